@@ -0,0 +1,54 @@
+# *-* encoding: utf-8 *-*
+"""
+Copyright (c) Copyright 2024 Scratch-Language Developers
+https://github.com/IsBenben/Scratch-Language
+License under the Apache License, version 2.0
+"""
+
+# Example usage:
+# python benchmarks/bench_parse.py
+# The time per token of TokenCursor should stay (almost) the same when the source grows,
+# the time per token of a list consumed by pop(0) grows with the source
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../src'))
+
+from bench_tokenize import generate
+from parse import Parser
+from tokens import TokenBuffer, TokenCursor, TokenLike
+
+class PopCursor:
+    # The cursor interface on a list consumed by pop(0), as the parser used to do
+    def __init__(self, tokens: list[TokenLike]):
+        self.tokens = tokens
+
+    def peek(self, k: int = 0) -> TokenLike:
+        return self.tokens[min(k, len(self.tokens) - 1)]
+
+    def advance(self) -> TokenLike:
+        if len(self.tokens) == 1:
+            return self.tokens[0]
+        return self.tokens.pop(0)
+
+def parse(cursor) -> None:
+    parser = Parser()
+    parser.record = None
+    parser.no_new_record = None
+    parser.parse_program(cursor)
+
+def main() -> None:
+    print(f'{"cursor":>12} {"lines":>8} {"tokens":>9} {"seconds":>9} {"us/token":>9}')
+    for name, make_cursor in (('TokenCursor', TokenCursor), ('list.pop(0)', lambda tokens: PopCursor(list(tokens)))):
+        for lines in (2500, 5000, 10000, 20000):
+            tokens = TokenBuffer(generate(lines))
+            cursor = make_cursor(tokens)
+            start = time.perf_counter()
+            parse(cursor)
+            elapsed = time.perf_counter() - start
+            print(f'{name:>12} {lines:>8} {len(tokens):>9} {elapsed:>9.3f} {elapsed / len(tokens) * 1e6:>9.2f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+# *-* encoding: utf-8 *-*
+"""
+Copyright (c) Copyright 2024 Scratch-Language Developers
+https://github.com/IsBenben/Scratch-Language
+License under the Apache License, version 2.0
+"""
+
+# Example usage:
+# python benchmarks/bench_tokenize.py
+# The time per line should stay (almost) the same when the source grows
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../src'))
+
+from tokens import TokenBuffer, tokenize
+
+LINES = [
+    '// generated line {i}',
+    'var value_{i} = {i} * 0x1F + 0.5;',
+    'looks_say("item " .. value_{i});',
+    'if (value_{i} >= 10 && value_{i} != 20) {{ value_{i} -= 1; }}',
+]
+
+def generate(lines: int) -> str:
+    return '\n'.join(LINES[i % len(LINES)].format(i=i) for i in range(lines))
+
+def main() -> None:
+    print(f'{"lexer":>12} {"lines":>8} {"tokens":>9} {"seconds":>9} {"us/line":>9}')
+    for lexer in (tokenize, TokenBuffer):
+        for lines in (1000, 5000, 25000, 50000):
+            code = generate(lines)
+            start = time.perf_counter()
+            tokens = lexer(code)
+            elapsed = time.perf_counter() - start
+            print(f'{lexer.__name__:>12} {lines:>8} {len(tokens):>9} {elapsed:>9.3f} {elapsed / lines * 1e6:>9.2f}')
+
+if __name__ == '__main__':
+    main()
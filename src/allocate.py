@@ -0,0 +1,203 @@
+# *-* encoding: utf-8 *-*
+"""
+Copyright (c) Copyright 2024 Scratch-Language Developers
+https://github.com/IsBenben/Scratch-Language
+License under the Apache License, version 2.0
+"""
+
+# Slot allocation (runs on the emitted project):
+# the parser makes a stage variable (or list) for every temporary, and every scope makes its own locals,
+# but most of them are never live at the same time, so they can share one variable (a "slot")
+# The liveness is computed for each script, and only the variables used in one script share its slots,
+# so two scripts running at the same time never write the variables of each other
+
+from typing import Iterator
+
+FIELD_NAMES = ('VARIABLE', 'LIST')
+SUBSTACK_NAMES = ('SUBSTACK', 'SUBSTACK2')
+# These blocks write their variable (or list), and the ones in KILL_OPCODES do not read it before
+WRITE_OPCODES = {'data_setvariableto', 'data_changevariableby', 'data_deletealloflist', 'data_addtolist',
+                 'data_deleteoflist', 'data_insertatlist', 'data_replaceitemoflist'}
+KILL_OPCODES = {'data_setvariableto', 'data_deletealloflist'}
+# Other threads may run while these blocks wait (a called function may run the same script again)
+WAIT_OPCODES = {'control_wait', 'control_wait_until', 'looks_sayforsecs', 'looks_thinkforsecs',
+                'motion_glidesecstoxy', 'motion_glideto', 'sensing_askandwait', 'event_broadcastandwait',
+                'sound_playuntildone', 'looks_switchbackdroptoandwait', 'procedures_call'}
+
+class SlotAllocator:
+    def __init__(self, project: dict):
+        self.blocks: dict[str, dict] = project['targets'][1]['blocks']
+        self.variables: dict[str, list] = project['targets'][0]['variables']
+        self.lists: dict[str, list] = project['targets'][0]['lists']
+        # The state of the script being analyzed
+        self.candidates: set[str] = set()
+        self.interference: dict[str, set[str]] = {}
+        self.excluded: set[str] = set()
+        self.shared = False  # The script may run in many threads (clones, or a function called by them)
+        self.warp = False
+
+    def allocate(self) -> int:
+        # Share the slots, and return the number of the removed variables and lists
+        scripts: dict[str, list[str]] = {}  # top block id -> variables in the order of their first use
+        owners: dict[str, set[str | None]] = {}
+        script_of: dict[str, str] = {}
+        for block_id, block in self.blocks.items():
+            if block['topLevel']:
+                order: dict[str, None] = {}
+                for inner_id in self.walk(block_id):
+                    script_of[inner_id] = block_id
+                    for variable in self.references(self.blocks[inner_id]):
+                        order[variable] = None
+                scripts[block_id] = list(order)
+        for block_id, block in self.blocks.items():
+            for variable in self.references(block):
+                owners.setdefault(variable, set()).add(script_of.get(block_id))
+
+        rename: dict[str, str] = {}
+        for script_id, variables in scripts.items():
+            self.candidates = {variable for variable in variables if owners[variable] == {script_id}}
+            if len(self.candidates) < 2:
+                continue
+            self.analyze(script_id)
+            for stage in (self.variables, self.lists):
+                slots: list[tuple[str, set[str]]] = []  # (slot id, the variables in it)
+                for variable in variables:
+                    if variable not in self.candidates or variable in self.excluded or variable not in stage:
+                        continue
+                    conflicts = self.interference.get(variable, set())
+                    for slot_id, members in slots:
+                        if not conflicts & members:
+                            members.add(variable)
+                            rename[variable] = slot_id
+                            break
+                    else:
+                        slots.append((variable, {variable}))
+        if rename:
+            self.rename(rename)
+        return len(rename)
+
+    def analyze(self, script_id: str) -> None:
+        hat = self.blocks[script_id]
+        self.interference = {}
+        self.excluded = set()
+        self.shared = hat['opcode'] != 'event_whenflagclicked'
+        self.warp = False
+        if hat['opcode'] == 'procedures_definition':
+            prototype = self.blocks[hat['inputs']['custom_block'][1]]
+            self.warp = prototype['mutation'].get('warp') == 'true'
+        # A variable read before it is written keeps its value between the runs, so it cannot share
+        self.excluded |= self.live_stack(script_id, set())
+
+    def live_stack(self, block_id: str | None, live: set[str]) -> set[str]:
+        # The variables live before the stack starting at "block_id", with the ones live after it
+        stack = []
+        while block_id is not None:
+            stack.append(block_id)
+            block_id = self.blocks[block_id]['next']
+        for block_id in reversed(stack):
+            live = self.live_block(block_id, live)
+        return live
+
+    def live_block(self, block_id: str, live: set[str]) -> set[str]:
+        block = self.blocks[block_id]
+        opcode = block['opcode']
+        inputs = block['inputs']
+        uses = self.uses(block)
+        if opcode in ('control_if', 'control_if_else'):
+            result = set(live) if opcode == 'control_if' else set()
+            for name in SUBSTACK_NAMES[:1 if opcode == 'control_if' else 2]:
+                result |= self.live_stack(inputs.get(name, [2, None])[1], live)
+            return result | uses
+        substacks = [inputs[name][1] for name in SUBSTACK_NAMES if name in inputs]
+        if substacks or opcode == 'control_forever':
+            # A loop (or an unknown C block), iterated until nothing changes
+            header = live | uses
+            while True:
+                result = live | uses
+                for substack in substacks:
+                    result |= self.live_stack(substack, header)
+                if result == header:
+                    break
+                header = result
+            if self.shared and not self.warp:
+                # The loop waits for the next frame at the end
+                self.excluded |= header
+            return header
+        written: set[str] = set()
+        if opcode in WRITE_OPCODES:
+            written = set(self.references(block, inputs=False)) & self.candidates
+        for variable in written:
+            self.interfere(variable, live)
+        if self.shared and opcode in WAIT_OPCODES:
+            self.excluded |= live - written
+        if opcode in KILL_OPCODES:
+            live = live - written
+        return live | uses
+
+    def interfere(self, variable: str, live: set[str]) -> None:
+        conflicts = self.interference.setdefault(variable, set())
+        for other in live:
+            if other != variable:
+                conflicts.add(other)
+                self.interference.setdefault(other, set()).add(variable)
+
+    def uses(self, block: dict) -> set[str]:
+        # The variables read by the block and its reporters
+        result: set[str] = set()
+        if block['opcode'] not in KILL_OPCODES:
+            result.update(self.references(block, inputs=False))
+        stack = [block]
+        while stack:
+            block = stack.pop()
+            for name, value in block['inputs'].items():
+                if name in SUBSTACK_NAMES:
+                    continue
+                for item in value[1:]:
+                    if isinstance(item, str) and item in self.blocks:
+                        reporter = self.blocks[item]
+                        result.update(self.references(reporter, inputs=False))
+                        stack.append(reporter)
+                    elif isinstance(item, list) and item[0] in (12, 13):
+                        result.add(item[2])
+        return result & self.candidates
+
+    def references(self, block: dict, inputs: bool = True) -> Iterator[str]:
+        # The variables and lists in the fields (and the inputs) of the block, not of its reporters
+        for name in FIELD_NAMES:
+            if name in block['fields']:
+                yield block['fields'][name][1]
+        if inputs:
+            for value in block['inputs'].values():
+                for item in value[1:]:
+                    if isinstance(item, list) and item[0] in (12, 13):
+                        yield item[2]
+
+    def walk(self, block_id: str) -> Iterator[str]:
+        # The blocks of a script, in order
+        stack = [block_id]
+        while stack:
+            block_id = stack.pop()
+            block = self.blocks[block_id]
+            yield block_id
+            children = [item for value in block['inputs'].values() for item in value[1:]
+                        if isinstance(item, str) and item in self.blocks]
+            if block['next'] is not None:
+                children.append(block['next'])
+            stack.extend(reversed(children))
+
+    def rename(self, rename: dict[str, str]) -> None:
+        names = {slot_id: (self.variables.get(slot_id) or self.lists[slot_id])[0] for slot_id in set(rename.values())}
+        for variable in rename:
+            self.variables.pop(variable, None)
+            self.lists.pop(variable, None)
+        for block in self.blocks.values():
+            for name in FIELD_NAMES:
+                field = block['fields'].get(name)
+                if field is not None and field[1] in rename:
+                    slot_id = rename[field[1]]
+                    block['fields'][name] = [names[slot_id], slot_id]
+            for value in block['inputs'].values():
+                for item in value[1:]:
+                    if isinstance(item, list) and item[0] in (12, 13) and item[2] in rename:
+                        item[2] = rename[item[2]]
+                        item[1] = names[item[2]]
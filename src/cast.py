@@ -0,0 +1,117 @@
+# *-* encoding: utf-8 *-*
+"""
+Copyright (c) Copyright 2024 Scratch-Language Developers
+https://github.com/IsBenben/Scratch-Language
+License under the Apache License, version 2.0
+"""
+
+# The conversions of Scratch (see scratch-vm/src/util/cast.js), used to fold the constants at compile time
+# A value is a float (a JavaScript number) or a str
+
+import math
+import re
+
+# The white spaces of String.prototype.trim
+WHITE_SPACES = '\t\n\v\f\r \u00a0\u1680\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2007\u2008\u2009\u200a\u2028\u2029\u202f\u205f\u3000\ufeff'
+# Only the ASCII digits (unlike \d and float, JavaScript does not read the other digits)
+DECIMAL_REGEX = re.compile(r'[+-]?(Infinity|([0-9]+\.?[0-9]*|\.[0-9]+)([eE][+-]?[0-9]+)?)')
+INTEGER_REGEXES = {16: re.compile(r'0[xX][0-9a-fA-F]+'), 8: re.compile(r'0[oO][0-7]+'), 2: re.compile(r'0[bB][01]+')}
+
+def js_number(value: float | str) -> float:
+    # Number(value), NaN if it's not a number
+    if isinstance(value, float):
+        return value
+    text = value.strip(WHITE_SPACES)
+    if not text:
+        return 0.0
+    if text.isascii() and DECIMAL_REGEX.fullmatch(text):
+        return float(text.replace('Infinity', 'inf'))
+    for base, regex in INTEGER_REGEXES.items():
+        if regex.fullmatch(text):
+            return float(int(text[2:], base))
+    return math.nan
+
+def to_number(value: float | str) -> float:
+    number = js_number(value)
+    return 0.0 if math.isnan(number) else number
+
+def to_string(value: float | str) -> str:
+    if isinstance(value, str):
+        return value
+    # Number.prototype.toString: the shortest digits (like repr) in the format of JavaScript
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return 'Infinity' if value > 0 else '-Infinity'
+    if value == 0:
+        return '0'
+    mantissa, _, exponent = repr(abs(value)).partition('e')
+    integer, _, fraction = mantissa.partition('.')
+    digits = integer + fraction
+    # The number of the digits before the point
+    point = len(integer) + int(exponent or 0) - (len(digits) - len(digits.lstrip('0')))
+    digits = digits.strip('0')
+    sign = '-' if value < 0 else ''
+    if len(digits) <= point <= 21:
+        return sign + digits + '0' * (point - len(digits))
+    if 0 < point <= 21:
+        return sign + digits[:point] + '.' + digits[point:]
+    if -6 < point <= 0:
+        return sign + '0.' + '0' * -point + digits
+    point -= 1
+    return sign + digits[0] + ('.' + digits[1:] if len(digits) > 1 else '') + ('e+' if point >= 0 else 'e-') + str(abs(point))
+
+def is_white_space(value: float | str) -> bool:
+    return isinstance(value, str) and not value.strip(WHITE_SPACES)
+
+def lower(value: float | str) -> str | None:
+    # String.prototype.toLowerCase, None if the result may be different from Python
+    text = to_string(value)
+    return text.lower() if text.isascii() else None
+
+def compare(left: float | str, right: float | str) -> float | None:
+    # Negative, zero or positive, None if it cannot be known at compile time
+    left_number, right_number = js_number(left), js_number(right)
+    if left_number == 0 and is_white_space(left) or right_number == 0 and is_white_space(right):
+        left_number = math.nan
+    if math.isnan(left_number) or math.isnan(right_number):
+        # Compared as strings, without case
+        left_text, right_text = lower(left), lower(right)
+        if left_text is None or right_text is None:
+            return None
+        return (left_text > right_text) - (left_text < right_text)
+    if left_number == right_number:
+        # Also Infinity and Infinity
+        return 0
+    return left_number - right_number
+
+def utf16_length(text: str) -> int | None:
+    # String.prototype.length, None if it has a character out of the BMP (it's two characters in JavaScript)
+    if any(ord(char) > 0xffff for char in text):
+        return None
+    return len(text)
+
+def js_round(value: float) -> float:
+    # Math.round: half up
+    if not math.isfinite(value):
+        return value
+    result = math.floor(value)
+    if value - result >= 0.5:
+        result += 1
+    return math.copysign(float(result), value) if result == 0 else float(result)
+
+def js_divide(left: float, right: float) -> float:
+    if right == 0:
+        if left == 0 or math.isnan(left):
+            return math.nan
+        return math.copysign(math.inf, left) * math.copysign(1, right)
+    return left / right
+
+def js_mod(left: float, right: float) -> float:
+    # The "mod" block: the sign of the result is the sign of the divisor
+    if right == 0 or math.isinf(left) or math.isnan(left) or math.isnan(right):
+        return math.nan
+    result = math.fmod(left, right) if not math.isinf(right) else left
+    if result / right < 0:
+        result += right
+    return result
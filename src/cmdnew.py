@@ -9,10 +9,15 @@ License under the Apache License, version 2.0
 # python cmdnew.py --infile test.scl --sb3 --outfile output.sb3
 
 from error import ScratchLanguageError
+from incremental import Document
 from interpret import Interpreter
-from parse import Parser
-from preprocessing import preprocess
-from utils import get_args, arg_parser
+from linker import Linker, unit_cache
+from parse import Parser, program_cache
+from passes import PASSES, pass_manager
+from preprocessing import include_cache, preprocess
+from typing import TextIO
+from utils import VERSION, get_args, arg_parser
+from warp import warp_report
 import atexit
 import json
 import sys
@@ -23,11 +28,21 @@ import time
 
 args = get_args()
 
-if args.lint:
-    arg_parser.error('Linter is not implemented yet.')
+if args.edits and not args.lint:
+    arg_parser.error('--edits 只能与 --lint 一起使用')
+if args.separate and not (args.json or args.sb3):
+    arg_parser.error('--separate 只能与 --json 或 --sb3 一起使用')
+if args.passes is not None:
+    pass_manager.enabled = {name.strip() for name in args.passes.split(',') if name.strip()}
+    for name in pass_manager.enabled - {item.name for item in PASSES}:
+        arg_parser.error(f'未知的优化 {name}，可用的优化：{", ".join(item.name for item in PASSES)}')
+if args.passreport:
+    atexit.register(lambda: sys.stderr.write(pass_manager.report()))
+if args.warpreport:
+    atexit.register(lambda: sys.stderr.write(warp_report()))
 
 if not args.quite:
-    print('[Scratch-Language] version 1.2.3')
+    print(f'[Scratch-Language] version {VERSION}')
     print()
     start = time.time()
     atexit.register(lambda: print(f'Successfully completed with {time.time() - start:.2f} seconds.'))
@@ -39,35 +54,66 @@ interpreter = Interpreter()
 if args.recursionlimit <= 10:
     arg_parser.error('递归的上限数字太小')
 sys.setrecursionlimit(args.recursionlimit)
+if args.nocache:
+    include_cache.path = None
+    program_cache.path = None
+    unit_cache.path = None
+if args.warpreport:
+    # The decisions are made by the warp pass, which a cached program (or unit) skips
+    program_cache.path = None
+    unit_cache.path = None
 
 infile = None
-incode = args.incode
+# The file is not read at once, the tokens are streamed from it
+incode: str | TextIO = args.incode
 if args.infile is not None:
     infile =  open(args.infile, 'r', encoding='utf-8')
     atexit.register(infile.close)
-    incode = infile.read()
+    incode = infile
 outfile = sys.stdout
 if args.outfile:
     outfile = open(args.outfile, 'w', encoding='utf-8')
     atexit.register(outfile.close)
 
+def build() -> None:
+    if args.separate:
+        Linker(interpreter).build(incode)
+    else:
+        interpreter.visit(parser.parse(preprocess(incode)))
+    if not args.nooptimize:
+        # After linking, the scripts of the units are in the project too
+        pass_manager.run_project(interpreter.project)
+
 # Process the input code
 try:
     if args.json:
-        interpreter.visit(parser.parse(preprocess(incode)))
+        build()
         json.dump(interpreter.project, outfile, indent=2)
     elif args.ast:
         outfile.write(parser.parse(preprocess(incode)).dump())
     elif args.sb3:
         if outfile == sys.stdout:
             arg_parser.error('二进制文件不能输出到标准输出')
-        interpreter.visit(parser.parse(preprocess(incode)))
+        build()
         shutil.copyfile(os.path.join(folder, 'default.zip'), outfile.name)
         with zipfile.ZipFile(outfile.name, 'a') as f:
             f.writestr('project.json', json.dumps(interpreter.project, separators=(',', ':')))
     elif args.tokens:
         for token in preprocess(incode):
             outfile.write(token.desc + '\n')
+    elif args.lint:
+        # One line of diagnostics (JSON) for the input, and one line for each edit
+        document = Document(incode if isinstance(incode, str) else incode.read())
+        outfile.write(json.dumps(document.diagnostics, ensure_ascii=False) + '\n')
+        outfile.flush()
+        if args.edits:
+            for line in sys.stdin:
+                if not line.strip():
+                    continue
+                edit = json.loads(line)
+                diagnostics = document.edit(edit['start'], edit['end'], edit['text'])
+                outfile.write(json.dumps(diagnostics, ensure_ascii=False) + '\n')
+                outfile.flush()
 except ScratchLanguageError:
     print('生成时发生错误，请检查您的代码。')
     # raise  # For debugging
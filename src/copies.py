@@ -0,0 +1,199 @@
+# *-* encoding: utf-8 *-*
+"""
+Copyright (c) Copyright 2024 Scratch-Language Developers
+https://github.com/IsBenben/Scratch-Language
+License under the Apache License, version 2.0
+"""
+
+# Copy elision for the temporary lists (on the syntax tree):
+# a list expression (like [1, 2], (1 -> n), [for ...], or an array in a join or an if expression) is made
+# in a temporary list, then copied item by item (a loop, see poly_copy_list) into the list it's assigned to
+# When the temporary is only made (cleared, then added to) before the copy, and never used after it,
+# the items are added straight into the destination list, and the copy loop is removed
+# The destination must not be used while the temporary is made, because it gets the items earlier
+
+from nodes import *
+from optimize import Names
+from typing import TypeGuard
+from utils import TEMPORARY_PREFIX
+
+class Mentions(NodeVisitor):
+    # The names used in a tree (the declarations too), and the uses of "name" which are not "add to list" of it
+    def __init__(self, name: str, functions: set[str]) -> None:
+        self.name = name
+        self.functions = functions
+        self.names: set[str] = set()
+        self.other_uses = False  # "name" is read, or set another way
+        self.calls = False  # A custom function is called, it may use any list
+
+    def visit_FunctionCall(self, node):
+        if not node.always_builtin and node.name in self.functions:
+            self.calls = True
+        args = node.args
+        if node.name == 'data_addtolist' and len(args) == 2 and isinstance(args[0], Identifier) and args[0].name == self.name:
+            self.names.add(self.name)
+            args = args[1:]
+        for arg in args:
+            self.visit(arg)
+
+    def visit_Identifier(self, node):
+        self.names.add(node.name)
+        if node.name == self.name:
+            self.other_uses = True
+
+    visit_ListIdentifier = visit_Identifier
+
+    def visit_VariableDeclaration(self, node):
+        self.names.add(node.name)
+        if node.name == self.name:
+            self.other_uses = True
+
+    def visit_FunctionDeclaration(self, node):
+        self.names.add(node.name)
+        self.generic_visit(node)
+
+    def visit_Clone(self, node):
+        self.generic_visit(node)
+
+class Rename(NodeTransformer):
+    # Replace the temporary list with the destination list
+    def __init__(self, name: str, target: Identifier) -> None:
+        super().__init__()
+        self.name = name
+        self.target = target
+
+    def visit_Identifier(self, node):
+        return self.target if node.name == self.name else None
+
+    visit_ListIdentifier = visit_Identifier
+
+def is_call(node: Node, name: str, count: int) -> TypeGuard[FunctionCall]:
+    return isinstance(node, FunctionCall) and node.name == name and len(node.args) == count
+
+def match_copy(statements: list[Statement]) -> tuple[Identifier, Identifier, Identifier, bool] | None:
+    # [delete all of destination], index = 0, repeat (length of source) {change index by 1; add (item index of source) to destination}
+    # Returns the destination, the source, the index, and if the destination is cleared first
+    full = bool(statements) and is_call(statements[0], 'data_deletealloflist', 1)
+    if len(statements) != 2 + full:
+        return None
+    reset, loop = statements[full:]
+    if not (is_call(reset, 'data_setvariableto', 2) and type(reset.args[0]) is Identifier
+            and isinstance(reset.args[1], Number) and reset.args[1].value == 0
+            and is_call(loop, 'control_repeat', 2) and is_call(loop.args[0], 'data_lengthoflist', 1)
+            and type(loop.args[1]) is Block and len(loop.args[1].body) == 2):
+        return None
+    index = reset.args[0]
+    source = loop.args[0].args[0]
+    change, add = loop.args[1].body
+    if not (isinstance(source, Identifier) and is_call(change, 'data_changevariableby', 2)
+            and type(change.args[0]) is Identifier and change.args[0].name == index.name
+            and isinstance(change.args[1], Number) and change.args[1].value == 1
+            and is_call(add, 'data_addtolist', 2) and isinstance(add.args[0], Identifier)
+            and is_call(add.args[1], 'data_itemoflist', 2)):
+        return None
+    destination = add.args[0]
+    item_source, item_index = add.args[1].args
+    if not (isinstance(item_source, Identifier) and item_source.name == source.name
+            and type(item_index) is Identifier and item_index.name == index.name
+            and len({index.name, source.name, destination.name}) == 3):
+        return None
+    cleared = statements[0]
+    if full and not (is_call(cleared, 'data_deletealloflist', 1) and isinstance(cleared.args[0], Identifier)
+                     and cleared.args[0].name == destination.name):
+        return None
+    return destination, source, index, full
+
+def match_block_copy(statement: Statement) -> tuple[Identifier, Identifier, Identifier, bool] | None:
+    # A copy in its own block (with the declaration of its index), like the assignment of a list
+    declared: set[str] = set()  # The names declared in the blocks (at every level)
+    while type(statement) is Block:
+        declared.update(item.name for item in statement.body if isinstance(item, VariableDeclaration))
+        body = [item for item in statement.body if not isinstance(item, VariableDeclaration)]
+        if len(body) == 1 and type(body[0]) is Block:
+            statement = body[0]
+            continue
+        copy = match_copy(body)
+        if copy is None:
+            return None
+        # Only the index may be declared in the blocks (else the destination may be another list)
+        return copy if declared <= {copy[2].name} else None
+    return None
+
+class CopyElider(NodeTransformer):
+    def __init__(self, exports: bool = False) -> None:
+        super().__init__()
+        self.exports = exports  # The top-level lists may be used by the other units (see linker.py)
+        self.functions: set[str] = set()
+
+    def visit_Program(self, node):
+        names = Names()
+        names.visit(node)
+        self.functions = names.functions
+        return self.visit_scope(node)
+
+    def visit_Block(self, node):
+        return self.visit_scope(node)
+
+    def visit_scope(self, node: Block):
+        results = self.visit_children(node.body)
+        body = node.body if results is None else results
+        changed = results is not None
+        index = 0
+        while index < len(body):
+            # The copies in their own blocks, then the copies in this block (the joins of the lists)
+            copy, end = match_block_copy(body[index]), index + 1
+            if copy is None:
+                for end in range(index + 2, min(index + 3, len(body)) + 1):
+                    copy = match_copy(body[index:end])
+                    if copy is not None:
+                        break
+            if copy is None or self.exports and type(node) is Program:
+                index += 1
+                continue
+            destination, source, _, full = copy
+            elided = self.elide(body, index, end, destination, source, full)
+            if elided is None:
+                index += 1
+                continue
+            body = elided
+            self.rewrites += 1
+            changed = True
+            index = 0
+        if not changed:
+            return node
+        rebuilt = node.replace(body=body)
+        self.rebuilt[id(rebuilt)] = rebuilt
+        return rebuilt
+
+    def elide(self, body: list[Statement], start: int, end: int,
+              destination: Identifier, source: Identifier, full: bool) -> list[Statement] | None:
+        # The new body without the copy body[start:end], None if the copy is needed
+        if not source.name.startswith(TEMPORARY_PREFIX):
+            # Only a temporary list (made by the parser) is only made for the copy
+            return None
+        declaration = next((index for index, statement in enumerate(body[:start])
+                            if isinstance(statement, VariableDeclaration) and statement.name == source.name), None)
+        if declaration is None:
+            return None
+        mentions = [Mentions(source.name, self.functions) for _ in body]
+        for mention, statement in zip(mentions, body):
+            mention.visit(statement)
+        # The temporary is cleared first, and not used after the copy
+        clear = next((index for index in range(declaration + 1, start) if source.name in mentions[index].names), None)
+        if clear is None or not is_call(body[clear], 'data_deletealloflist', 1) \
+                or any(source.name in mention.names for mention in mentions[end:]):
+            return None
+        # The destination is the same list at the clear (declared before it, in this body or an enclosing one)
+        if any(isinstance(statement, VariableDeclaration) and statement.name == destination.name
+               for statement in body[clear:end]):
+            return None
+        # Then it is only added to, and the destination is not used
+        for mention in mentions[clear + 1:start]:
+            if mention.other_uses or mention.calls or destination.name in mention.names:
+                return None
+        target = ListIdentifier(destination.name)
+        rename = Rename(source.name, target)
+        made = [statement if result is None else result
+                for statement, result in ((statement, rename.visit(statement)) for statement in body[clear + 1:start])]
+        cleared: list[Statement] = [FunctionCall('data_deletealloflist', [target])] if full else []
+        return body[:clear] + cleared + made + body[end:]
@@ -0,0 +1,166 @@
+# *-* encoding: utf-8 *-*
+"""
+Copyright (c) Copyright 2024 Scratch-Language Developers
+https://github.com/IsBenben/Scratch-Language
+License under the Apache License, version 2.0
+"""
+
+# Common subexpression elimination (on the syntax tree):
+# a reporter computed again and again in a basic block (the statements between two control blocks, custom calls
+# or blocks waiting, so no other thread runs in the middle) is computed once into a temporary, before its first use
+# Only the reporters which depend on their arguments (and the lists) are shared (see INVARIANT_REPORTERS,
+# but not an item at a random index, see random_item),
+# until a statement sets a variable or a list they read
+# A temporary costs a block (setting it) and a read for each use, so a reporter is only shared if it costs more:
+# each block costs BLOCK_COST, and each variable read costs READ_COST (in Scratch, a variable is a block too)
+
+from allocate import WAIT_OPCODES
+from interpret import BLOCK_TYPES
+from loops import INVARIANT_REPORTERS, random_item
+from nodes import *
+from optimize import LIST_WRITE_FUNCTIONS, WRITE_FUNCTIONS, Names
+from utils import generate_name
+
+BLOCK_COST = 2
+READ_COST = 1
+
+def cost(node: Node) -> int:
+    if isinstance(node, FunctionCall):
+        return BLOCK_COST + sum(cost(arg) for arg in node.args)
+    # (a list is a field, not a block)
+    return READ_COST if type(node) is Identifier else 0
+
+def is_block(node: FunctionCall, functions: set[str]) -> bool:
+    # A Scratch block, not a custom function (a function of a linked unit is not in "functions", like in WaitFinder)
+    return node.always_builtin or node.name in BLOCK_TYPES and node.name not in functions
+
+def in_basic_block(statement: Statement, functions: set[str]) -> bool:
+    # The statement runs at once, without control flow, and then the next statement runs
+    return isinstance(statement, FunctionCall) and not statement.name.startswith('control_') \
+        and statement.name not in WAIT_OPCODES and is_block(statement, functions)
+
+class Group:
+    # The uses of a reporter in a basic block, while the variables and the lists it reads are not set
+    def __init__(self, node: FunctionCall, reads: set[str], first: int) -> None:
+        self.node = node
+        self.reads = reads
+        self.first = first  # The statements of the uses (indexes in the basic block)
+        self.last = first
+        self.count = 0
+
+    @property
+    def benefit(self) -> int:
+        # The cost saved by the temporary
+        return (self.count - 1) * cost(self.node) - BLOCK_COST - self.count * READ_COST
+
+class Reporters(NodeVisitor):
+    # The shareable reporters in a statement: the key (the dump) of each one -> the node, and the names it reads
+    def __init__(self, functions: set[str]) -> None:
+        self.functions = functions
+        self.found: list[tuple[str, FunctionCall, set[str]]] = []
+
+    def visit_FunctionCall(self, node):
+        self.shareable(node)
+
+    def shareable(self, node: Node) -> set[str] | None:
+        # The names read by the node, None if it cannot be shared
+        if isinstance(node, (Number, String)):
+            return set()
+        if isinstance(node, Identifier):
+            return {node.name}
+        if not isinstance(node, FunctionCall):
+            return None
+        args = node.args
+        if node.name in WRITE_FUNCTIONS + LIST_WRITE_FUNCTIONS and args and isinstance(args[0], Identifier):
+            # The variable (or the list) set is not a reporter
+            args = args[1:]
+        reads = [self.shareable(arg) for arg in args]
+        if node.name not in INVARIANT_REPORTERS or random_item(node) or not is_block(node, self.functions) \
+                or any(names is None for names in reads):
+            return None
+        names = set().union(*(names for names in reads if names is not None))
+        self.found.append((node.dump(), node, names))
+        return names
+
+class Replace(NodeTransformer):
+    def __init__(self, key: str, temporary: Identifier) -> None:
+        super().__init__()
+        self.key = key
+        self.temporary = temporary
+
+    def visit_FunctionCall(self, node):
+        if node.dump() == self.key:
+            return self.temporary
+        return self.generic_visit(node)
+
+class CommonSubexpressionEliminator(NodeTransformer):
+    def __init__(self) -> None:
+        super().__init__()
+        self.functions: set[str] = set()
+
+    def visit_Program(self, node):
+        names = Names()
+        names.visit(node)
+        self.functions = names.functions
+        return self.visit_scope(node)
+
+    def visit_Block(self, node):
+        return self.visit_scope(node)
+
+    def visit_FunctionDeclaration(self, node):
+        if 'nooptimize' in node.attributes:
+            return None
+        return self.generic_visit(node)
+
+    def visit_scope(self, node: Block):
+        results = self.visit_children(node.body)
+        body = node.body if results is None else results
+        changed = results is not None
+        start = 0
+        while start < len(body):
+            end = start
+            while end < len(body) and in_basic_block(body[end], self.functions):
+                end += 1
+            shared = self.share(body[start:end])
+            if shared is None:
+                start = end + 1
+                continue
+            body = body[:start] + shared + body[end:]
+            changed = True
+        if not changed:
+            return node
+        rebuilt = node.replace(body=body)
+        self.rebuilt[id(rebuilt)] = rebuilt
+        return rebuilt
+
+    def share(self, statements: list[Statement]) -> list[Statement] | None:
+        # The basic block with the most beneficial reporter shared, None if nothing is worth sharing
+        groups: list[Group] = []
+        live: dict[str, Group] = {}
+        for index, statement in enumerate(statements):
+            reporters = Reporters(self.functions)
+            reporters.visit(statement)
+            for key, reporter, reads in reporters.found:
+                if key not in live:
+                    live[key] = Group(reporter, reads, index)
+                    groups.append(live[key])
+                live[key].count += 1
+                live[key].last = index
+            # The statement sets a variable (or a list) after reading it, then the next uses are another group
+            assert isinstance(statement, FunctionCall)
+            if statement.name in WRITE_FUNCTIONS + LIST_WRITE_FUNCTIONS and statement.args \
+                    and isinstance(statement.args[0], Identifier):
+                written = statement.args[0].name
+                live = {key: group for key, group in live.items() if written not in group.reads}
+        best = max(groups, key=lambda group: group.benefit, default=None)
+        if best is None or best.benefit <= 0:
+            return None
+        self.rewrites += 1
+        temporary = Identifier('')
+        temporary.name = generate_name(('cse', temporary))
+        replace = Replace(best.node.dump(), temporary)
+        uses = [statement if result is None else result for statement, result in
+                ((statement, replace.visit(statement)) for statement in statements[best.first:best.last + 1])]
+        return statements[:best.first] + [VariableDeclaration(temporary.name, False, False),
+                                          FunctionCall('data_setvariableto', [temporary, best.node])] \
+            + uses + statements[best.last + 1:]
@@ -0,0 +1,177 @@
+# *-* encoding: utf-8 *-*
+"""
+Copyright (c) Copyright 2024 Scratch-Language Developers
+https://github.com/IsBenben/Scratch-Language
+License under the Apache License, version 2.0
+"""
+
+# Incremental front end for editors:
+# after an edit, only the damaged tokens are lexed again,
+# and only the top-level statements around them are parsed again
+
+from __future__ import annotations
+from contextlib import redirect_stdout
+from dataclasses import dataclass
+from error import ScratchLanguageError
+from nodes import Program, Statement, VariableDeclaration
+from parse import Parser, Record, extend_or_append
+from preprocessing import preprocess
+from tokens import TOKEN_TYPES, TokenBuffer, TokenCursor, TokenType
+from typing import Callable
+import io
+
+PREPROCESSING_INDEX = TOKEN_TYPES.index(TokenType.PREPROCESSING)
+
+@dataclass
+class Segment:
+    # A top-level statement: tokens[first:stop], and the nodes it added to the program
+    first: int
+    stop: int
+    nodes: list[Statement]
+    declarations: list[VariableDeclaration]
+
+    @property
+    def signature(self) -> list[tuple[str, bool, bool]]:
+        # The declarations change how the later statements are parsed (for example a[1])
+        return [(node.name, node.is_const, node.is_array) for node in self.declarations]
+
+class TopLevelRecord(Record):
+    # Remembers the declarations of the current top-level statement
+    def __init__(self, block: list[Statement]):
+        super().__init__(block)
+        self.declared: list[VariableDeclaration] = []
+
+    def variable_declaration(self, name: str, *args, **kwargs):
+        result = super().variable_declaration(name, *args, **kwargs)
+        self.declared.append(result)
+        return result
+
+class Document:
+    def __init__(self, code: str):
+        self.code = code
+        self.tokens: TokenBuffer | None = None
+        self.segments: list[Segment] | None = None
+        self.program: Program | None = None
+        self.diagnostics: list[str] = []
+        self.rebuild()
+
+    def rebuild(self) -> None:
+        self.tokens = None
+        self.segments = None
+        self.program = None
+        self.diagnostics = self._capture(self._rebuild)
+
+    def edit(self, start: int, end: int, text: str) -> list[str]:
+        # Replace code[start:end] with text, and return the diagnostics
+        self.code = self.code[:start] + text + self.code[end:]
+        if self.tokens is None or self.segments is None:
+            self.rebuild()
+        else:
+            self.diagnostics = self._capture(lambda: self._edit(start, end, text))
+            if self.diagnostics:
+                # The old parse state is not usable any more
+                self.segments = None
+        return self.diagnostics
+
+    def _capture(self, function: Callable[[], None]) -> list[str]:
+        # raise_error prints the error, so the printed text is the diagnostic
+        output = io.StringIO()
+        try:
+            with redirect_stdout(output):
+                function()
+        except ScratchLanguageError:
+            return [line for line in output.getvalue().splitlines() if line]
+        return []
+
+    def _rebuild(self) -> None:
+        self.tokens = TokenBuffer(self.code)
+        if self._has_directives():
+            # A macro or an include may change any token, so the whole program is always parsed again
+            # ("segments" stays None)
+            self._parse_whole()
+            return None
+        self.segments = self._parse_segments(0, [])
+        self.program = self._join()
+
+    def _edit(self, start: int, end: int, text: str) -> None:
+        assert self.tokens is not None and self.segments is not None
+        first, old_stop, new_stop = self.tokens.edit(start, end, text)
+        if self._has_directives():
+            self.segments = None
+            self._parse_whole()
+            return None
+        shift = new_stop - old_stop
+        segments = self.segments
+        # The parser looks two tokens ahead (for example "else" after an if statement),
+        # so the statement just before the damaged tokens is parsed again too
+        lo = 0
+        while lo < len(segments) and segments[lo].stop + 2 <= first:
+            lo += 1
+        hi = lo
+        while hi < len(segments) and segments[hi].first < old_stop:
+            hi += 1
+        start_token = segments[lo].first if lo < len(segments) else first
+        kept = segments[hi:]
+        for segment in kept:
+            segment.first += shift
+            segment.stop += shift
+        parsed = self._parse_segments(start_token, segments[:lo], new_stop, kept, segments[lo:hi])
+        self.segments = parsed
+        self.program = self._join()
+
+    def _has_directives(self) -> bool:
+        assert self.tokens is not None
+        return PREPROCESSING_INDEX in self.tokens.types
+
+    def _parse_whole(self) -> None:
+        # Same as Parser.parse, but not optimized
+        parser = Parser()
+        parser.record = None
+        parser.no_new_record = None
+        self.program = parser.parse_program(TokenCursor(preprocess(self.code)))
+
+    def _parse_segments(self, first: int, before: list[Segment], damaged_stop: int = 0,
+                        after: list[Segment] | None = None, replaced: list[Segment] | None = None) -> list[Segment]:
+        # Parse top-level statements from tokens[first], until the old statements are reached again
+        assert self.tokens is not None
+        after = after or []
+        replaced = replaced or []
+        parser = Parser()
+        body: list[Statement] = []
+        record = TopLevelRecord(body)
+        parser.record = record
+        parser.no_new_record = None
+        for segment in before:
+            for declaration in segment.declarations:
+                record.variables[declaration.name] = declaration
+        tokens = TokenCursor(self.tokens.iter_from(first))
+        segments = list(before)
+        new_signature: list[tuple[str, bool, bool]] = []
+        old_signature = [item for segment in replaced for item in segment.signature]
+        position = first
+        while tokens.peek().type != TokenType.EOF:
+            if position >= damaged_stop and after and position == after[0].first \
+                   and new_signature == old_signature:
+                # The rest is not changed
+                return segments + after
+            if after and position > after[0].first:
+                # Old statements swallowed by the new ones
+                old_signature += after.pop(0).signature
+                continue
+            body.clear()
+            record.declared = []
+            statement = parser.parse_statement(tokens)
+            if statement is not None:
+                extend_or_append(body, statement)
+            segment = Segment(position, first + tokens.position, list(body), record.declared)
+            new_signature += segment.signature
+            segments.append(segment)
+            position = first + tokens.position
+        return segments
+
+    def _join(self) -> Program:
+        assert self.segments is not None
+        program = Program()
+        for segment in self.segments:
+            program.body.extend(segment.nodes)
+        return program
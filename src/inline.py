@@ -0,0 +1,222 @@
+# *-* encoding: utf-8 *-*
+"""
+Copyright (c) Copyright 2024 Scratch-Language Developers
+https://github.com/IsBenben/Scratch-Language
+License under the Apache License, version 2.0
+"""
+
+# Inline expansion (on the syntax tree): a call of a small custom function is replaced with the body of the function,
+# so no procedures_call (and no frame for its arguments) runs
+# The arguments are set to temporaries before the body (a literal argument is used directly),
+# and the names used in the body must mean the same variables and functions at the call as at the declaration
+# (the names are resolved like DeadCodeEliminator does)
+# A function is inlined if it is small (see INLINE_BLOCKS), or called only once (then the body is moved, not copied),
+# or has attribute(inline); never if it has attribute(noinline) or attribute(nooptimize), or it may call itself
+
+from allocate import WAIT_OPCODES
+from loops import count_blocks
+from nodes import *
+from optimize import LIST_WRITE_FUNCTIONS, WRITE_FUNCTIONS, Key
+from utils import generate_name
+
+INLINE_BLOCKS = 12  # The most blocks of the body of an inlined function (without attribute(inline))
+LOOP_FUNCTIONS = ('control_repeat', 'control_repeat_until', 'control_forever')
+
+class BodyNames(NodeVisitor):
+    # The names used in the body of a function, and the things in it which stop the inlining
+    def __init__(self, arguments: list[str]) -> None:
+        self.arguments = arguments
+        self.names: set[str] = set()  # The variables, the lists and the custom functions
+        self.declarations = False  # A function or a clone is declared, or an argument is declared again or set
+        self.yields = False  # Other threads may run in the middle of the body (a loop, a wait, or a custom function)
+
+    def visit_FunctionCall(self, node):
+        if node.name in WRITE_FUNCTIONS + LIST_WRITE_FUNCTIONS and node.args and isinstance(node.args[0], Identifier) \
+                and node.args[0].name in self.arguments:
+            self.declarations = True
+        if not node.always_builtin:
+            self.names.add(node.name)
+            self.yields = True
+        if node.name in LOOP_FUNCTIONS or node.name in WAIT_OPCODES:
+            self.yields = True
+        self.generic_visit(node)
+
+    def visit_Identifier(self, node):
+        self.names.add(node.name)
+
+    def visit_ListIdentifier(self, node):
+        self.names.add(node.name)
+        if node.name in self.arguments:
+            self.declarations = True
+
+    def visit_VariableDeclaration(self, node):
+        if node.name in self.arguments:
+            self.declarations = True
+
+    def visit_FunctionDeclaration(self, node):
+        self.declarations = True
+
+    def visit_Clone(self, node):
+        self.declarations = True
+
+class Substitution(NodeTransformer):
+    # Replace the arguments of a function with their values
+    def __init__(self, values: dict[str, Node]) -> None:
+        super().__init__()
+        self.values = values
+
+    def visit_Identifier(self, node):
+        return self.values.get(node.name)
+
+class Inliner(NodeTransformer):
+    def __init__(self, exports: bool = False) -> None:
+        super().__init__()
+        self.exports = exports  # The top-level functions may be called by the other units (see linker.py)
+        self.analyzing = True
+        # Each scope: its id, and name -> the key of the variable (or the argument), name -> the key of the function
+        self.scopes: list[tuple[int, dict[str, Key], dict[str, Key]]] = []
+        self.owner: Key | None = None  # The function or the clone being visited, None for the main script
+        self.warp = False  # In a norefresh function
+        self.protected = 0  # In a nooptimize function, nothing is inlined
+        self.functions: dict[Key, FunctionDeclaration] = {}
+        # The keys of the names used in each function, at the declaration of it
+        self.resolutions: dict[Key, dict[str, tuple[Key | None, Key | None]]] = {}
+        self.calls: dict[Key | None, set[Key]] = {}
+        self.counts: dict[Key, int] = {}
+        self.exported: set[Key] = set()
+
+    def visit_Program(self, node):
+        self.analyzing = True
+        self.visit_scope(node)
+        self.analyzing = False
+        return self.visit_scope(node)
+
+    def visit_Block(self, node):
+        return self.visit_scope(node)
+
+    def visit_scope(self, node: Block, arguments: list[str] | None = None):
+        variables = {name: (id(node), name) for name in arguments or []}
+        self.scopes.append((id(node), variables, {}))
+        body: list[Statement] = []
+        changed = False
+        for statement in node.body:
+            if isinstance(statement, VariableDeclaration):
+                variables[statement.name] = (id(node), statement.name)
+            result = self.visit(statement)
+            if result is not None and result is not statement:
+                self.count_rewrite(result, statement)
+                changed = True
+                statement = result
+            if not self.analyzing and isinstance(statement, FunctionCall):
+                inlined = self.inline(statement)
+                if inlined is not None:
+                    self.rewrites += 1
+                    changed = True
+                    statement = inlined
+            body.append(statement)
+        self.scopes.pop()
+        if not changed:
+            return node
+        rebuilt = node.replace(body=body)
+        self.rebuilt[id(rebuilt)] = rebuilt
+        return rebuilt
+
+    def visit_FunctionDeclaration(self, node):
+        scope_id, _, functions = self.scopes[-1]
+        key = functions[node.name] = (scope_id, node.name)
+        if self.analyzing:
+            self.functions[key] = node
+            names = BodyNames(node.args)
+            names.visit(node.body)
+            self.resolutions[key] = {name: self.resolve(name) for name in names.names - set(node.args)}
+            if self.exports and len(self.scopes) == 1:
+                self.exported.add(key)
+        nooptimize = 'nooptimize' in node.attributes
+        owner, warp = self.owner, self.warp
+        self.owner, self.warp = key, 'norefresh' in node.attributes
+        self.protected += nooptimize
+        body = self.visit_scope(node.body, node.args)
+        self.protected -= nooptimize
+        self.owner, self.warp = owner, warp
+        if body is node.body:
+            return node
+        rebuilt = node.replace(body=body)
+        self.rebuilt[id(rebuilt)] = rebuilt
+        return rebuilt
+
+    def visit_Clone(self, node):
+        owner, warp = self.owner, self.warp
+        self.owner, self.warp = (id(node), 'clone'), False
+        result = self.generic_visit(node)
+        self.owner, self.warp = owner, warp
+        return result
+
+    def visit_FunctionCall(self, node):
+        if self.analyzing and not node.always_builtin:
+            callee = self.resolve(node.name)[1]
+            if callee is not None:
+                self.calls.setdefault(self.owner, set()).add(callee)
+                self.counts[callee] = self.counts.get(callee, 0) + 1
+        return self.generic_visit(node)
+
+    def resolve(self, name: str) -> tuple[Key | None, Key | None]:
+        # The keys of the variable and the function with the name, None if it's not declared in the program
+        variable = function = None
+        for _, variables, functions in reversed(self.scopes):
+            if variable is None and name in variables:
+                variable = variables[name]
+            if function is None and name in functions:
+                function = functions[name]
+        return variable, function
+
+    def recursive(self, function: Key) -> bool:
+        # The function may call itself (then its body is never done)
+        seen: set[Key] = set()
+        stack = list(self.calls.get(function, ()))
+        while stack:
+            callee = stack.pop()
+            if callee == function:
+                return True
+            if callee not in seen:
+                seen.add(callee)
+                stack += self.calls.get(callee, ())
+        return False
+
+    def inline(self, node: FunctionCall) -> Statement | None:
+        # The body replacing the call, None if the call is kept
+        if node.always_builtin or self.protected:
+            return None
+        key = self.resolve(node.name)[1]
+        if key is None:
+            return None
+        function = self.functions[key]
+        attributes = function.attributes
+        if 'noinline' in attributes or 'nooptimize' in attributes or len(node.args) != len(function.args):
+            return None
+        once = self.counts.get(key) == 1 and key not in self.exported
+        if 'inline' not in attributes and not once and count_blocks(function.body) > INLINE_BLOCKS:
+            return None
+        if self.recursive(key) or any(self.resolve(name) != resolution for name, resolution in self.resolutions[key].items()):
+            return None
+        names = BodyNames(function.args)
+        names.visit(function.body)
+        if names.declarations:
+            return None
+        literals = all(isinstance(arg, (Number, String)) for arg in node.args)
+        if names.yields and ('norefresh' in attributes and not self.warp or not literals and self.owner is not None):
+            # A norefresh function runs without waiting for the next frame, and the temporaries are shared
+            # by the threads running the same script (clones, or a function called by them)
+            return None
+
+        statements: list[Statement] = []
+        values: dict[str, Node] = {}
+        for name, arg in zip(function.args, node.args):
+            if isinstance(arg, (Number, String)):
+                values[name] = arg
+                continue
+            value = Identifier('')
+            value.name = generate_name(('inline', name, value))
+            values[name] = value
+            statements += [VariableDeclaration(value.name, True, False), FunctionCall('data_setvariableto', [value, arg])]
+        body = Substitution(values).visit(function.body)
+        return Block(statements + [function.body if body is None else body])
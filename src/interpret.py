@@ -7,10 +7,10 @@ License under the Apache License, version 2.0
 
 from dataclasses import dataclass
 from error import Error, raise_error
-from nodes import NodeVisitor, FunctionDeclaration
+from nodes import NodeVisitor, FunctionDeclaration, Block as BlockNode
 from records import Record
 from typing import Optional, Literal
-from utils import generate_id
+from utils import CLONE_VARIABLE, generate_id, reset_ids
 from values import *
 import json
 import math
@@ -25,7 +25,8 @@ PRO = 'procedure_'
 @dataclass
 class Input:
     name: str
-    type: Literal['normal', 'boolean', 'block', 'shadow'] = 'normal'
+    # "menu" is a field with a fixed value (written as a string, for example "sqrt" of operator_mathop)
+    type: Literal['normal', 'boolean', 'block', 'shadow', 'menu'] = 'normal'
     required: bool = True
 
 SCRATCH_EXTENSION = Literal['music', 'pen', 'videoSensing', 'text2speech', 'translate']
@@ -98,8 +99,10 @@ BLOCK_TYPES: dict[str, BlockType] = {
     'operator_equals': BlockType(inputs=('OPERAND1', 'OPERAND2')),
     'operator_gt': BlockType(inputs=('OPERAND1', 'OPERAND2')),
     'operator_join': BlockType(inputs=('STRING1', 'STRING2')),
+    'operator_length': BlockType(inputs=('STRING',)),
     'operator_letter_of': BlockType(inputs=('STRING', 'LETTER')),
     'operator_lt': BlockType(inputs=('OPERAND1', 'OPERAND2')),
+    'operator_mathop': BlockType(inputs=('NUM',), fields=(Input(name='OPERATOR', type='menu'),)),
     'operator_mod': BlockType(inputs=('NUM1', 'NUM2')),
     'operator_multiply': BlockType(inputs=('NUM1', 'NUM2')),
     'operator_not': BlockType(inputs=(Input(name='OPERAND', type='boolean', required=False),)),
@@ -122,18 +125,48 @@ BLOCK_TYPES: dict[str, BlockType] = {
 
 class Interpreter(NodeVisitor):
     def __init__(self) -> None:
-        self.record = Record()
+        self.imports = Record()  # The declarations of the linked units (see linker.py)
+        self.record = Record(self.imports)
         self.project: dict = json.load(open(os.path.join(folder, 'template.json'), encoding='utf-8'))
         self.blocks: dict[str, dict] = self.project['targets'][1]['blocks']
         self.variables: dict[str, list[str]] = self.project['targets'][0]['variables']
         self.lists: dict[str, list[str | list]] = self.project['targets'][0]['lists']
         self.extensions: list[SCRATCH_EXTENSION] = self.project['extensions']
         self.parent_function: Optional[FunctionDeclaration] = None
-        self.clone_variable = generate_id(('variable', 'clone', None))
+        reset_ids()
+        self.clone_variable = CLONE_VARIABLE
         self.project['targets'][1]['variables'][self.clone_variable] = [self.clone_variable, '[NOT ASSIGNED]']
+        self.visits = 0
+
+    def node_id(self, kind: str, node) -> str:
+        # A node may be shared by many parents, so each visit of it gets its own block
+        self.visits += 1
+        return generate_id((kind, node, self.visits))
+
+    def function_ids(self, record: Record, node: FunctionDeclaration) -> tuple[str, list[str]]:
+        # The id of a function declared in "record", and the ids of its arguments
+        function_id = generate_id((f'{PRO}name', record, node.name))
+        return function_id, [generate_id((f'{PRO}argument', function_id, arg_name)) for arg_name in node.args]
+
+    def variable_id(self, record: Record, name: str) -> str:
+        return generate_id(('variable', name, record))
+
+    def import_function(self, name: str, args: list[str]) -> tuple[str, list[str]]:
+        # Declare a function of a linked unit, and return its ids in this project
+        node = FunctionDeclaration(name, args, BlockNode(), [])
+        self.imports.declare_function(node)
+        return self.function_ids(self.imports, node)
+
+    def import_variable(self, name: str, is_const: bool) -> str:
+        self.imports.declare_variable('variable', name, is_const)
+        # A constant is already set in its unit
+        self.imports.variables[name].change_counts = 1
+        return self.variable_id(self.imports, name)
     
     def visit_Block(self, node) -> BlockList | None:
         if not node.body:
+            # An empty function body, the arguments are not used
+            self.parent_function = None
             return NoBlock(None)
         start_id = end_id = None
         event = None
@@ -144,8 +177,7 @@ class Interpreter(NodeVisitor):
         # If the parent function is not None, add the arguments to the record
         if self.parent_function is not None:
             function_node = self.parent_function
-            function_id = generate_id((f'{PRO}name', self.record.resolve_function(function_node.name), function_node.name))
-            arg_ids = [generate_id((f'{PRO}argument', function_id, arg_name)) for arg_name in function_node.args]
+            _, arg_ids = self.function_ids(self.record.resolve_function(function_node.name), function_node)
             for arg_name, arg_id in zip(function_node.args, arg_ids):
                 self.record.declare_variable('argument', arg_name, arg_id)
             self.parent_function = None
@@ -195,7 +227,7 @@ class Interpreter(NodeVisitor):
             return Variable(node.name, variable_record)
         else:  # argument
             # In Scratch, it's a function call
-            call_id = generate_id(('call', node))
+            call_id = self.node_id('call', node)
             self.blocks[call_id] = {
                 "opcode": "argument_reporter_string_number",
                 "next": None,
@@ -211,7 +243,7 @@ class Interpreter(NodeVisitor):
     
     def visit_VariableDeclaration(self, node) -> None:
         self.record.declare_variable('variable', node.name, node.is_const)
-        variable_id = generate_id(('variable', node.name, self.record))
+        variable_id = self.variable_id(self.record, node.name)
         if node.is_array:
             self.lists[variable_id] = [variable_id, []]
         else:
@@ -221,7 +253,7 @@ class Interpreter(NodeVisitor):
         return String(node.value)
 
     def visit_Program(self, node) -> Block:
-        event_id = generate_id(('event', node))
+        event_id = self.node_id('event', node)
         event = self.blocks[event_id] = {
             'opcode': 'event_whenflagclicked',
             'next': None,
@@ -255,10 +287,9 @@ class Interpreter(NodeVisitor):
 
     def _visit_custom_FunctionCall(self, node) -> Block:
         # Custom functions
-        call_id = generate_id(('call', node))
+        call_id = self.node_id('call', node)
         function_node = self.record.resolve_function(node.name).functions[node.name]
-        function_id = generate_id((f'{PRO}name', self.record.resolve_function(function_node.name), function_node.name))
-        arg_ids = [generate_id((f'{PRO}argument', function_id, arg_name)) for arg_name in function_node.args]
+        function_id, arg_ids = self.function_ids(self.record.resolve_function(function_node.name), function_node)
 
         # mutation
         mutation = {
@@ -298,18 +329,21 @@ class Interpreter(NodeVisitor):
 
     def _visit_builtin_FunctionCall(self, node) -> Block:
         # Built-in functions
-        call_id = generate_id(('call', node))
+        call_id = self.node_id('call', node)
         if node.name not in BLOCK_TYPES:
             # If the function cannot be found in the built-in functions, raise an error
             raise_error(Error('Interpret', f'Function {node.name} not declared'))
         bt = BLOCK_TYPES[node.name]  # block type
         # Parse the arguments and remove any NoBlock(s)
+        # (an empty substack keeps its position, so the next one is not moved into it, like "if (...) {} else {...}")
         args = [self.visit(arg) for arg in node.args]
-        args = [arg for arg in args if not isinstance(arg, NoBlock) and arg is not None]
-        if len(args) < bt.required_arguments_count:
+        positions = [(i, arg) for i, arg in enumerate(args) if not isinstance(arg, NoBlock) and arg is not None]
+        if len(positions) < bt.required_arguments_count:
             raise_error(Error('Interpret', f'Too few arguments in function {node.name}'))
         fields, inputs = {}, {}
-        for i, arg in enumerate(args):
+        for position, (i, arg) in enumerate(positions):
+            if i >= len(bt.fields + bt.inputs) or (bt.fields + bt.inputs)[i].type != 'block':
+                i = position
             if i < len(bt.fields):
                 if isinstance(arg, Variable) and arg.value[1] is not None:
                     # Then, by default assume that they are setting the variables
@@ -324,7 +358,10 @@ class Interpreter(NodeVisitor):
                         # Second change: raise an error
                         if variable.change_counts >= 2:
                             raise_error(Error('Interpret', 'Cannot set a constant variable'))
-                value = arg.get_as_field()
+                if bt.fields[i].type == 'menu' and isinstance(arg, String):
+                    value = [arg.value, None]
+                else:
+                    value = arg.get_as_field()
                 fields[bt.fields[i].name] = value
             elif i < len(bt.fields + bt.inputs):
                 # Set a block parent
@@ -361,11 +398,10 @@ class Interpreter(NodeVisitor):
     
     def visit_FunctionDeclaration(self, node) -> None:
         # ids
-        definition_id = generate_id((f'{PRO}definition', node))
-        prototype_id = generate_id((f'{PRO}prototype', node))
+        definition_id = self.node_id(f'{PRO}definition', node)
+        prototype_id = self.node_id(f'{PRO}prototype', node)
         self.record.declare_function(node)
-        function_id = generate_id((f'{PRO}name', self.record, node.name))
-        arg_ids = [generate_id((f'{PRO}argument', function_id, arg_name)) for arg_name in node.args]
+        function_id, arg_ids = self.function_ids(self.record, node)
         attributes = node.attributes
 
         # mutation
@@ -424,7 +460,7 @@ class Interpreter(NodeVisitor):
         return Custom(node.name)
     
     def visit_Clone(self, node) -> BlockList | None:
-        event_id = generate_id(('event', node))
+        event_id = self.node_id('event', node)
         event = self.blocks[event_id] = {
             'opcode': 'control_start_as_clone',
             'next': None,
@@ -0,0 +1,284 @@
+# *-* encoding: utf-8 *-*
+"""
+Copyright (c) Copyright 2024 Scratch-Language Developers
+https://github.com/IsBenben/Scratch-Language
+License under the Apache License, version 2.0
+"""
+
+# Separate compilation (--separate):
+# every included file with code is a unit, it is compiled on its own (with the declarations of the units it includes),
+# and the compiled unit is saved in the cache, keyed by its preprocessed tokens and the declarations it uses
+# Then the units are linked into the project of the main file, so a change of the main file never compiles a unit again
+# Differences from #include:
+#   the macros of the main file are not seen by a unit (a file only with macros is still unfolded),
+#   the paths in a unit are relative to the unit,
+#   the top-level statements of the units run before the ones of the main file
+
+from __future__ import annotations
+from dataclasses import asdict, dataclass
+from error import Error, raise_error
+from interpret import Interpreter, json_with_settings
+from nodes import Block
+from parse import Parser, Record as ParseRecord, program_cache
+from passes import pass_manager
+from preprocessing import include_cache, preprocess
+from typing import Callable, TextIO
+from utils import ID_REGEX, generate_id, get_args, linked_names, unit_ids
+import json
+import os
+import values
+
+folder = os.path.dirname(__file__)
+UNIT_CACHE_PATH = os.path.join(folder, '../.cache/units')
+UNIT_CACHE_VERSION = 1  # Change it when the format of Unit changes
+
+@dataclass
+class Unit:
+    # A compiled unit, only made of JSON values
+    digest: str
+    # The declarations at the top level:
+    # functions: name -> [arguments, function id, argument ids]
+    # variables: name -> [variable id, is constant, is array]
+    functions: dict[str, list]
+    variables: dict[str, list]
+    # The ids used for the declarations of the included units:
+    # name -> [function id, argument ids], and name -> variable id
+    imported_functions: dict[str, list]
+    imported_variables: dict[str, str]
+    blocks: dict[str, dict]
+    stage_variables: dict[str, list]
+    stage_lists: dict[str, list]
+    extensions: list[str]
+    script: list[str] | None  # The first and the last block of the top-level statements
+    clone_variables: list[str]  # The ids of the clone variable (see nodes.Clone)
+
+    @property
+    def signature(self) -> list:
+        # What a unit including this one knows about it
+        return [sorted((name, function[0]) for name, function in self.functions.items()),
+                sorted((name, variable[1], variable[2]) for name, variable in self.variables.items())]
+
+def clone_variables(interpreter: Interpreter) -> list[str]:
+    return [interpreter.clone_variable, values.Variable(interpreter.clone_variable, None).id]
+
+def make_unit(digest: str, interpreter: Interpreter) -> Unit:
+    blocks = dict(interpreter.blocks)
+    # The top-level statements are taken out of the "when flag clicked" script
+    event_id = next(block_id for block_id, block in blocks.items() if block['opcode'] == 'event_whenflagclicked')
+    first = blocks.pop(event_id)['next']
+    script = None
+    if first is not None:
+        blocks[first] = dict(blocks[first], parent=None)
+        last = first
+        while blocks[last]['next'] is not None:
+            last = blocks[last]['next']
+        script = [first, last]
+
+    record = interpreter.record
+    functions = {}
+    for name, node in record.functions.items():
+        function_id, arg_ids = interpreter.function_ids(record, node)
+        functions[name] = [node.args, function_id, arg_ids]
+    variables = {}
+    for name, variable in record.variables.items():
+        variable_id = interpreter.variable_id(record, name)
+        variables[name] = [variable_id, variable.more, variable_id in interpreter.lists]
+    imports = interpreter.imports
+    imported_functions = {name: list(interpreter.function_ids(imports, node)) for name, node in imports.functions.items()}
+    imported_variables = {name: interpreter.variable_id(imports, name) for name in imports.variables}
+    return Unit(digest, functions, variables, imported_functions, imported_variables,
+                blocks, interpreter.variables, interpreter.lists, list(interpreter.extensions),
+                script, clone_variables(interpreter))
+
+def rename_block(block: dict, rename: Callable[[str], str], clone_variables: list[str]) -> dict:
+    # Rename the ids in the places where a block has ids, and never in a string of the code
+    # (a string can be anything, like "$10000000000")
+    # The only strings that are names are the names of the clones, set to or compared with the clone variable
+    # (see nodes.Clone), and the code can't use the clone variable
+    clone_variable = clone_variables[1]
+    uses_clone = (any(value[1] == clone_variable for value in block['fields'].values())
+                  or any(isinstance(item, list) and item[0] == 12 and item[2] == clone_variable
+                         for value in block['inputs'].values() for item in value))
+
+    def rename_value(value):
+        if isinstance(value, str):
+            return rename(value)  # A block
+        if value[0] in (12, 13):
+            return [value[0], rename(value[1]), rename(value[2])]  # A variable or a list
+        if uses_clone and isinstance(value[1], str) and ID_REGEX.fullmatch(value[1]):
+            return [value[0], rename(value[1])]
+        return value
+
+    renamed = dict(block)
+    for key in ('next', 'parent'):
+        if block[key] is not None:
+            renamed[key] = rename(block[key])
+    # The custom blocks use the argument ids as the names of their inputs
+    renamed['inputs'] = {(rename(name) if ID_REGEX.fullmatch(name) else name):
+                         [item if item is None or isinstance(item, int) else rename_value(item) for item in value]
+                         for name, value in block['inputs'].items()}
+    # A field is [value, id], and the value is an id too (of a variable, or of an argument for an argument reporter),
+    # unless the id is None (like a menu)
+    is_argument = block['opcode'].startswith('argument_reporter_')
+    renamed['fields'] = {name: [rename(value[0]), None if value[1] is None else rename(value[1])]
+                         if value[1] is not None or is_argument else value
+                         for name, value in block['fields'].items()}
+    if 'mutation' in block:
+        mutation = renamed['mutation'] = dict(block['mutation'])
+        function_id, _, args = mutation['proccode'].partition(' ')
+        mutation['proccode'] = f'{rename(function_id)} {args}' if args else rename(function_id)
+        for key in ('argumentids', 'argumentnames'):
+            if key in mutation:
+                mutation[key] = json_with_settings(json.dumps, [rename(arg_id) for arg_id in json.loads(mutation[key])])
+    return renamed
+
+class UnitCache:
+    # Compiled units, saved in "path" (unless it is None) as JSON
+    def __init__(self, path: str | None = UNIT_CACHE_PATH):
+        self.path = path
+
+    def load(self, digest: str) -> Unit | None:
+        if self.path is None:
+            return None
+        try:
+            with open(os.path.join(self.path, digest + '.json'), 'r', encoding='utf-8') as f:
+                version, data = json.load(f)
+            unit = Unit(**data)
+        except (OSError, ValueError, TypeError):
+            return None
+        if version != UNIT_CACHE_VERSION or unit.digest != digest:
+            return None
+        return unit
+
+    def save(self, unit: Unit) -> None:
+        if self.path is None:
+            return None
+        file = os.path.join(self.path, unit.digest + '.json')
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            # Written to another file first, so a reader never sees a half-written file
+            with open(f'{file}.{os.getpid()}', 'w', encoding='utf-8') as f:
+                json.dump([UNIT_CACHE_VERSION, asdict(unit)], f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(f'{file}.{os.getpid()}', file)
+        except OSError:
+            pass
+
+unit_cache = UnitCache()
+
+class Linker:
+    def __init__(self, interpreter: Interpreter):
+        self.interpreter = interpreter  # The project of the main file
+        self.imports = ParseRecord([])  # The declarations of the linked units, for the parser
+        self.units: dict[str, tuple[Unit, list[str]]] = {}  # path -> (unit, paths of the units it includes)
+        self.compiling: list[str] = []
+        self.linked: set[str] = set()
+        self.scripts: list[list[str]] = []
+
+    def build(self, code: str | TextIO) -> None:
+        # Compile the main file, and link the units included by it
+        paths: list[str] = []
+        tokens = list(preprocess(code, units=paths))
+        for path in paths:
+            self.link(path)
+        self.interpreter.visit(Parser().parse(tokens, self.imports))
+
+        # The top-level statements of the units go before the ones of the main file
+        blocks = self.interpreter.blocks
+        event_id = next(block_id for block_id, block in blocks.items() if block['opcode'] == 'event_whenflagclicked')
+        first = blocks[event_id]['next']
+        previous = event_id
+        for start, end in self.scripts:
+            blocks[previous]['next'] = start
+            blocks[start]['parent'] = previous
+            previous = end
+        blocks[previous]['next'] = first
+        if first is not None:
+            blocks[first]['parent'] = previous
+
+    def link(self, path: str) -> None:
+        if path in self.linked:
+            return None
+        unit, paths = self.compile(path)
+        for included in paths:
+            self.link(included)
+        self.linked.add(path)
+
+        interpreter = self.interpreter
+        rename = self.declare(interpreter, self.imports, unit)
+        for name, (function_id, arg_ids) in unit.imported_functions.items():
+            new_function_id, new_arg_ids = interpreter.function_ids(interpreter.imports, interpreter.imports.functions[name])
+            rename[function_id] = new_function_id
+            rename.update(zip(arg_ids, new_arg_ids))
+        for name, variable_id in unit.imported_variables.items():
+            rename[variable_id] = interpreter.variable_id(interpreter.imports, name)
+        rename.update(zip(unit.clone_variables, clone_variables(interpreter)))
+
+        # The other ids are only used in the unit, they are made again, so they are different from the ids of the project
+        def rename_id(old: str) -> str:
+            if old not in rename:
+                # A temporary name (like the name of a clone) is still a name
+                generate = linked_names.generate if old.startswith('$$') else generate_id
+                rename[old] = generate(('link', unit.digest, old))
+            return rename[old]
+        for block_id, block in unit.blocks.items():
+            interpreter.blocks[rename_id(block_id)] = rename_block(block, rename_id, unit.clone_variables)
+        for variable_id, (name, value) in unit.stage_variables.items():
+            interpreter.variables[rename_id(variable_id)] = [rename_id(name), value]
+        for list_id, (name, items) in unit.stage_lists.items():
+            interpreter.lists[rename_id(list_id)] = [rename_id(name), items]
+        script = None if unit.script is None else [rename_id(block_id) for block_id in unit.script]
+        for extension in unit.extensions:
+            if extension not in interpreter.extensions:
+                interpreter.extensions.append(extension)  # type: ignore[arg-type]
+        if script is not None:
+            self.scripts.append(script)
+
+    def declare(self, interpreter: Interpreter, imports: ParseRecord, unit: Unit) -> dict[str, str]:
+        # Declare the top-level declarations of "unit" in "interpreter" and "imports",
+        # and return the new ids of them
+        rename: dict[str, str] = {}
+        for name, (args, function_id, arg_ids) in unit.functions.items():
+            new_function_id, new_arg_ids = interpreter.import_function(name, args)
+            imports.function_declaration(name, args, Block(), [])
+            rename[function_id] = new_function_id
+            rename.update(zip(arg_ids, new_arg_ids))
+        for name, (variable_id, is_const, is_array) in unit.variables.items():
+            rename[variable_id] = interpreter.import_variable(name, is_const)
+            imports.variable_declaration(name, is_const, is_array)
+        return rename
+
+    def compile(self, path: str) -> tuple[Unit, list[str]]:
+        if path in self.units:
+            return self.units[path]
+        if path in self.compiling:
+            raise_error(Error('Link', f'File "{path}" includes itself'))
+        self.compiling.append(path)
+        paths: list[str] = []
+        tokens = list(preprocess(include_cache.get(path).code, os.path.dirname(path), paths))
+        for included_path in paths:
+            self.compile(included_path)
+        included = self.closure(paths)
+        passes = '' if get_args().nooptimize else pass_manager.key
+        digest = program_cache.digest(tokens, passes, json.dumps([self.units[item][0].signature for item in included]))
+        unit = unit_cache.load(digest)
+        if unit is None:
+            with unit_ids():
+                interpreter = Interpreter()
+                imports = ParseRecord([])
+                for item in included:
+                    self.declare(interpreter, imports, self.units[item][0])
+                interpreter.visit(Parser().parse(tokens, imports))
+                unit = make_unit(digest, interpreter)
+            unit_cache.save(unit)
+        self.compiling.pop()
+        self.units[path] = (unit, paths)
+        return self.units[path]
+
+    def closure(self, paths: list[str]) -> list[str]:
+        # "paths" and the units included by them (directly or not), the included ones first
+        result: list[str] = []
+        for path in paths:
+            for item in self.closure(self.units[path][1]) + [path]:
+                if item not in result:
+                    result.append(item)
+        return result
@@ -0,0 +1,314 @@
+# *-* encoding: utf-8 *-*
+"""
+Copyright (c) Copyright 2024 Scratch-Language Developers
+https://github.com/IsBenben/Scratch-Language
+License under the Apache License, version 2.0
+"""
+
+# The loop optimizations (on the syntax tree):
+#   unrolling of control_repeat with a known count, chosen by the number of the blocks (a cost model):
+#   a small loop is unrolled fully, a bigger one partially (the body is repeated "factor" times,
+#   and a remainder loop runs the other iterations), so fewer loop steps (and frames, out of a warp function) run
+#   (a loop with an unknown count is not unrolled: the count, the division and the remainder loop
+#   cost more blocks than they save in the short loops of the arrays)
+#   loop-invariant code motion: the reporters in a control_repeat_until (the condition and the body)
+#   which give the same value in every iteration are computed once before the loop, into temporaries
+#   (only in the main script: a function or a clone may run in many threads at the same time, sharing the temporaries)
+#   a loop counting a variable by 1 between two known numbers in the main script becomes a counted loop first
+
+from cast import js_round, to_number
+from nodes import *
+from optimize import LIST_WRITE_FUNCTIONS, WRITE_FUNCTIONS, literal_value
+from utils import generate_name
+import math
+
+FULL_UNROLL_BLOCKS = 64  # The most blocks of a fully unrolled loop
+UNROLL_BLOCKS = 16  # The most blocks of the body of a partially unrolled loop
+# The reporters which only depend on their arguments (and the lists), so they can be hoisted out of a loop
+# (not the booleans, a variable keeps a boolean as a string)
+INVARIANT_REPORTERS = {'operator_add', 'operator_subtract', 'operator_multiply', 'operator_divide', 'operator_mod',
+                       'operator_join', 'operator_letter_of', 'operator_length', 'operator_round', 'operator_mathop',
+                       'data_itemoflist', 'data_lengthoflist', 'data_itemnumoflist'}
+# The reporters which always report a number (never the text "random")
+NUMBER_REPORTERS = {'operator_add', 'operator_subtract', 'operator_multiply', 'operator_divide', 'operator_mod',
+                    'operator_length', 'operator_round', 'operator_mathop', 'data_lengthoflist', 'data_itemnumoflist'}
+
+def random_item(node: FunctionCall) -> bool:
+    # An item of a list whose index may be "random" (or "any"), then each time it is another item
+    if node.name != 'data_itemoflist' or len(node.args) != 2:
+        return False
+    index = node.args[1]
+    if isinstance(index, Number):
+        return False
+    if isinstance(index, String):
+        return index.value in ('random', 'any')
+    return not (isinstance(index, FunctionCall) and index.name in NUMBER_REPORTERS)
+
+def count_blocks(node: Node) -> int:
+    # The number of the blocks emitted for "node" (about)
+    if isinstance(node, FunctionCall):
+        return 1 + sum(count_blocks(arg) for arg in node.args)
+    if type(node) is Block:
+        return sum(count_blocks(statement) for statement in node.body)
+    return 0
+
+def temporary(prefix: str) -> Identifier:
+    result = Identifier('')
+    result.name = generate_name(('loop', prefix, result))
+    return result
+
+class LoopWrites(NodeVisitor):
+    # The variables and lists set (and declared) in a tree, and the things in it which stop the loop optimizations
+    def __init__(self, functions: set[str]) -> None:
+        self.functions = functions
+        self.names: set[str] = set()
+        self.calls = False  # A custom function is called, it may set anything
+        self.declarations = False  # A function or a clone is declared (it cannot be copied)
+
+    def visit_FunctionCall(self, node):
+        if node.name in WRITE_FUNCTIONS + LIST_WRITE_FUNCTIONS and node.args and isinstance(node.args[0], Identifier):
+            self.names.add(node.args[0].name)
+        if not node.always_builtin and node.name in self.functions:
+            self.calls = True
+        self.generic_visit(node)
+
+    def visit_VariableDeclaration(self, node):
+        self.names.add(node.name)
+
+    def visit_FunctionDeclaration(self, node):
+        self.declarations = True
+
+    def visit_Clone(self, node):
+        self.declarations = True
+
+class Writers(NodeVisitor):
+    # The scripts setting each variable and list: the id of the clone or the function, or None for the main script
+    def __init__(self) -> None:
+        self.writers: dict[str, set[int | None]] = {}
+        self.functions: set[str] = set()
+        self.owner: int | None = None
+
+    def visit_FunctionCall(self, node):
+        if node.name in WRITE_FUNCTIONS + LIST_WRITE_FUNCTIONS and node.args and isinstance(node.args[0], Identifier):
+            self.writers.setdefault(node.args[0].name, set()).add(self.owner)
+        self.generic_visit(node)
+
+    def visit_FunctionDeclaration(self, node):
+        self.functions.add(node.name)
+        self.visit_owner(node)
+
+    def visit_Clone(self, node):
+        self.visit_owner(node)
+
+    def visit_owner(self, node: Node) -> None:
+        owner = self.owner
+        self.owner = id(node)
+        self.generic_visit(node)
+        self.owner = owner
+
+class LoopOptimizer(NodeTransformer):
+    def __init__(self, exports: bool = False) -> None:
+        super().__init__()
+        self.exports = exports  # The top-level variables may be set by the other units (see linker.py)
+        self.writers: dict[str, set[int | None]] = {}
+        self.functions: set[str] = set()
+        self.declared: set[str] = set()  # The variables declared in the program, not at the top level if "exports"
+        self.owner: Node | None = None  # The function or the clone being visited
+        # The variables with a known number at this point of the main script (set by the statements before)
+        self.known: dict[str, float] = {}
+
+    def visit_Program(self, node):
+        writers = Writers()
+        writers.visit(node)
+        self.writers = writers.writers
+        self.functions = writers.functions
+        self.known = {}
+        return self.visit_scope(node)
+
+    def visit_Block(self, node):
+        return self.visit_scope(node)
+
+    def visit_scope(self, node: Block):
+        body: list[Statement] = []
+        changed = False
+        declarations: list[str] = []
+        for statement in node.body:
+            original = statement
+            if isinstance(statement, VariableDeclaration):
+                declarations.append(statement.name)
+                if not (self.exports and type(node) is Program):
+                    self.declared.add(statement.name)
+            result = self.visit(statement)
+            if result is not None and result is not statement:
+                self.count_rewrite(result, statement)
+                changed = True
+                statement = result
+            if isinstance(statement, FunctionCall) and statement.name == 'control_repeat_until' and statement.always_builtin:
+                counted = self.count_loop(statement)
+                if counted is not None:
+                    self.rewrites += 1
+                    changed = True
+                    statement = self.unroll(counted)
+                else:
+                    hoisted = self.hoist(statement)
+                    if hoisted:
+                        changed = True
+                        body += hoisted[:-1]
+                        statement = hoisted[-1]
+            if type(original) is not Block:
+                # (a block is visited in order, then its statements are already known,
+                # but a loop unrolled into a block is not, so the variables it sets are forgotten)
+                self.forget(original)
+                if isinstance(statement, FunctionCall) and statement.name == 'data_setvariableto' and len(statement.args) == 2 \
+                        and type(statement.args[0]) is Identifier and isinstance(statement.args[1], Number):
+                    self.known[statement.args[0].name] = float(statement.args[1].value)
+            body.append(statement)
+        for name in declarations:
+            # Out of the scope, the name is another variable
+            self.known.pop(name, None)
+        if not changed:
+            return node
+        rebuilt = node.replace(body=body)
+        self.rebuilt[id(rebuilt)] = rebuilt
+        return rebuilt
+
+    def forget(self, statement: Statement) -> None:
+        # The variables set (or declared) by "statement" are not known anymore
+        writes = LoopWrites(self.functions)
+        writes.visit(statement)
+        if writes.calls:
+            self.known.clear()
+        for name in writes.names:
+            self.known.pop(name, None)
+
+    def visit_FunctionDeclaration(self, node):
+        if 'nooptimize' in node.attributes:
+            return None
+        return self.visit_owner(node)
+
+    def visit_Clone(self, node):
+        return self.visit_owner(node)
+
+    def visit_owner(self, node: Node):
+        owner, known = self.owner, self.known
+        self.owner, self.known = node, {}
+        result = self.generic_visit(node)
+        self.owner, self.known = owner, known
+        return result
+
+    def visit_FunctionCall(self, node):
+        # The blocks in a control block (like a loop body) do not run in order with the statements around it
+        known = self.known
+        self.known = {}
+        node = self.generic_visit(node)
+        self.known = known
+        if node.name == 'control_repeat' and node.always_builtin and len(node.args) == 2:
+            return self.unroll(node)
+        return node
+
+    def count_loop(self, loop: FunctionCall) -> FunctionCall | None:
+        # A loop counting a variable by 1 from a known number to a number, like the loop of a range (1 -> 10),
+        # or "while (i < 10)" after "i = 0", becomes a control_repeat (then it may be unrolled)
+        condition, body = loop.args
+        if self.owner is not None or type(body) is not Block:
+            return None
+        comparison, negated = condition, False
+        if isinstance(condition, FunctionCall) and condition.name == 'operator_not' and len(condition.args) == 1:
+            comparison, negated = condition.args[0], True
+        if not (isinstance(comparison, FunctionCall) and comparison.always_builtin and len(comparison.args) == 2
+                and comparison.name == ('operator_lt' if negated else 'operator_gt')):
+            return None
+        variable, limit = comparison.args
+        if type(variable) is not Identifier or not isinstance(limit, Number) or variable.name not in self.known:
+            return None
+        start, end = self.known[variable.name], float(limit.value)
+        if not (start.is_integer() and end.is_integer() and abs(start) < 2 ** 31 and abs(end) < 2 ** 31):
+            return None
+        # The variable is only changed by "change by 1" once in each iteration, and not by the other scripts
+        writes = LoopWrites(self.functions)
+        writes.visit(loop)
+        changes = [statement for statement in body.body if isinstance(statement, FunctionCall)
+                   and statement.name in WRITE_FUNCTIONS and statement.args and isinstance(statement.args[0], Identifier)
+                   and statement.args[0].name == variable.name]
+        if writes.calls or writes.declarations or self.writers.get(variable.name, set()) - {None} or len(changes) != 1 \
+                or changes[0].name != 'data_changevariableby' or not (isinstance(changes[0].args[1], Number)
+                                                                      and changes[0].args[1].value == 1):
+            return None
+        others = LoopWrites(self.functions)
+        others.visit(body.replace(body=[statement for statement in body.body if statement is not changes[0]]))
+        if variable.name in others.names:
+            return None
+        # until (i > end): i is start, start + 1, ..., end; while (i < end): start, ..., end - 1
+        count = max(0, int(end - start) + (0 if negated else 1))
+        return FunctionCall('control_repeat', [Number(count), body])
+
+    def unroll(self, node: FunctionCall) -> Statement:
+        times, body = node.args
+        value = literal_value(times)
+        if value is None or type(body) is not Block:
+            return node
+        count = js_round(to_number(value))
+        if not count >= 1:
+            return Block()
+        writes = LoopWrites(self.functions)
+        writes.visit(body)
+        size = count_blocks(body)
+        if writes.declarations or not size or math.isinf(count):
+            return node
+        if count * size <= FULL_UNROLL_BLOCKS:
+            # The nodes are never changed, so the body is shared instead of copied
+            return Block([body] * int(count))
+        # The biggest factor in the budget, then the body of the new loop is too big to be unrolled again
+        factor = UNROLL_BLOCKS // size
+        if factor < 2:
+            return node
+        # repeat (count // factor) {body * factor}, then the remainder loop (unrolled fully later)
+        loops: list[Statement] = [FunctionCall('control_repeat', [Number(int(count // factor)), Block([body] * factor)])]
+        if count % factor:
+            loops.append(FunctionCall('control_repeat', [Number(int(count % factor)), body]))
+        return Block(loops)
+
+    def hoist(self, loop: FunctionCall) -> list[Statement]:
+        # The declarations and the settings of the temporaries, and the new loop (nothing if nothing is hoisted)
+        writes = LoopWrites(self.functions)
+        writes.visit(loop)
+        if self.owner is not None or writes.calls or writes.declarations:
+            return []
+        temporaries: dict[str, Identifier] = {}  # The dump of the hoisted reporter -> the temporary
+        statements: list[Statement] = []
+
+        def invariant(node: Node) -> bool:
+            if isinstance(node, (Number, String)):
+                return True
+            if isinstance(node, Identifier):
+                # Not set in the loop, and not by the other scripts (they may run when the loop waits for the next frame)
+                return node.name not in writes.names and node.name in self.declared \
+                    and self.writers.get(node.name, set()) <= {None}
+            return isinstance(node, FunctionCall) and node.name in INVARIANT_REPORTERS and not random_item(node) \
+                and (node.always_builtin or node.name not in self.functions) and all(invariant(arg) for arg in node.args)
+
+        def replace(node: Statement) -> Statement:
+            if not isinstance(node, FunctionCall):
+                if type(node) is Block:
+                    return node.replace(body=[replace(statement) for statement in node.body])
+                return node
+            args = list(node.args)
+            start = 1 if node.name in WRITE_FUNCTIONS + LIST_WRITE_FUNCTIONS else 0
+            for index in range(start, len(args)):
+                arg = args[index]
+                if isinstance(arg, FunctionCall) and invariant(arg):
+                    key = arg.dump()
+                    if key not in temporaries:
+                        temporaries[key] = temporary('invariant')
+                        statements.append(VariableDeclaration(temporaries[key].name, False, False))
+                        statements.append(FunctionCall('data_setvariableto', [temporaries[key], arg]))
+                    args[index] = temporaries[key]
+                else:
+                    args[index] = replace(arg)
+            return node.replace(args=args)
+
+        result = replace(loop)
+        if not statements:
+            return []
+        self.rewrites += len(temporaries)
+        return statements + [result]
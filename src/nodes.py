@@ -6,50 +6,55 @@ License under the Apache License, version 2.0
 """
 
 from __future__ import annotations
-from utils import generate_id
-import copy
-from typing import TypeVar
+from utils import CLONE_VARIABLE, generate_name
+from typing import Callable, ClassVar, TypeVar
 
 INDENT = '  '
+T_NODE = TypeVar('T_NODE', bound='Node')
 
 class Node:
+    # Compact nodes: the fields are slots, and each class lists them
+    # "fields" are the arguments of __init__ (in order, used by dump and replace),
+    # "children" are the fields with nodes (or lists of nodes), walked by NodeVisitor.generic_visit
+    __slots__ = ()
+    fields: ClassVar[tuple[str, ...]] = ()
+    children: ClassVar[tuple[str, ...]] = ()
+
     def node_type_name(self) -> str:
         return type(self).__name__
     
     def dump(self, indent=''):
-        return ''
+        return Dumper().dump(self, indent)
 
     @staticmethod
     def dump_list(list, indent='') -> str:
-        if not list:
-            return indent + '[*No elements*]\n'
-        result = indent + '[\n'
-        for item in list:
-            if isinstance(item, Node):
-                result += item.dump(indent + INDENT)
-            else:
-                result += indent + INDENT + item + '\n'
-        result += indent + ']\n'
-        return result
+        dumper = Dumper()
+        dumper.visit_list(list, indent)
+        return ''.join(dumper.parts)
     
-    # Support for "copy" module
-    @property
-    def _copy_keys(self):
-        return {k: v for k, v in self.__dict__.items() if not k.startswith('_')}
-
-    def __copy__(self):
-        return type(self)(**self._copy_keys)
-
-    def __deepcopy__(self, memo):
-        return type(self)(**copy.deepcopy(self._copy_keys, memo))
+    # A node is not changed after it is built, so a subtree can be shared by many parents
+    # (for example an unrolled loop body), and it is never copied
+    # To change a node, build a new one with replace(), the children not changed are shared
+    def replace(self: T_NODE, **changes) -> T_NODE:
+        values = {field: getattr(self, field) for field in self.fields}
+        values.update(changes)
+        return type(self)(**values)
+
+    def __reduce__(self):
+        # Pickled as the class and the fields only (the other slots are built again by __init__)
+        return type(self), tuple(getattr(self, field) for field in self.fields)
 
 class Statement(Node):
-    def dump(self, indent=''):
-        return indent + 'Statement {N/A}\n'
+    __slots__ = ()
+
 
 STATEMENT_TYPE = None | list[Statement] | Statement
 
 class Block(Statement):
+    __slots__ = ('body',)
+    fields = ('body',)
+    children: ClassVar[tuple[str, ...]] = ('body',)
+
     def __init__(self, body: STATEMENT_TYPE = None):
         if isinstance(body, Block):
             body = body.body
@@ -59,40 +64,34 @@ class Block(Statement):
             body = [body]
         self.body: list[Statement] = body
     
-    def dump(self, indent=''):
-        result = indent + 'Block {\n'
-        result += Node.dump_list(self.body, indent + INDENT)
-        result += indent + '}\n'
-        return result
 
 class Program(Block):
-    def dump(self, indent=''):
-        result = indent + 'Program {\n'
-        result += Node.dump_list(self.body, indent + INDENT)
-        result += indent + '}\n'
-        return result
+    __slots__ = ()
+
 
 class Expression(Statement):
-    def dump(self, indent=''):
-        return indent + 'Expression {N/A}\n'
+    __slots__ = ()
+
 
 class Factor(Expression):
-    def dump(self, indent=''):
-        return indent + 'Factor {N/A}\n'
+    __slots__ = ()
+
 
 class Number(Factor):
+    __slots__ = ('value',)
+    fields = ('value',)
+
     def __init__(self, value: float):
         self.value: float = value
     
-    def dump(self, indent=''): 
-        return indent + 'Number ' + str(self.value) + '\n'
 
 class String(Factor):
+    __slots__ = ('value',)
+    fields = ('value',)
+
     def __init__(self, value: str):
         self.value: str = value
     
-    def dump(self, indent=''): 
-        return indent + 'String ' + str(self.value) + '\n'
 
 # Boolean implement with FunctionCall
 
@@ -124,27 +123,28 @@ def value_of_boolean(node: Node) -> bool:
     return not value_of_boolean(node.args[0])
 
 class Identifier(Factor):
+    __slots__ = ('name',)
+    fields = ('name',)
+
     def __init__(self, name: str):
         self.name: str = name
     
-    def dump(self, indent=''):
-        return indent + 'Identifier ' + self.name + '\n'
 
 class FunctionCall(Factor):
+    __slots__ = ('name', 'args', 'always_builtin')
+    fields = ('name', 'args', 'always_builtin')
+    children = ('args',)
+
     def __init__(self, name: str, args: list[Statement], always_builtin: bool = True):
         self.name: str = name
         self.args: list[Statement] = args
         self.always_builtin: bool = always_builtin
     
-    def dump(self, indent=''):
-        result = indent + 'FunctionCall {\n'
-        result += indent + INDENT + '[str] ' + self.name + '\n'
-        result += Node.dump_list(self.args, indent + INDENT)
-        result += indent + INDENT + '[bool] ' + str(self.always_builtin) + '\n'
-        result += indent + '}\n'
-        return result
 
 class VariableDeclaration(Statement):
+    __slots__ = ('name', 'is_const', 'is_array')
+    fields = ('name', 'is_const', 'is_array')
+
     def __init__(self, name: str, is_const: bool, is_array: bool):
         self.name: str = name
         if is_const and is_array:
@@ -152,87 +152,109 @@ class VariableDeclaration(Statement):
         self.is_const: bool = is_const
         self.is_array: bool = is_array
     
-    def dump(self, indent=''):
-        result = indent + 'VariableDeclaration {\n'
-        result += indent + INDENT + '[str] ' + self.name + '\n'
-        result += indent + INDENT + '[bool] ' + str(self.is_const) + '\n'
-        result += indent + INDENT + '[bool] ' + str(self.is_array) + '\n'
-        result += indent + '}\n'
-        return result
 
 class FunctionDeclaration(Statement):
+    __slots__ = ('name', 'args', 'body', 'attributes')
+    fields = ('name', 'args', 'body', 'attributes')
+    children = ('body',)
+
     def __init__(self, name: str, args: list[str], body: Block, attributes: list[str]):
         self.name: str = name
         self.args: list[str] = args
         self.body: Block = body
         self.attributes: list[str] = attributes
     
-    def dump(self, indent=''):
-        result = indent + 'FunctionDeclaration {\n'
-        result += indent + INDENT + '[str] ' + self.name + '\n'
-        result += self.dump_list(self.args, indent + INDENT)
-        result += self.body.dump(indent + INDENT)
-        result += self.dump_list(self.attributes, indent + INDENT)
-        result += indent + '}\n'
-        return result
 
 class Custom(Block):
+    __slots__ = ('name',)
+    fields = ('name',)
+    children: ClassVar[tuple[str, ...]] = ()
+
     def __init__(self, name: str):
         self.name: str = name
     
-    def dump(self, indent=''):
-        return indent + 'Custom ' + self.name + '\n'
 
 class Clone(Statement):
-    def __init__(self, clone: Block):
+    __slots__ = ('clone', 'name', '_clone_comparison', '_parent')
+    fields = ('clone',)
+    children = ('clone',)
+
+    def __init__(self, clone: Block, name: str | None = None):
         self.clone = clone
+        self.name = generate_name(('clone', self)) if name is None else name
         self._clone_comparison = FunctionCall('control_if', [
             FunctionCall('operator_equals', [
-                Identifier(generate_id(('variable', 'clone', None))),
-                String(generate_id(('clone', self))),
+                Identifier(CLONE_VARIABLE),
+                String(self.name),
             ]),
             clone,
         ])
         self._parent = Block([
             FunctionCall('data_setvariableto', [
-                Identifier(generate_id(('variable', 'clone', None))),
-                String(generate_id(('clone', self)))
+                Identifier(CLONE_VARIABLE),
+                String(self.name)
             ]),
             FunctionCall('control_create_clone_of', [
                 FunctionCall('control_create_clone_of_menu', [Custom('_myself_')])
             ],
         )])
-    
-    def dump(self, indent=''):
-        result = indent + 'Clone {\n'
-        result += self.clone.dump(indent + INDENT)
-        result += indent + '}\n'
-        return result
+
+    def __reduce__(self):
+        # The name is kept, so a cached program is the same as a parsed one (see ProgramCache)
+        return type(self), (self.clone, self.name)
+
 
 class ListIdentifier(Identifier):
+    __slots__ = ()
+
     def __init__(self, name: str | Identifier):
         self.name: str = name if isinstance(name, str) else name.name
 
 class Macro(Statement):
+    __slots__ = ('name', 'args', 'body')
+    fields = ('name', 'args', 'body')
+    children = ('body',)
+
     def __init__(self, name: str, args: list[str], body: STATEMENT_TYPE):
         self.name: str = name
         self.args: list[str] = args
         self.body: None | list[Statement] | Statement = body
 
 class NodeVisitor:
+    # visit() looks up the method of each node type once, then keeps it in "dispatch"
+    # (every subclass has its own table, because it may define other methods)
+    dispatch: ClassVar[dict[type, Callable]] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.dispatch = {}
+
     def visit(self, node: Node):
-        return getattr(self, 'visit_' + type(node).__name__, self.visit_error)(node)
+        cls = type(self)
+        try:
+            method = cls.dispatch[type(node)]
+        except KeyError:
+            method = cls.dispatch[type(node)] = getattr(cls, 'visit_' + type(node).__name__, cls.visit_error)
+        return method(self, node)
+
+    def generic_visit(self, node: Node):
+        # Visit all the children of the node
+        for field in node.children:
+            child = getattr(node, field)
+            if isinstance(child, list):
+                for item in child:
+                    self.visit(item)
+            elif child is not None:
+                self.visit(child)
     
     def visit_Statement(self, node: Statement):
         pass
 
     def visit_Block(self, node: Block):
-        for statement in node.body:
-            self.visit(statement)
+        self.generic_visit(node)
 
     def visit_Program(self, node: Program):
-        for statement in node.body:
-            self.visit(statement)
+        self.generic_visit(node)
 
     def visit_Expression(self, node: Expression):
         pass
@@ -250,14 +272,13 @@ class NodeVisitor:
         pass
     
     def visit_FunctionCall(self, node: FunctionCall):
-        for arg in node.args:
-            self.visit(arg)
+        self.generic_visit(node)
 
     def visit_VariableDeclaration(self, node: VariableDeclaration):
         pass
 
     def visit_FunctionDeclaration(self, node: FunctionDeclaration):
-        self.visit(node.body)
+        self.generic_visit(node)
 
     def visit_Custom(self, node: Custom):
         pass
@@ -275,39 +296,129 @@ class NodeTransformer(NodeVisitor):
     # visit_xxx method usage:
     # return Node: replace with
     # return None: keep old
+    # The nodes are never changed: a node with a replaced child is rebuilt, and the other children are shared
+
+    def __init__(self) -> None:
+        # The number of the nodes replaced by the visit_xxx methods (not counting the rebuilt parents of them)
+        self.rewrites = 0
+        self.rebuilt: dict[int, Node] = {}
+
+    def count_rewrite(self, result, child: Node) -> None:
+        if result is not None and result is not child and id(result) not in self.rebuilt:
+            self.rewrites += 1
+
+    def visit_children(self, children: list[Statement]) -> list[Statement] | None:
+        # The new children, or None if all of them are kept
+        results = [self.visit(child) for child in children]
+        if all(result is None or result is child for result, child in zip(results, children)):
+            return None
+        for result, child in zip(results, children):
+            self.count_rewrite(result, child)
+        return [child if result is None else result for result, child in zip(results, children)]
+
+    def generic_visit(self, node: Node):
+        changes = {}
+        for field in node.children:
+            child = getattr(node, field)
+            if isinstance(child, list):
+                result = self.visit_children(child)
+                if result is not None:
+                    changes[field] = result
+            elif child is not None:
+                result = self.visit(child)
+                if result is not None and result is not child:
+                    self.count_rewrite(result, child)
+                    changes[field] = result
+        if not changes:
+            return node
+        rebuilt = node.replace(**changes)
+        self.rebuilt[id(rebuilt)] = rebuilt
+        return rebuilt
 
     def visit_Block(self, node: Block):
-        for i, statement in enumerate(node.body):
-            result = self.visit(statement)
-            if result is not None:
-                node.body[i] = result
-        return node
+        return self.generic_visit(node)
 
     def visit_Program(self, node: Program):
-        for i, statement in enumerate(node.body):
-            result = self.visit(statement)
-            if result is not None:
-                node.body[i] = result
-        return node
+        return self.generic_visit(node)
     
     def visit_FunctionCall(self, node: FunctionCall):
-        for i, arg in enumerate(node.args):
-            result = self.visit(arg)
-            if result is not None:
-                node.args[i] = result
-        return node
+        return self.generic_visit(node)
 
     def visit_FunctionDeclaration(self, node: FunctionDeclaration):
-        result = self.visit(node.body)
-        if result is not None:
-            node.body = result
-        return node
+        return self.generic_visit(node)
     
     def visit_Clone(self, node: Clone):
-        result = self.visit(node.clone)
-        if result is not None:
-            node.clone = result
-        return node
+        return self.generic_visit(node)
 
     def visit_error(self, node: Node):
         raise TypeError(f'Method visit_{type(node).__name__} is not defined')
+
+class Dumper(NodeVisitor):
+    # Node.dump: the text is written to "parts", and joined at the end
+    def __init__(self) -> None:
+        self.parts: list[str] = []
+        self.indent = ''
+
+    def dump(self, node: Node, indent='') -> str:
+        self.indent = indent
+        self.visit(node)
+        return ''.join(self.parts)
+
+    def visit_list(self, list, indent: str):
+        if not list:
+            self.parts.append(indent + '[*No elements*]\n')
+            return
+        self.parts.append(indent + '[\n')
+        for item in list:
+            if isinstance(item, Node):
+                self.indent = indent + INDENT
+                self.visit(item)
+            else:
+                self.parts.append(indent + INDENT + item + '\n')
+        self.parts.append(indent + ']\n')
+
+    def visit_fields(self, node: Node):
+        indent = self.indent
+        self.parts.append(indent + node.node_type_name() + ' {\n')
+        for field in node.fields:
+            value = getattr(node, field)
+            if isinstance(value, Node):
+                self.indent = indent + INDENT
+                self.visit(value)
+            elif isinstance(value, list):
+                self.visit_list(value, indent + INDENT)
+            else:
+                self.parts.append(indent + INDENT + f'[{type(value).__name__}] {value}\n')
+        self.parts.append(indent + '}\n')
+        self.indent = indent
+
+    def visit_leaf(self, node: Node, text: str):
+        self.parts.append(self.indent + node.node_type_name() + ' ' + text + '\n')
+
+    def visit_Statement(self, node: Statement):
+        self.parts.append(self.indent + 'Statement {N/A}\n')
+
+    def visit_Expression(self, node: Expression):
+        self.parts.append(self.indent + 'Expression {N/A}\n')
+
+    def visit_Factor(self, node: Factor):
+        self.parts.append(self.indent + 'Factor {N/A}\n')
+
+    visit_Macro = visit_Statement
+    visit_Block = visit_Program = visit_FunctionCall = visit_fields
+    visit_VariableDeclaration = visit_FunctionDeclaration = visit_Clone = visit_fields
+
+    def visit_Number(self, node: Number):
+        self.visit_leaf(node, str(node.value))
+
+    def visit_String(self, node: String):
+        self.visit_leaf(node, node.value)
+
+    def visit_Identifier(self, node: Identifier):
+        self.visit_leaf(node, node.name)
+
+    def visit_ListIdentifier(self, node: ListIdentifier):
+        self.parts.append(self.indent + 'Identifier ' + node.name + '\n')
+
+    def visit_Custom(self, node: Custom):
+        self.visit_leaf(node, node.name)
@@ -5,20 +5,93 @@ https://github.com/IsBenben/Scratch-Language
 License under the Apache License, version 2.0
 """
 
+from cast import compare, js_divide, js_mod, js_round, lower, to_number, to_string, utf16_length
 from nodes import *
-import operator
-
-numeric_operators = {
-    'operator_add': operator.add,
-    'operator_subtract': operator.sub,
-    'operator_multiply': operator.mul,
-    'operator_divide': operator.truediv,
-    'operator_mod': operator.mod,
+from typing import Callable
+import math
+
+# The operators folded at compile time, like Scratch does at runtime (see scratch-vm/src/blocks/scratch3_operators.js)
+# They get the values of the literals (a float for a Number, a str for a String),
+# and return a number, a string, a boolean, or None if the result cannot be known at compile time
+Value = float | str
+
+def fold_comparison(check: Callable[[float], bool]) -> Callable[[Value, Value], bool | None]:
+    def fold(left: Value, right: Value) -> bool | None:
+        result = compare(left, right)
+        return None if result is None else check(result)
+    return fold
+
+def fold_contains(text: Value, part: Value) -> bool | None:
+    lower_text, lower_part = lower(text), lower(part)
+    if lower_text is None or lower_part is None:
+        return None
+    return lower_part in lower_text
+
+def fold_length(text: Value) -> float | None:
+    length = utf16_length(to_string(text))
+    return None if length is None else float(length)
+
+def fold_letter_of(text: Value, letter: Value) -> str | None:
+    text = to_string(text)
+    index = to_number(letter) - 1
+    if utf16_length(text) is None:
+        return None
+    if index < 0 or index >= len(text):
+        return ''
+    return text[int(index)]
+
+def scratch_trigonometry(function: Callable[[float], float]) -> Callable[[float], float]:
+    # The result is rounded, so sin(180) is 0
+    return lambda number: js_round(function(math.pi * number / 180) * 1e10) / 1e10 if math.isfinite(number) else math.nan
+
+def scratch_tan(number: float) -> float:
+    angle = math.fmod(number, 360) if math.isfinite(number) else math.nan
+    if angle in (-270, 90):
+        return math.inf
+    if angle in (-90, 270):
+        return -math.inf
+    return scratch_trigonometry(math.tan)(angle)
+
+math_operators: dict[str, Callable[[float], float]] = {
+    'abs': abs,
+    'floor': lambda number: float(math.floor(number)) if math.isfinite(number) else number,
+    'ceiling': lambda number: float(math.ceil(number)) if math.isfinite(number) else number,
+    'sqrt': lambda number: math.sqrt(number) if number >= 0 else math.nan,
+    'sin': scratch_trigonometry(math.sin),
+    'cos': scratch_trigonometry(math.cos),
+    'tan': scratch_tan,
 }
-comparison_operators = {
-    'operator_gt': operator.gt,
-    'operator_lt': operator.lt,
-    'operator_equals': operator.eq,
+# These depend on the math library of the browser, so they are not folded
+browser_math_operators = ('asin', 'acos', 'atan', 'ln', 'log', 'e ^', '10 ^')
+
+def fold_mathop(operator: Value, number: Value) -> float | None:
+    name = lower(operator)
+    if name is None or name in browser_math_operators:
+        return None
+    if name not in math_operators:
+        # Scratch returns 0 for an unknown operator
+        return 0.0
+    return math_operators[name](to_number(number))
+
+constant_operators: dict[str, Callable[..., Value | bool | None]] = {
+    'operator_add': lambda left, right: to_number(left) + to_number(right),
+    'operator_subtract': lambda left, right: to_number(left) - to_number(right),
+    'operator_multiply': lambda left, right: to_number(left) * to_number(right),
+    'operator_divide': lambda left, right: js_divide(to_number(left), to_number(right)),
+    'operator_mod': lambda left, right: js_mod(to_number(left), to_number(right)),
+    'operator_gt': fold_comparison(lambda result: result > 0),
+    'operator_lt': fold_comparison(lambda result: result < 0),
+    'operator_equals': fold_comparison(lambda result: result == 0),
+    'operator_join': lambda left, right: to_string(left) + to_string(right),
+    'operator_contains': fold_contains,
+    'operator_length': fold_length,
+    'operator_letter_of': fold_letter_of,
+    'operator_round': lambda number: js_round(to_number(number)),
+    'operator_mathop': fold_mathop,
+}
+constant_operator_arguments = {
+    'operator_length': 1,
+    'operator_round': 1,
 }
 logic_operators = {
     # operator.and_ and operator.or_ are bitwise operators
@@ -26,7 +99,30 @@ logic_operators = {
     'operator_or': lambda a, b: a or b,
 }
 
+def literal_value(node: Node) -> Value | None:
+    if isinstance(node, Number):
+        return float(node.value)
+    if isinstance(node, String):
+        return node.value
+    return None
+
+def create_literal(value: Value | bool) -> Node:
+    if isinstance(value, bool):
+        return create_boolean(value)
+    if isinstance(value, str):
+        return String(value)
+    if not math.isfinite(value):
+        # Infinity and NaN are not numbers in JSON, and the strings are the same in Scratch
+        return String(to_string(value))
+    if value.is_integer() and abs(value) < 2 ** 53 and math.copysign(1, value) > 0:
+        return Number(int(value))
+    return Number(value)
+
 class Optimizer(NodeTransformer):
+    def __init__(self) -> None:
+        super().__init__()
+        self.functions: set[str] = set()
+
     def visit(self, node):
         # Example: !(!(!true)) -> false
         return super().visit(node)
@@ -36,44 +132,49 @@ class Optimizer(NodeTransformer):
             return None
         return super().visit_FunctionDeclaration(node)
 
+    def visit_Program(self, node):
+        names = Names()
+        names.visit(node)
+        self.functions = names.functions
+        return super().visit_Program(node)
+
     def visit_FunctionCall(self, node):
-        super().visit_FunctionCall(node)
-        if not node.always_builtin:
-            return None
+        node = super().visit_FunctionCall(node)
+        if not node.always_builtin and (node.name not in constant_operators or node.name in self.functions):
+            # A custom function (a call of an operator is folded too, unless a function with the same name is declared)
+            return node
         
-        if node.name in numeric_operators:
-            if len(node.args) != 2:
-                return None
-            left, right = node.args
-            if isinstance(left, Number) and isinstance(right, Number):
-                return Number(numeric_operators[node.name](left.value, right.value))
-        if node.name in comparison_operators:
-            if len(node.args) != 2:
-                return None
-            left, right = node.args
-            if isinstance(left, Number) and isinstance(right, Number):
-                return create_boolean(comparison_operators[node.name](left.value, right.value))
+        if node.name in constant_operators:
+            if len(node.args) != constant_operator_arguments.get(node.name, 2):
+                return node
+            values = [literal_value(arg) for arg in node.args]
+            if any(value is None for value in values):
+                return node
+            result = constant_operators[node.name](*values)
+            if result is None:
+                return node
+            return create_literal(result)
         if node.name in logic_operators:
             if len(node.args) != 2:
-                return None
+                return node
             left, right = node.args
             if is_boolean(left) and is_boolean(right):
                 return create_boolean(logic_operators[node.name](value_of_boolean(left), value_of_boolean(right)))
         if node.name == 'control_if':
             if len(node.args) != 2:
-                return None
+                return node
             condition, sub_stack = node.args
             if is_boolean(condition):
                 return sub_stack if value_of_boolean(condition) else Block()
         if node.name == 'control_if_else':
             if len(node.args) != 3:
-                return None
+                return node
             condition, sub_stack, sub_stack2 = node.args
             if is_boolean(condition):
                 return sub_stack if value_of_boolean(condition) else sub_stack2
         if node.name == 'control_repeat_until':
             if len(node.args) != 2:
-                return None
+                return node
             condition, sub_stack = node.args
             if is_boolean(condition):
                 # until True -> pass
@@ -81,16 +182,324 @@ class Optimizer(NodeTransformer):
                 return Block() if value_of_boolean(condition) else FunctionCall(
                     'control_forever', [sub_stack]
                 )
-        if node.name == 'control_repeat':
-            if len(node.args) != 2:
-                return None
-            times, sub_stack = node.args
-            if isinstance(times, Number):
-                if times.value < 1:
-                    return Block()
-                if times.value >= 10:
-                    # Too many loops!
-                    return None
-                return Block([sub_stack] * int(times.value))
         if is_boolean(node):
+            # not() and not(not()) are already the simplest, and kept, so the passes can reach a fixed point
+            if not node.args or not node.args[0].args:
+                return node
             return create_boolean(node)
+        return node
+
+WRITE_FUNCTIONS = ('data_setvariableto', 'data_changevariableby')
+
+def is_literal(node: Node) -> bool:
+    return isinstance(node, (Number, String)) or is_boolean(node)
+
+class Names(NodeVisitor):
+    # The names in a tree: the variables written (and how many times) and read, and the functions declared
+    def __init__(self) -> None:
+        self.writes: dict[str, int] = {}
+        self.reads: set[str] = set()
+        self.functions: set[str] = set()
+
+    def visit_FunctionCall(self, node):
+        args = node.args
+        if node.name in WRITE_FUNCTIONS and args and type(args[0]) is Identifier:
+            self.writes[args[0].name] = self.writes.get(args[0].name, 0) + 1
+            args = args[1:]
+        for arg in args:
+            self.visit(arg)
+
+    def visit_Identifier(self, node):
+        self.reads.add(node.name)
+
+    def visit_FunctionDeclaration(self, node):
+        self.functions.add(node.name)
+        self.generic_visit(node)
+
+    def visit_Clone(self, node):
+        self.generic_visit(node)
+
+class ConstantPropagator(NodeTransformer):
+    # const NAME = value; with a value known at compile time (a number, a string or a boolean):
+    # the uses of NAME are replaced with the value, and the declaration is dropped
+    # (the constants made of other constants are folded by Optimizer first, then propagated in the next iteration)
+    def __init__(self) -> None:
+        super().__init__()
+        self.writes: dict[str, int] = {}
+        # Each scope (like the records of Interpreter): name -> the value, or None if it's not a known constant
+        self.scopes: list[dict[str, Node | None]] = []
+        self.kept: set[tuple[int, str]] = set()  # The constants still used (by a nooptimize function): (id of scope, name)
+
+    def visit_Program(self, node):
+        uses = Names()
+        uses.visit(node)
+        self.writes = uses.writes
+        return self.visit_scope(node)
+
+    def visit_Block(self, node):
+        return self.visit_scope(node)
+
+    def visit_scope(self, node: Block):
+        scope: dict[str, Node | None] = {}
+        self.scopes.append(scope)
+        body: list[Statement] = []
+        constants: list[tuple[int, str]] = []  # The indexes in "body" and the names of the known constants
+        changed = False
+        index = 0
+        while index < len(node.body):
+            statement = node.body[index]
+            if isinstance(statement, VariableDeclaration):
+                scope[statement.name] = None
+                value = self.constant_value(statement, node.body[index + 1:index + 2])
+                if value is not None:
+                    scope[statement.name] = value
+                    constants.append((len(body), statement.name))
+                    body += [statement, node.body[index + 1]]
+                    index += 2
+                    continue
+            result = self.visit(statement)
+            if result is not None and result is not statement:
+                self.count_rewrite(result, statement)
+                changed = True
+                statement = result
+            body.append(statement)
+            index += 1
+        self.scopes.pop()
+
+        dropped = {index for index, name in constants if (id(scope), name) not in self.kept}
+        if dropped:
+            self.rewrites += 2 * len(dropped)
+            body = [statement for index, statement in enumerate(body) if index not in dropped and index - 1 not in dropped]
+        elif not changed:
+            return node
+        rebuilt = node.replace(body=body)
+        self.rebuilt[id(rebuilt)] = rebuilt
+        return rebuilt
+
+    def constant_value(self, declaration: VariableDeclaration, following: list[Statement]) -> Node | None:
+        # The value of a constant if it is only set by the statement after the declaration
+        if not declaration.is_const or self.writes.get(declaration.name) != 1 or not following:
+            return None
+        statement = following[0]
+        if not (isinstance(statement, FunctionCall) and statement.name == 'data_setvariableto'
+                and len(statement.args) == 2 and type(statement.args[0]) is Identifier
+                and statement.args[0].name == declaration.name):
+            return None
+        value = self.visit(statement.args[1])
+        if value is None:
+            value = statement.args[1]
+        return value if is_literal(value) else None
+
+    def visit_FunctionCall(self, node):
+        if node.name in WRITE_FUNCTIONS and node.args and type(node.args[0]) is Identifier:
+            # The variable set is not a use of it
+            args = self.visit_children(node.args[1:])
+            if args is None:
+                return node
+            rebuilt = node.replace(args=node.args[:1] + args)
+            self.rebuilt[id(rebuilt)] = rebuilt
+            return rebuilt
+        return self.generic_visit(node)
+
+    def visit_FunctionDeclaration(self, node):
+        if 'nooptimize' in node.attributes:
+            # Not changed, so the constants used in it are kept
+            uses = Names()
+            uses.visit(node.body)
+            for name in uses.reads - set(node.args):
+                scope = self.resolve(name)
+                if scope is not None and scope[name] is not None:
+                    self.kept.add((id(scope), name))
+            return None
+        self.scopes.append(dict.fromkeys(node.args))
+        result = self.generic_visit(node)
+        self.scopes.pop()
+        return result
+
+    def visit_Identifier(self, node):
+        scope = self.resolve(node.name)
+        if scope is None:
+            return None
+        return scope[node.name]
+
+    def resolve(self, name: str) -> dict[str, Node | None] | None:
+        for scope in reversed(self.scopes):
+            if name in scope:
+                return scope
+        return None
+
+LIST_WRITE_FUNCTIONS = ('data_deletealloflist', 'data_addtolist', 'data_deleteoflist', 'data_insertatlist', 'data_replaceitemoflist')
+# A declaration: (id of the scope, name)
+Key = tuple[int, str]
+
+def is_pure(node: Node) -> bool:
+    # Without a call written in the code (it may be a custom function, or a block doing something)
+    if isinstance(node, FunctionCall):
+        return node.always_builtin and all(is_pure(arg) for arg in node.args)
+    return isinstance(node, (Number, String, Identifier))
+
+def is_empty(node: Node) -> bool:
+    return type(node) is Block and not node.body
+
+class DeadCodeEliminator(NodeTransformer):
+    # Whole-program dead code elimination:
+    # the functions never called (from the scripts, or from the functions called), the variables and the lists never read
+    # are removed with the statements setting them, so they are never emitted (the unused code of the included files too)
+    # The names are resolved like the records of Interpreter: a block is a scope, and a name is declared by a statement before it
+    # Each run analyzes the program, then removes the dead code, until nothing is removed
+    # (a removed statement may be the only read of another variable)
+    def __init__(self, exports: bool = False) -> None:
+        super().__init__()
+        self.exports = exports  # Keep the top-level declarations, they are used by the other units (see linker.py)
+        self.analyzing = True
+        # Each scope: its id, and name -> the key of the variable (or None for an argument), name -> the key of the function
+        self.scopes: list[tuple[int, dict[str, Key | None], dict[str, Key]]] = []
+        self.owner: Key | None = None  # The function being visited, None for the scripts
+        self.protected = 0  # In a nooptimize function, nothing is removed
+        self.target: Key | None = None  # The variable set by the statement being visited
+        self.roots: set[Key] = set()
+        self.calls: dict[Key | None, set[Key]] = {}
+        self.reads: dict[Key | None, set[Key]] = {}
+        self.live: set[Key] = set()
+
+    def visit_Program(self, node):
+        while True:
+            self.analyzing = True
+            self.roots, self.calls, self.reads = set(), {}, {}
+            self.visit_scope(node)
+            self.live = self.reachable()
+            self.analyzing = False
+            rewrites = self.rewrites
+            node = self.visit_scope(node)
+            if self.rewrites == rewrites:
+                return node
+
+    def reachable(self) -> set[Key]:
+        functions: set[Key | None] = {None} | set(self.roots)
+        stack = list(functions)
+        while stack:
+            for callee in self.calls.get(stack.pop(), ()):
+                if callee not in functions:
+                    functions.add(callee)
+                    stack.append(callee)
+        live = self.roots.copy()
+        for function in functions:
+            if function is not None:
+                live.add(function)
+            live |= self.reads.get(function, set())
+        return live
+
+    def visit_Block(self, node):
+        return self.visit_scope(node)
+
+    def visit_scope(self, node: Block, arguments: list[str] | None = None):
+        variables: dict[str, Key | None] = dict.fromkeys(arguments or [])
+        self.scopes.append((id(node), variables, {}))
+        body: list[Statement] = []
+        changed = False
+        for statement in node.body:
+            if isinstance(statement, VariableDeclaration):
+                key = (id(node), statement.name)
+                variables[statement.name] = key
+                if self.analyzing and (self.protected or self.exports and len(self.scopes) == 1):
+                    self.roots.add(key)
+                elif not self.analyzing and key not in self.live:
+                    self.rewrites += 1
+                    changed = True
+                    continue
+            result = self.visit(statement)
+            if result is not None and result is not statement:
+                self.count_rewrite(result, statement)
+                changed = True
+                if is_empty(result):
+                    continue
+                statement = result
+            body.append(statement)
+        self.scopes.pop()
+        if not changed:
+            return node
+        rebuilt = node.replace(body=body)
+        self.rebuilt[id(rebuilt)] = rebuilt
+        return rebuilt
+
+    def visit_FunctionDeclaration(self, node):
+        scope_id, _, functions = self.scopes[-1]
+        key = functions[node.name] = (scope_id, node.name)
+        nooptimize = 'nooptimize' in node.attributes
+        if self.analyzing:
+            if nooptimize or self.protected or self.exports and len(self.scopes) == 1:
+                self.roots.add(key)
+        elif key not in self.live:
+            return Block()
+        elif nooptimize or self.protected:
+            return None
+        owner = self.owner
+        self.owner = key
+        self.protected += nooptimize
+        body = self.visit_scope(node.body, node.args)
+        self.protected -= nooptimize
+        self.owner = owner
+        if body is node.body:
+            return node
+        rebuilt = node.replace(body=body)
+        self.rebuilt[id(rebuilt)] = rebuilt
+        return rebuilt
+
+    def visit_FunctionCall(self, node):
+        args = node.args
+        if node.name in WRITE_FUNCTIONS + LIST_WRITE_FUNCTIONS and args and isinstance(args[0], Identifier):
+            # The variable (or the list) set is not a read of it
+            key = self.resolve_variable(args[0].name)
+            if key is not None:
+                if self.analyzing and (self.protected or not all(is_pure(arg) for arg in args[1:])):
+                    self.read(key)
+                elif not self.analyzing and key not in self.live:
+                    return Block()
+            # A read in the value (like x = x + 1) is not a read either, the value is only used by the variable itself
+            target = self.target
+            self.target = key
+            rest = self.visit_children(args[1:])
+            self.target = target
+            if rest is None:
+                return node
+            rebuilt = node.replace(args=args[:1] + rest)
+            self.rebuilt[id(rebuilt)] = rebuilt
+            return rebuilt
+        if self.analyzing and not node.always_builtin:
+            callee = self.resolve_function(node.name)
+            if callee is not None:
+                self.calls.setdefault(self.owner, set()).add(callee)
+        node = self.generic_visit(node)
+        if self.analyzing or self.protected:
+            return node
+        # The control blocks left empty do nothing
+        if node.name in ('control_repeat', 'control_if') and len(node.args) == 2 \
+                and is_empty(node.args[1]) and is_pure(node.args[0]):
+            return Block()
+        if node.name == 'control_if_else' and len(node.args) == 3 \
+                and is_empty(node.args[1]) and is_empty(node.args[2]) and is_pure(node.args[0]):
+            return Block()
+        return node
+
+    def visit_Identifier(self, node):
+        key = self.resolve_variable(node.name)
+        if self.analyzing and key is not None and key != self.target:
+            self.read(key)
+
+    visit_ListIdentifier = visit_Identifier
+
+    def read(self, key: Key) -> None:
+        self.reads.setdefault(self.owner, set()).add(key)
+
+    def resolve_variable(self, name: str) -> Key | None:
+        # None for an argument, or a name not declared in the program (like a variable of another unit)
+        for _, variables, _ in reversed(self.scopes):
+            if name in variables:
+                return variables[name]
+        return None
+
+    def resolve_function(self, name: str) -> Key | None:
+        for _, _, functions in reversed(self.scopes):
+            if name in functions:
+                return functions[name]
+        return None
@@ -6,15 +6,22 @@ License under the Apache License, version 2.0
 """
 
 from __future__ import annotations
-from tokens import TokenType, tokenize, Token
+from tokens import TokenType, TokenBuffer, TokenLike, TokenCursor
 from nodes import *
 from poly import *
 from error import Error, raise_error
-from typing import Optional, NoReturn, Any, Callable, TypeVar, Protocol, Generator, Literal
+from typing import Optional, NoReturn, Any, Callable, TypeVar, Protocol, Generator, Literal, Iterable
 from contextlib import contextmanager
 from utils import *
-from optimize import Optimizer
-import copy
+from passes import pass_manager
+import hashlib
+import os
+import pickle
+import zlib
+
+folder = os.path.dirname(__file__)
+PROGRAM_CACHE_PATH = os.path.join(folder, '../.cache/programs')
+PROGRAM_CACHE_VERSION = 2  # Change it when the nodes or the parser change
 
 sign_to_english = {
     '+': 'add',
@@ -30,6 +37,21 @@ sign_to_english = {
     '&&': 'and',
     '..': 'join',
 }
+# Binding power of the binary operators, the bigger binds more tightly
+BOOLEAN_PRECEDENCE = {
+    '&&': 1,
+    '||': 2,
+}
+VALUE_PRECEDENCE = {
+    '->': 1,
+    '..': 2,
+    '+': 3,
+    '-': 3,
+    '*': 4,
+    '/': 4,
+    '%': 4,
+}
+RIGHT_ASSOCIATIVE = frozenset(['->'])
 inverse_sign = {
     '!=': '==',
     '<': '>=',
@@ -51,6 +73,11 @@ def extend_or_append(list_: T, value: T | Any) -> T:
         list_.append(value)
     return list_
 
+def apply_sign(factor: Expression, multiplier: int, has_sign: bool) -> Expression:
+    if not has_sign:
+        return factor
+    return FunctionCall('operator_' + sign_to_english['*'], [factor, Number(multiplier)])
+
 class Record:
     def __init__(self, block: list[Statement], parent: Record | None = None):
         self.block = block
@@ -94,26 +121,87 @@ COMPREHENSION_ELEMENTS_TYPE = list[
     | tuple[Literal['for'], Identifier, Identifier, ListIdentifier]
 ]
 
+class ProgramCache:
+    # Parsed (and optimized) programs, keyed by the hash of the preprocessed tokens,
+    # the compiler version and the optimize flag
+    # Saved in "path" (unless it is None), so a build of the same tokens skips parsing and optimizing
+    def __init__(self, path: str | None = PROGRAM_CACHE_PATH):
+        self.path = path
+
+    def digest(self, tokens: list[TokenLike], passes: str, extra: str = '') -> str:
+        # "passes" is the key of the enabled optimization passes (see PassManager.key)
+        # The line numbers are not hashed, because they are only used by the errors (nothing is saved after an error)
+        sha = hashlib.sha256(f'{VERSION}\0{PROGRAM_CACHE_VERSION}\0{passes}\0{extra}\0'.encode())
+        for token in tokens:
+            sha.update(f'{token.type.name} {len(token.value)} {token.value}'.encode())
+        return sha.hexdigest()
+
+    def load(self, digest: str) -> Program | None:
+        if self.path is None:
+            return None
+        try:
+            with open(os.path.join(self.path, digest + '.pickle.z'), 'rb') as f:
+                version, program = pickle.loads(zlib.decompress(f.read()))
+        except (OSError, EOFError, zlib.error, pickle.UnpicklingError, AttributeError, ValueError, TypeError, RecursionError):
+            return None
+        if version != PROGRAM_CACHE_VERSION or not isinstance(program, Program):
+            return None
+        return program
+
+    def save(self, digest: str, program: Program) -> None:
+        if self.path is None:
+            return None
+        file = os.path.join(self.path, digest + '.pickle.z')
+        try:
+            # The pickled nodes repeat a lot, so they are compressed (quickly)
+            data = zlib.compress(pickle.dumps((PROGRAM_CACHE_VERSION, program), pickle.HIGHEST_PROTOCOL), 1)
+            os.makedirs(self.path, exist_ok=True)
+            # Written to another file first, so a reader never sees a half-written file
+            with open(f'{file}.{os.getpid()}', 'wb') as f:
+                f.write(data)
+            os.replace(f'{file}.{os.getpid()}', file)
+        except (OSError, RecursionError):
+            # A very deep program can not be pickled, it is just not cached
+            pass
+
+program_cache = ProgramCache()
+
 class Parser:
-    def parse(self, tokens: str | list[Token]) -> Program:
-        self.record: Record | None = None
+    def parse(self, tokens: str | Iterable[TokenLike], imports: Record | None = None) -> Program:
+        # "imports" has the declarations of the linked units (see linker.py)
+        self.record: Record | None = imports
         self.no_new_record: Block | None = None
         if isinstance(tokens, str):
-            tokens = tokenize(tokens)
-        parsed = self.parse_program(tokens)
-        if not get_args().nooptimize:
-            result = Optimizer().visit(parsed)
-            if result is not None:
-                assert isinstance(result, Program)
-                parsed = result
+            tokens = TokenBuffer(tokens)
+        optimize = not get_args().nooptimize
+        # The temporary names start again, so a cached program has the same names as a parsed one
+        temporary_names.reset()
+        digest = None
+        if program_cache.path is not None:
+            # The tokens must be hashed before parsing, so they are not streamed to the parser
+            tokens = list(tokens)
+            # The temporary names of a unit are padded (see unit_ids)
+            extra = 'padded' if temporary_names.padded else ''
+            if imports is not None:
+                # Whether an imported variable is an array changes the parsing
+                extra += repr(sorted((name, node.is_const, node.is_array) for name, node in imports.variables.items()))
+            digest = program_cache.digest(tokens, pass_manager.key if optimize else '', extra)
+            cached = program_cache.load(digest)
+            if cached is not None:
+                return cached
+        parsed = self.parse_program(TokenCursor(tokens))
+        if optimize:
+            parsed = pass_manager.run_program(parsed)
+        if digest is not None:
+            program_cache.save(digest, parsed)
         return parsed
     
-    def eat(self, tokens: list[Token], type: Optional[TokenType] = None) -> Token:
+    def eat(self, tokens: TokenCursor, type: Optional[TokenType] = None) -> TokenLike:
         if type is None:
-            return tokens.pop(0)
-        if tokens[0].type == type:
-            return tokens.pop(0)
-        raise_error(Error('Parse', f'Unexpected token "{tokens[0].desc}", expected {type}'))
+            return tokens.advance()
+        if tokens.peek().type == type:
+            return tokens.advance()
+        raise_error(Error('Parse', f'Unexpected token "{tokens.peek().desc}", expected {type}'))
     
     @contextmanager
     def new_record(self, block_type: type[T_BODY], check_no_new_record: bool = False) -> Generator[T_BODY, None, None]:
@@ -129,97 +217,127 @@ class Parser:
         yield block_like
         self.record = old_record
 
-    def parse_program(self, tokens: list[Token]) -> Program:
+    def parse_program(self, tokens: TokenCursor) -> Program:
         with self.new_record(Program) as program:
-            while tokens[0].type != TokenType.EOF:
+            while tokens.peek().type != TokenType.EOF:
                 statement = self.parse_statement(tokens)
                 if statement is not None:
                     extend_or_append(program.body, statement)
             return program
     
-    def parse_block(self, tokens: list[Token]) -> Block:
+    def parse_block(self, tokens: TokenCursor) -> Block:
         assert self.record
 
         self.eat(tokens, TokenType.BLOCK_START)
         with self.new_record(Block, check_no_new_record=True) as block:
-            while tokens[0].type != TokenType.BLOCK_END:
+            while tokens.peek().type != TokenType.BLOCK_END:
                 statement = self.parse_statement(tokens)
                 if statement is not None:
                     extend_or_append(block.body, statement)
             self.eat(tokens, TokenType.BLOCK_END)
         return block
 
-    def parse_statement(self, tokens: list[Token]) -> STATEMENT_TYPE:
+    def parse_statement(self, tokens: TokenCursor) -> STATEMENT_TYPE:
         assert self.record is not None
 
         result: STATEMENT_TYPE
 
         # Special case
-        if tokens[0].type == TokenType.STATEMENT_END:
+        if tokens.peek().type == TokenType.STATEMENT_END:
             result = None
-        elif tokens[0].type == TokenType.BLOCK_START:
+        elif tokens.peek().type == TokenType.BLOCK_START:
             result = self.parse_block(tokens)
-        elif len(tokens) >= 2 and tokens[1].type == TokenType.ASSIGNMENT:
+        elif tokens.peek(1).type == TokenType.ASSIGNMENT:
             result = self.parse_assignment(tokens)
         
         # Keywords sign
-        elif tokens[0].type == TokenType.KEYWORD:
-            keyword = tokens[0].value
+        elif tokens.peek().type == TokenType.KEYWORD:
+            keyword = tokens.peek().value
             if keyword in ['var', 'const', 'array']:
                 result = self.parse_assignment(tokens)
-            if keyword == 'if':
+            elif keyword == 'if':
                 result = self.parse_if_statement(tokens)
-            if keyword in ['while', 'until']:
+            elif keyword in ['while', 'until']:
                 result = self.parse_repeat_statement(tokens)
-            if keyword == 'function':
+            elif keyword == 'function':
                 result = self.parse_function_declaration(tokens)
-            if keyword == 'clone':
+            elif keyword == 'clone':
                 result = self.parse_clone_statement(tokens)
-            if keyword == 'delete':
+            elif keyword == 'delete':
                 result = self.parse_delete(tokens)
-            if keyword == 'for':
+            elif keyword == 'for':
                 result = self.parse_for_statement(tokens)
+            else:
+                raise_error(Error('Parse', f'Unexpected token "{tokens.peek().desc}", expected a statement'))
         
         # Others: an expression
         else:
             result = self.parse_join_expression(tokens)
             self.eat(tokens, TokenType.STATEMENT_END)
         
-        while tokens[0].type == TokenType.STATEMENT_END:
+        while tokens.peek().type == TokenType.STATEMENT_END:
             self.eat(tokens)
         self.no_new_record = None
         return result
     
     # Deprecated!
-    # def parse_expression(self, tokens: list[Token]) -> Expression:
-    #     if len(tokens) >= 2 and tokens[1].type == TokenType.COMPARE:
-    #         if tokens[1].value in ['>=', '<=']:
+    # def parse_expression(self, tokens: TokenCursor) -> Expression:
+    #     if tokens.peek(1).type == TokenType.COMPARE:
+    #         if tokens.peek(1).value in ['>=', '<=']:
     #             return self.parse_comparison_expression(tokens)
     #     return self.parse_join_expression(tokens)
     
-    def parse_and_expression(self, tokens: list[Token]) -> Expression:
-        return self._parse_expression(tokens, ['&&'], self.parse_or_expression)
-
-    def parse_or_expression(self, tokens: list[Token]) -> Expression:
-        return self._parse_expression(tokens, ['||'], self.parse_comparison_expression)
-
-    def parse_comparison_expression(self, tokens: list[Token]) -> Expression | NoReturn:
-        inverse = False
-        if tokens[0].type == TokenType.OPERATOR and tokens[0].value == '!':
-            self.eat(tokens)
-            inverse = not inverse
-        
-        if tokens[0].type == TokenType.LEFT_PAREN:
-            self.eat(tokens)  # eat TokenType.LEFT_PAREN
-            comparison_expression = self.parse_and_expression(tokens)
-            self.eat(tokens, TokenType.RIGHT_PAREN)
-        elif tokens[0].type == TokenType.KEYWORD:
-            if tokens[0].value in ['true', 'false']:
+    def parse_and_expression(self, tokens: TokenCursor) -> Expression:
+        return self._parse_boolean_expression(tokens, True)
+
+    def parse_comparison_expression(self, tokens: TokenCursor) -> Expression:
+        # One comparison, "&&" and "||" are only parsed in parens
+        return self._parse_boolean_expression(tokens, False)
+
+    def _parse_boolean_expression(self, tokens: TokenCursor, with_operators: bool) -> Expression:
+        # Precedence climbing with explicit stacks, so the nested parens do not use Python frames
+        # "operators" has the binary operators, and the open parens (whether "!" is before them)
+        operands: list[Expression] = []
+        operators: list[str | bool] = []
+        open_parens = 0
+        while True:
+            inverse = False
+            if tokens.peek().type == TokenType.OPERATOR and tokens.peek().value == '!':
+                self.eat(tokens)
+                inverse = True
+            if tokens.peek().type == TokenType.LEFT_PAREN:
+                self.eat(tokens)  # eat TokenType.LEFT_PAREN
+                operators.append(inverse)
+                open_parens += 1
+                continue
+            operands.append(self._parse_comparison(tokens, inverse))
+            while True:
+                token = tokens.peek()
+                if token.type == TokenType.OPERATOR and token.value in BOOLEAN_PRECEDENCE \
+                       and (with_operators or open_parens):
+                    self._reduce(operands, operators, BOOLEAN_PRECEDENCE, token.value)
+                    operators.append(self.eat(tokens).value)
+                    break
+                if token.type == TokenType.RIGHT_PAREN and open_parens:
+                    self._reduce(operands, operators, BOOLEAN_PRECEDENCE)
+                    self.eat(tokens)  # eat TokenType.RIGHT_PAREN
+                    open_parens -= 1
+                    if operators.pop():
+                        operands.append(FunctionCall('operator_' + sign_to_english['!'], [operands.pop()]))
+                    continue
+                self._reduce(operands, operators, BOOLEAN_PRECEDENCE)
+                if open_parens:
+                    self.eat(tokens, TokenType.RIGHT_PAREN)
+                return operands[0]
+
+    def _parse_comparison(self, tokens: TokenCursor, inverse: bool) -> Expression | NoReturn:
+        if tokens.peek().type == TokenType.KEYWORD:
+            if tokens.peek().value in ['true', 'false']:
                 boolean = self.eat(tokens).value == 'true'
                 if inverse:
                     boolean = not boolean
                 return create_boolean(boolean)
-            elif tokens[0].value == 'if':
+            elif tokens.peek().value == 'if':
                 result = self.parse_if_expression_and(tokens)
                 # Identifier is a reporter block
                 # Convert to a boolean block instead
@@ -235,7 +353,7 @@ class Parser:
                     ])
                 inverse = False
             else:
-                raise_error(Error('Parse', f'Unexpected token "{tokens[0].desc}", expected keyword "true", "if", or "false"'))
+                raise_error(Error('Parse', f'Unexpected token "{tokens.peek().desc}", expected keyword "true", "if", or "false"'))
         else:
             left = self.parse_join_expression(tokens)
             if isinstance(left, ListIdentifier):
@@ -258,67 +376,62 @@ class Parser:
             return FunctionCall('operator_' + sign_to_english['!'], [comparison_expression])
         return comparison_expression
 
-    def _parse_expression(self, tokens: list[Token], operators: list[str], next_level: Callable[[list[Token]], Expression]) -> Expression:
-        left = next_level(tokens)
-        while tokens[0].type == TokenType.OPERATOR and tokens[0].value in operators:
-            operator = self.eat(tokens).value
-            right = next_level(tokens)
-            is_array = isinstance(right, ListIdentifier)
-            if is_array != isinstance(left, ListIdentifier):
-                raise_error(Error('Parse', f'Cannot use operator "{operator}" with different types'))
-            if is_array:
-                if operator == '+' or operator == '..':
-                    assert self.record is not None
-
-                    result = ListIdentifier('')
-                    result.name = generate_id(('array', 'join', result))
-                    index = Identifier(generate_id(('array', 'index', result)))
-                    # # Pseudo Code:
-                    # result = []
-                    # index = 0
-                    # for _ in range(len(left)):
-                    #     index += 1
-                    #     result.append(left[i]) # Scratch lists are 1-indexed
-                    # index = 0
-                    # for _ in range(len(right)):
-                    #     index += 1
-                    #     result.append(right[i])
-                    self.record.block.extend([
-                        self.record.variable_declaration(result.name, False, True),
-                        self.record.variable_declaration(index.name, False, False),
-                        FunctionCall('data_setvariableto', [index, Number(0)]),
-                        FunctionCall('control_repeat', [
-                            FunctionCall('data_lengthoflist', [left]),
-                            Block([
-                                FunctionCall('data_changevariableby', [index, Number(1)]),
-                                FunctionCall('data_addtolist', [result, FunctionCall('data_itemoflist', [left, index])])
-                            ])
-                        ]),
-                        FunctionCall('data_setvariableto', [index, Number(0)]),
-                        FunctionCall('control_repeat', [
-                            FunctionCall('data_lengthoflist', [right]),
-                            Block([
-                                FunctionCall('data_changevariableby', [index, Number(1)]),
-                                FunctionCall('data_addtolist', [result, FunctionCall('data_itemoflist', [right, index])])
-                            ])
-                        ]),
-                    ])
-                    left = result
-                else:
-                    raise_error(Error('Parse', f'Cannot use operator "{operator}" with two arrays'))
-            else:
-                left = FunctionCall('operator_' + sign_to_english[operator], [left, right])
-        return left
-
-    def parse_join_expression(self, tokens: list[Token]) -> Expression:
+    def parse_join_expression(self, tokens: TokenCursor) -> Expression | NoReturn:
+        # Precedence climbing with explicit stacks, so the nested parens do not use Python frames
+        # "operators" has the binary operators, and the open parens (with the sign before them)
+        operands: list[Expression] = []
+        operators: list[str | tuple[int, bool]] = []
+        open_parens = 0
+        while True:
+            multiplier, has_sign = self.parse_sign(tokens)
+            if tokens.peek().type == TokenType.LEFT_PAREN:
+                self.eat(tokens)  # eat TokenType.LEFT_PAREN
+                operators.append((multiplier, has_sign))
+                open_parens += 1
+                continue
+            factor = self.parse_factor(tokens, multiplier, has_sign)
+            operands.append(self.parse_subscript_expression(tokens, factor))
+            while True:
+                token = tokens.peek()
+                if token.type == TokenType.OPERATOR and token.value in VALUE_PRECEDENCE:
+                    self._reduce(operands, operators, VALUE_PRECEDENCE, token.value)
+                    if token.value == '->' and isinstance(operands[-1], ListIdentifier):
+                        raise_error(Error('Parse', 'Cannot use "->" operator with array'))
+                    operators.append(self.eat(tokens).value)
+                    break
+                if token.type == TokenType.RIGHT_PAREN and open_parens:
+                    self._reduce(operands, operators, VALUE_PRECEDENCE)
+                    self.eat(tokens)  # eat TokenType.RIGHT_PAREN
+                    open_parens -= 1
+                    paren = operators.pop()
+                    assert isinstance(paren, tuple)
+                    multiplier, has_sign = paren
+                    operands.append(self.parse_subscript_expression(tokens, apply_sign(operands.pop(), multiplier, has_sign)))
+                    continue
+                self._reduce(operands, operators, VALUE_PRECEDENCE)
+                if open_parens:
+                    self.eat(tokens, TokenType.RIGHT_PAREN)
+                return operands[0]
+
+    def _reduce(self, operands: list[Expression], operators: list, precedence: dict[str, int], incoming: Optional[str] = None) -> None:
+        # Apply the operators on the top of the stack, until an open paren,
+        # or an operator binding less tightly than "incoming" (all of them if "incoming" is None)
+        while operators and isinstance(operators[-1], str):
+            operator = operators[-1]
+            if incoming is not None:
+                if precedence[operator] < precedence[incoming]:
+                    break
+                if precedence[operator] == precedence[incoming] and incoming in RIGHT_ASSOCIATIVE:
+                    break
+            operators.pop()
+            right = operands.pop()
+            left = operands.pop()
+            operands.append(self._apply_operator(operator, left, right))
+
+    def _apply_operator(self, operator: str, left: Expression, right: Expression) -> Expression | NoReturn:
         assert self.record is not None
 
-        left = self._parse_expression(tokens, ['..'], self.parse_additive_expression)
-        if tokens[0].type == TokenType.OPERATOR and tokens[0].value == '->':
-            if isinstance(left, ListIdentifier):
-                raise_error(Error('Parse', 'Cannot use "->" operator with array'))
-            self.eat(tokens)  # eat TokenType.OPERATOR
-            right = self.parse_join_expression(tokens)
+        if operator == '->':
             if isinstance(right, ListIdentifier):
                 raise_error(Error('Parse', 'Cannot use "->" operator with array'))
             
@@ -329,8 +442,8 @@ class Parser:
             #    result.append(i)
             #    i += 1
             result = ListIdentifier('')
-            result.name = generate_id(('array', 'range', result))
-            index = Identifier(generate_id(('array', 'index', result)))
+            result.name = generate_name(('array', 'range', result))
+            index = Identifier(generate_name(('array', 'index', result)))
             self.record.block.extend([
                 self.record.variable_declaration(result.name, False, True),
                 self.record.variable_declaration(index.name, False, False),
@@ -344,19 +457,55 @@ class Parser:
                     ])
                 ]),
             ])
-            left = result
-        return left
+            return result
 
-    def parse_additive_expression(self, tokens: list[Token]) -> Expression:
-        return self._parse_expression(tokens, ['+', '-'], self.parse_multiplicative_expression)
+        is_array = isinstance(right, ListIdentifier)
+        if is_array != isinstance(left, ListIdentifier):
+            raise_error(Error('Parse', f'Cannot use operator "{operator}" with different types'))
+        if not is_array:
+            return FunctionCall('operator_' + sign_to_english[operator], [left, right])
+        if operator != '+' and operator != '..':
+            raise_error(Error('Parse', f'Cannot use operator "{operator}" with two arrays'))
+
+        result = ListIdentifier('')
+        result.name = generate_name(('array', 'join', result))
+        index = Identifier(generate_name(('array', 'index', result)))
+        # # Pseudo Code:
+        # result = []
+        # index = 0
+        # for _ in range(len(left)):
+        #     index += 1
+        #     result.append(left[i]) # Scratch lists are 1-indexed
+        # index = 0
+        # for _ in range(len(right)):
+        #     index += 1
+        #     result.append(right[i])
+        self.record.block.extend([
+            self.record.variable_declaration(result.name, False, True),
+            self.record.variable_declaration(index.name, False, False),
+            FunctionCall('data_setvariableto', [index, Number(0)]),
+            FunctionCall('control_repeat', [
+                FunctionCall('data_lengthoflist', [left]),
+                Block([
+                    FunctionCall('data_changevariableby', [index, Number(1)]),
+                    FunctionCall('data_addtolist', [result, FunctionCall('data_itemoflist', [left, index])])
+                ])
+            ]),
+            FunctionCall('data_setvariableto', [index, Number(0)]),
+            FunctionCall('control_repeat', [
+                FunctionCall('data_lengthoflist', [right]),
+                Block([
+                    FunctionCall('data_changevariableby', [index, Number(1)]),
+                    FunctionCall('data_addtolist', [result, FunctionCall('data_itemoflist', [right, index])])
+                ])
+            ]),
+        ])
+        return result
 
-    def parse_multiplicative_expression(self, tokens: list[Token]) -> Expression:
-        return self._parse_expression(tokens, ['*', '/', '%'], self.parse_subscript_expression)
-    
-    def parse_subscript_expression(self, tokens: list[Token]) -> Expression | NoReturn:
-        left = self.parse_factor(tokens)
+    def parse_subscript_expression(self, tokens: TokenCursor, left: Expression) -> Expression | NoReturn:
+        # "[index]" and "[index] = value" after a factor
         item_of_list = None
-        if tokens[0].type == TokenType.SUBSCRIPT_LEFT:
+        if tokens.peek().type == TokenType.SUBSCRIPT_LEFT:
             self.eat(tokens)  # eat TokenType.SUBSCRIPT_LEFT
             index = self.parse_join_expression(tokens)
             self.eat(tokens, TokenType.SUBSCRIPT_RIGHT)
@@ -367,27 +516,31 @@ class Parser:
                 left = FunctionCall('data_itemoflist', list(item_of_list))
             else:
                 left = FunctionCall('operator_letter_of', [left, index])
-        if tokens[0].type == TokenType.ASSIGNMENT:
+        if tokens.peek().type == TokenType.ASSIGNMENT:
             if not item_of_list:
                 raise_error(Error('Parse', 'Cannot set item of non-array'))
             if self.eat(tokens).value != '=':
-                raise_error(Error('Parse', f'Unexpected token "{tokens[0].desc}", expected "=" after array set item'))
+                raise_error(Error('Parse', f'Unexpected token "{tokens.peek().desc}", expected "=" after array set item'))
             expression = self.parse_join_expression(tokens)
             left = FunctionCall('data_replaceitemoflist', list([*item_of_list, expression]))
         return left
 
-    def parse_factor(self, tokens: list[Token]) -> Expression:
-        assert self.record is not None
-
+    def parse_sign(self, tokens: TokenCursor) -> tuple[int, bool]:
         multiplier = 1
         has_sign = False
-        while tokens[0].type == TokenType.OPERATOR and tokens[0].value in ['+', '-']:
+        while tokens.peek().type == TokenType.OPERATOR and tokens.peek().value in ['+', '-']:
             has_sign = True
             if self.eat(tokens).value == '-':
                 multiplier *= -1
+        return multiplier, has_sign
+
+    def parse_factor(self, tokens: TokenCursor, multiplier: int = 1, has_sign: bool = False) -> Expression:
+        # The parens are parsed by parse_join_expression
+        assert self.record is not None
+
         factor: Expression | None = None
 
-        if tokens[0].type == TokenType.INTEGER:
+        if tokens.peek().type == TokenType.INTEGER:
             value = self.eat(tokens).value  # eat TokenType.INTEGER
             base = 10
             if value.startswith('0') and value != '0':
@@ -403,7 +556,7 @@ class Parser:
             factor = Number(int(value, base) * multiplier)
             multiplier = 1
             has_sign = False
-        elif tokens[0].type == TokenType.FLOAT:
+        elif tokens.peek().type == TokenType.FLOAT:
             value = self.eat(tokens).value  # eat TokenType.FLOAT
             if value.endswith('.'):
                 value += '0'
@@ -412,76 +565,70 @@ class Parser:
             factor = Number(float(value) * multiplier)
             multiplier = 1
             has_sign = False
-        elif tokens[0].type == TokenType.LEFT_PAREN:
-            self.eat(tokens)  # eat TokenType.LEFT_PAREN
-            expression = self.parse_join_expression(tokens)
-            self.eat(tokens, TokenType.RIGHT_PAREN)
-            factor = expression
-        elif tokens[0].type == TokenType.SUBSCRIPT_LEFT:
+        elif tokens.peek().type == TokenType.SUBSCRIPT_LEFT:
             return self.parse_array(tokens)
-        elif tokens[0].type == TokenType.STRING:
+        elif tokens.peek().type == TokenType.STRING:
             factor = String(self.eat(tokens).value)  # eat TokenType.STRING
-        elif len(tokens) >= 2 and tokens[0].type == TokenType.IDENTIFIER and tokens[1].type == TokenType.LEFT_PAREN:
+        elif tokens.peek().type == TokenType.IDENTIFIER and tokens.peek(1).type == TokenType.LEFT_PAREN:
             factor = self.parse_function_call(tokens)
-        elif tokens[0].type == TokenType.IDENTIFIER:
+        elif tokens.peek().type == TokenType.IDENTIFIER:
             factor = self.parse_identifier(tokens)
-        elif tokens[0].type == TokenType.KEYWORD and tokens[0].value == 'if':
+        elif tokens.peek().type == TokenType.KEYWORD and tokens.peek().value == 'if':
             factor = self.parse_if_expression_join(tokens)
         else:  # No any factor found
-            raise_error(Error('Parse', f'Unexpected token "{tokens[0].desc}", expected a factor'))
+            raise_error(Error('Parse', f'Unexpected token "{tokens.peek().desc}", expected a factor'))
         
-        if not has_sign:
-            return factor
-        return FunctionCall('operator_' + sign_to_english['*'], [factor, Number(multiplier)])
+        assert factor is not None
+        return apply_sign(factor, multiplier, has_sign)
 
-    def parse_function_call(self, tokens: list[Token]) -> FunctionCall:
+    def parse_function_call(self, tokens: TokenCursor) -> FunctionCall:
         name = self.parse_identifier(tokens).name
         params = []
         self.eat(tokens, TokenType.LEFT_PAREN)
-        if tokens[0].type != TokenType.RIGHT_PAREN:
+        if tokens.peek().type != TokenType.RIGHT_PAREN:
             params.append(self.parse_join_expression(tokens))
-            while tokens[0].type == TokenType.COMMA:
+            while tokens.peek().type == TokenType.COMMA:
                 self.eat(tokens)  # eat TokenType.COMMA   
                 params.append(self.parse_join_expression(tokens))
         self.eat(tokens, TokenType.RIGHT_PAREN)
         return FunctionCall(name, list(params), always_builtin=False)
 
-    def parse_identifier(self, tokens: list[Token]) -> Identifier:
+    def parse_identifier(self, tokens: TokenCursor) -> Identifier:
         assert self.record is not None
 
-        if tokens[0].type == TokenType.IDENTIFIER:
+        if tokens.peek().type == TokenType.IDENTIFIER:
             name = self.eat(tokens).value
             variable = self.record.resolve(name)
             if isinstance(variable, VariableDeclaration) and variable.is_array:
                 return ListIdentifier(name)
             return Identifier(name)
-        raise_error(Error('Parse', f'Unexpected token "{tokens[0].desc}", expected an identifier (letters, "_", or numbers (not start))'))
+        raise_error(Error('Parse', f'Unexpected token "{tokens.peek().desc}", expected an identifier (letters, "_", or numbers (not start))'))
 
-    def parse_array(self, tokens: list[Token]) -> ListIdentifier:
+    def parse_array(self, tokens: TokenCursor) -> ListIdentifier:
         assert self.record is not None
 
         name = ListIdentifier('')
-        name.name = generate_id(('array', 'literal', name))
+        name.name = generate_name(('array', 'literal', name))
         self.eat(tokens, TokenType.SUBSCRIPT_LEFT)
         self.record.block.append(self.record.variable_declaration(name.name, False, True))
         self.record.block.append(FunctionCall('data_deletealloflist', [name]))
-        if tokens[0].type != TokenType.SUBSCRIPT_RIGHT:
-            if tokens[0].type == TokenType.KEYWORD:
+        if tokens.peek().type != TokenType.SUBSCRIPT_RIGHT:
+            if tokens.peek().type == TokenType.KEYWORD:
                 name = self._parse_array_comprehension(tokens, name)
             else:
                 self.record.block.append(FunctionCall('data_addtolist', [name, self.parse_join_expression(tokens)]))
-                while tokens[0].type == TokenType.COMMA:
+                while tokens.peek().type == TokenType.COMMA:
                     self.eat(tokens)  # eat TokenType.COMMA
                     self.record.block.append(FunctionCall('data_addtolist', [name, self.parse_join_expression(tokens)]))
         self.eat(tokens, TokenType.SUBSCRIPT_RIGHT)
         return name
 
-    def _parse_array_comprehension(self, tokens: list[Token], name: ListIdentifier) -> ListIdentifier:
+    def _parse_array_comprehension(self, tokens: TokenCursor, name: ListIdentifier) -> ListIdentifier:
         assert self.record is not None
 
         # Example: [for (i = arr) if (i % 2 == 0) (i)]
         elements: COMPREHENSION_ELEMENTS_TYPE = []
-        while tokens[0].type == TokenType.KEYWORD:
+        while tokens.peek().type == TokenType.KEYWORD:
             token = self.eat(tokens)  # eat TokenType.KEYWORD
             self.eat(tokens, TokenType.LEFT_PAREN)
             if token.value == 'if':
@@ -489,7 +636,7 @@ class Parser:
                 elements.append(('if', condition))
             elif token.value == 'for':
                 var = self.parse_identifier(tokens)
-                index = Identifier(generate_id(('for_each', var)))
+                index = Identifier(generate_name(('for_each', var)))
                 assignment = self.eat(tokens, TokenType.ASSIGNMENT)
                 if assignment.value != '=':
                     raise_error(Error('Parse', f'Unexpected token "{assignment.desc}", expected "="'))
@@ -523,30 +670,30 @@ class Parser:
         self.record.block.append(poly_concat_blocks(Block(list(declarations)), Block(body)))
         return name
 
-    def parse_assignment(self, tokens: list[Token]) -> FunctionCall | VariableDeclaration | list[Statement] | Block | NoReturn:
+    def parse_assignment(self, tokens: TokenCursor) -> FunctionCall | VariableDeclaration | list[Statement] | Block | NoReturn:
         assert self.record is not None
         
         is_declare = False
-        if tokens[0].type == TokenType.KEYWORD:
-            if tokens[0].value in ['const', 'var', 'array']:
+        if tokens.peek().type == TokenType.KEYWORD:
+            if tokens.peek().value in ['const', 'var', 'array']:
                 is_declare = True
-                is_const = tokens[0].value == 'const'
-                is_array = tokens[0].value == 'array'
+                is_const = tokens.peek().value == 'const'
+                is_array = tokens.peek().value == 'array'
                 self.eat(tokens)  # eat TokenType.KEYWORD
             else:
-                raise_error(Error('Parse', f'Unexpected token "{tokens[0].desc}", expected "var", "const", "array" or an identifier'))
+                raise_error(Error('Parse', f'Unexpected token "{tokens.peek().desc}", expected "var", "const", "array" or an identifier'))
         identifier = self.parse_identifier(tokens)
-        if tokens[0].type != TokenType.ASSIGNMENT:  # No assignment
+        if tokens.peek().type != TokenType.ASSIGNMENT:  # No assignment
             if not is_declare:
                 # Example: NOT_DECLARED = 1;
-                raise_error(Error('Parse', f'Unexpected token "{tokens[0].desc}", expected an assignment or a variable declaration'))
+                raise_error(Error('Parse', f'Unexpected token "{tokens.peek().desc}", expected an assignment or a variable declaration'))
             if is_const:
                 # Example: const SOME_CONST;
-                raise_error(Error('Parse', f'Unexpected token "{tokens[0].desc}", expected an assignment on a constant variable'))
+                raise_error(Error('Parse', f'Unexpected token "{tokens.peek().desc}", expected an assignment on a constant variable'))
             # Example: var SOME_VAR;
             return self.record.variable_declaration(identifier.name, False, is_array)
-        if is_declare and tokens[0].value != '=':
-            raise_error(Error('Parse', f'Unexpected token "{tokens[0].desc}", expected "=" after variable declaration'))
+        if is_declare and tokens.peek().value != '=':
+            raise_error(Error('Parse', f'Unexpected token "{tokens.peek().desc}", expected "=" after variable declaration'))
         assignment_node = self.eat(tokens)  # eat TokenType.ASSIGNMENT
         expression = self.parse_join_expression(tokens)
         self.eat(tokens, TokenType.STATEMENT_END)
@@ -555,7 +702,7 @@ class Parser:
         if assignment_node.value == '=':
             if isinstance(expression, ListIdentifier):
                 with self.new_record(Block):
-                    index = Identifier(generate_id(('array', 'index', identifier)))
+                    index = Identifier(generate_name(('array', 'index', identifier)))
                     assignment = Block(
                         [
                             self.record.variable_declaration(index.name, False, False),
@@ -566,7 +713,7 @@ class Parser:
                 assignment = FunctionCall('data_setvariableto', [identifier, expression])
         elif assignment_node.value == '+=':
             if isinstance(expression, ListIdentifier):
-                index = Identifier(generate_id(('array', 'index', identifier)))
+                index = Identifier(generate_name(('array', 'index', identifier)))
                 assignment = Block([
                     self.record.variable_declaration(index.name, False, False),
                     # Only no "FunctionCall('data_deletealloflist', [identifier]),"
@@ -597,20 +744,20 @@ class Parser:
             assignment  # SOME_VAR = 1;
         ]
 
-    def parse_if_statement(self, tokens: list[Token]) -> FunctionCall:
+    def parse_if_statement(self, tokens: TokenCursor) -> FunctionCall:
         self.eat(tokens)  # eat TokenType.KEYWORD
         self.eat(tokens, TokenType.LEFT_PAREN)
         condition = self.parse_and_expression(tokens)
         self.eat(tokens, TokenType.RIGHT_PAREN)
         sub_stack = Block(self.parse_statement(tokens))
-        if tokens[0].type == TokenType.KEYWORD:
-            if tokens[0].value == 'else':
+        if tokens.peek().type == TokenType.KEYWORD:
+            if tokens.peek().value == 'else':
                 self.eat(tokens)  # eat TokenType.KEYWORD
                 sub_stack2 = Block(self.parse_statement(tokens))
                 return FunctionCall('control_if_else', [condition, sub_stack, sub_stack2])
         return FunctionCall('control_if', [condition, sub_stack])
 
-    def _parse_if_expression(self, tokens: list[Token], next_level: Callable[[list[Token]], Expression]) -> Identifier:
+    def _parse_if_expression(self, tokens: TokenCursor, next_level: Callable[[TokenCursor], Expression]) -> Identifier:
         assert self.record
 
         self.eat(tokens)  # eat TokenType.KEYWORD
@@ -620,7 +767,7 @@ class Parser:
         with self.new_record(Block) as sub_stack:
             value1 = next_level(tokens)
         if self.eat(tokens, TokenType.KEYWORD).value != 'else':
-            raise_error(Error('Parse', f'Unexpected token "{tokens[0].desc}", expected "else" after if expression'))
+            raise_error(Error('Parse', f'Unexpected token "{tokens.peek().desc}", expected "else" after if expression'))
         with self.new_record(Block) as sub_stack2:
             value2 = next_level(tokens)
         
@@ -630,9 +777,9 @@ class Parser:
         result: Identifier
         if is_array:
             result = ListIdentifier('')
-            result.name = generate_id(('if_expression', result))
+            result.name = generate_name(('if_expression', result))
             index = Identifier('')
-            index.name = generate_id(('array', 'if_expression', result))
+            index.name = generate_name(('array', 'if_expression', result))
             self.record.block.extend([
                 self.record.variable_declaration(result.name, False, True),
                 self.record.variable_declaration(index.name, False, False)
@@ -641,7 +788,7 @@ class Parser:
             sub_stack2.body.append(Block(poly_copy_list(from_=value2, to=result, index=index)))
         else:
             result = Identifier('')
-            result.name = generate_id(('if_expression', result))
+            result.name = generate_name(('if_expression', result))
             self.record.block.append(
                 self.record.variable_declaration(result.name, False, False)
             )
@@ -651,13 +798,13 @@ class Parser:
         self.record.block.append(FunctionCall('control_if_else', [condition, sub_stack, sub_stack2]))
         return result
 
-    def parse_if_expression_join(self, tokens: list[Token]) -> Identifier:
+    def parse_if_expression_join(self, tokens: TokenCursor) -> Identifier:
         return self._parse_if_expression(tokens, self.parse_join_expression)
     
-    def parse_if_expression_and(self, tokens: list[Token]) -> Identifier:
+    def parse_if_expression_and(self, tokens: TokenCursor) -> Identifier:
         return self._parse_if_expression(tokens, self.parse_and_expression)
 
-    def parse_repeat_statement(self, tokens: list[Token]) -> Block:
+    def parse_repeat_statement(self, tokens: TokenCursor) -> Block:
         mode = self.eat(tokens).value  # eat TokenType.KEYWORD, "while" or "until"
         self.eat(tokens, TokenType.LEFT_PAREN)
         with self.new_record(Block) as condition_record:
@@ -666,8 +813,10 @@ class Parser:
             condition = FunctionCall('operator_' + sign_to_english['!'], [condition])
         self.eat(tokens, TokenType.RIGHT_PAREN)
         sub_stack = Block(self.parse_statement(tokens))
+        # The statements of the condition run before the loop and at the end of each iteration,
+        # the nodes are shared (the interpreter gives each use its own blocks)
         return poly_concat_blocks(
-            copy.deepcopy(condition_record),
+            condition_record,
             Block(
                 FunctionCall('control_repeat_until', [condition, poly_concat_blocks(
                     sub_stack,
@@ -676,18 +825,18 @@ class Parser:
             )
         )
 
-    def parse_function_declaration(self, tokens: list[Token]) -> FunctionDeclaration:
+    def parse_function_declaration(self, tokens: TokenCursor) -> FunctionDeclaration:
         assert self.record
 
         attributes = set()
         def parse_attributes() -> set[str]:
             result = set()
-            if tokens[0].type == TokenType.KEYWORD \
-                   and tokens[0].value == 'attribute':
+            if tokens.peek().type == TokenType.KEYWORD \
+                   and tokens.peek().value == 'attribute':
                 self.eat(tokens)  # eat TokenType.KEYWORD
                 self.eat(tokens, TokenType.LEFT_PAREN)  # must have least 1 attribute
                 result.add(self.parse_identifier(tokens).name)
-                while tokens[0].type == TokenType.COMMA:
+                while tokens.peek().type == TokenType.COMMA:
                     self.eat(tokens)  # eat TokenType.COMMA
                     result.add(self.parse_identifier(tokens).name)
                 self.eat(tokens, TokenType.RIGHT_PAREN)
@@ -702,10 +851,10 @@ class Parser:
             attributes |= parse_attributes()
             self.eat(tokens, TokenType.LEFT_PAREN)
             params = []
-            if tokens[0].type != TokenType.RIGHT_PAREN:
+            if tokens.peek().type != TokenType.RIGHT_PAREN:
                 params.append(self.parse_identifier(tokens).name)
                 self.record.variable_declaration(params[-1], False, False)
-                while tokens[0].type == TokenType.COMMA:
+                while tokens.peek().type == TokenType.COMMA:
                     self.eat(tokens)  # eat TokenType.COMMA
                     params.append(self.parse_identifier(tokens).name)
                     self.record.variable_declaration(params[-1], False, False)
@@ -714,12 +863,12 @@ class Parser:
             sub_stack = Block(self.parse_statement(tokens))
         return FunctionDeclaration(name, params, sub_stack, list(attributes))
 
-    def parse_clone_statement(self, tokens: list[Token]) -> Clone:
+    def parse_clone_statement(self, tokens: TokenCursor) -> Clone:
         self.eat(tokens)  # eat TokenType.KEYWORD
         clone = Block(self.parse_statement(tokens))
         return Clone(clone)
 
-    def parse_delete(self, tokens: list[Token]) -> FunctionCall:
+    def parse_delete(self, tokens: TokenCursor) -> FunctionCall:
         self.eat(tokens)  # eat TokenType.KEYWORD
         name = self.parse_identifier(tokens)
         if not isinstance(name, ListIdentifier):
@@ -729,13 +878,13 @@ class Parser:
         self.eat(tokens, TokenType.SUBSCRIPT_RIGHT)
         return FunctionCall('data_deleteoflist', [name, index])
 
-    def parse_for_statement(self, tokens: list[Token]) -> Block:
+    def parse_for_statement(self, tokens: TokenCursor) -> Block:
         assert self.record is not None
 
         self.eat(tokens)  # eat TokenType.KEYWORD
         self.eat(tokens, TokenType.LEFT_PAREN)
         var = self.parse_identifier(tokens)
-        index = Identifier(generate_id(('for_each', var)))
+        index = Identifier(generate_name(('for_each', var)))
         assignment = self.eat(tokens, TokenType.ASSIGNMENT)
         if assignment.value != '=':
             raise_error(Error('Parse', f'Unexpected token "{assignment.desc}", expected "="'))
@@ -0,0 +1,128 @@
+# *-* encoding: utf-8 *-*
+"""
+Copyright (c) Copyright 2024 Scratch-Language Developers
+https://github.com/IsBenben/Scratch-Language
+License under the Apache License, version 2.0
+"""
+
+# The optimization passes, in the order they run:
+# the passes of the program (on the syntax tree, before the interpreter) run again and again until nothing changes,
+# because a pass may make something possible for another one; then the same for the passes of the project (on the blocks)
+# Every pass can be enabled or disabled by its name (see --passes), and the time and the rewrites of it are counted
+
+from allocate import SlotAllocator
+from copies import CopyElider
+from cse import CommonSubexpressionEliminator
+from dataclasses import dataclass
+from inline import Inliner
+from loops import LoopOptimizer
+from nodes import NodeTransformer, Program
+from optimize import ConstantPropagator, DeadCodeEliminator, Optimizer
+from peephole import PeepholeOptimizer
+from typing import Any, Callable, Literal
+from utils import get_args
+from warp import WarpInference
+import time
+
+@dataclass
+class Pass:
+    name: str
+    stage: Literal['program', 'project']
+    # Returns the result (a new program, or the same one if nothing changes) and the number of the rewrites
+    run: Callable[[Any], tuple[Any, int]]
+    description: str
+
+@dataclass
+class PassStatistics:
+    runs: int = 0
+    seconds: float = 0.0
+    rewrites: int = 0
+
+def transformer_pass(transformer: Callable[[], NodeTransformer]) -> Callable[[Program], tuple[Program, int]]:
+    def run(program: Program) -> tuple[Program, int]:
+        visitor = transformer()
+        result = visitor.visit(program)
+        return (program if result is None else result), visitor.rewrites
+    return run
+
+# A unit of the separate compilation keeps its top-level declarations, the main file may use them
+def dead_code_eliminator() -> DeadCodeEliminator:
+    return DeadCodeEliminator(exports=get_args().separate)
+
+def inliner() -> Inliner:
+    return Inliner(exports=get_args().separate)
+
+def copy_elider() -> CopyElider:
+    return CopyElider(exports=get_args().separate)
+
+def loop_optimizer() -> LoopOptimizer:
+    return LoopOptimizer(exports=get_args().separate)
+
+def optimize_peepholes(project: dict) -> tuple[dict, int]:
+    return project, PeepholeOptimizer(project).optimize()
+
+def allocate_slots(project: dict) -> tuple[dict, int]:
+    return project, SlotAllocator(project).allocate()
+
+PASSES: list[Pass] = [
+    Pass('constants', 'program', transformer_pass(ConstantPropagator), 'Replace the constants known at compile time with their values'),
+    Pass('fold', 'program', transformer_pass(Optimizer), 'Fold the constant operators and control blocks'),
+    Pass('warp', 'program', transformer_pass(WarpInference), 'Run the functions which never wait without screen refresh'),
+    Pass('inline', 'program', transformer_pass(inliner), 'Replace the calls of the small functions with their bodies'),
+    Pass('copies', 'program', transformer_pass(copy_elider), 'Make the temporary lists straight in the lists they are copied to'),
+    Pass('loops', 'program', transformer_pass(loop_optimizer), 'Unroll the counted loops, and hoist the invariant reporters out of the loops'),
+    Pass('cse', 'program', transformer_pass(CommonSubexpressionEliminator), 'Compute the reporters used again and again in a basic block once'),
+    Pass('dce', 'program', transformer_pass(dead_code_eliminator), 'Remove the functions never called, and the variables and lists never read'),
+    Pass('peephole', 'project', optimize_peepholes, 'Rewrite the small patterns of the emitted blocks'),
+    Pass('slots', 'project', allocate_slots, 'Share the variables and lists which are never live at the same time'),
+]
+
+class PassManager:
+    def __init__(self, max_iterations: int = 8):
+        self.enabled = {item.name for item in PASSES}
+        self.max_iterations = max_iterations  # Of each stage, then it stops even if something still changes
+        self.statistics = {item.name: PassStatistics() for item in PASSES}
+        self.iterations = {'program': 0, 'project': 0}
+
+    @property
+    def key(self) -> str:
+        # The enabled passes, for the caches
+        return ','.join(item.name for item in PASSES if item.name in self.enabled)
+
+    def run(self, stage: Literal['program', 'project'], target: Any) -> Any:
+        passes = [item for item in PASSES if item.stage == stage and item.name in self.enabled]
+        for _ in range(self.max_iterations if passes else 0):
+            self.iterations[stage] += 1
+            changed = False
+            for item in passes:
+                start = time.perf_counter()
+                result, rewrites = item.run(target)
+                statistics = self.statistics[item.name]
+                statistics.runs += 1
+                statistics.seconds += time.perf_counter() - start
+                statistics.rewrites += rewrites
+                if result is not target or rewrites:
+                    changed = True
+                target = result
+            if not changed:
+                break
+        return target
+
+    def run_program(self, program: Program) -> Program:
+        return self.run('program', program)
+
+    def run_project(self, project: dict) -> None:
+        self.run('project', project)
+
+    def report(self) -> str:
+        lines = [f'{"pass":<12}{"stage":<10}{"runs":>6}{"time (ms)":>12}{"rewrites":>10}']
+        for item in PASSES:
+            if item.name not in self.enabled:
+                continue
+            statistics = self.statistics[item.name]
+            lines.append(f'{item.name:<12}{item.stage:<10}{statistics.runs:>6}'
+                         f'{statistics.seconds * 1000:>12.2f}{statistics.rewrites:>10}')
+        lines.append(f'iterations: {self.iterations["program"]} (program), {self.iterations["project"]} (project)')
+        return '\n'.join(lines) + '\n'
+
+pass_manager = PassManager()
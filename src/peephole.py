@@ -0,0 +1,120 @@
+# *-* encoding: utf-8 *-*
+"""
+Copyright (c) Copyright 2024 Scratch-Language Developers
+https://github.com/IsBenben/Scratch-Language
+License under the Apache License, version 2.0
+"""
+
+# Peephole optimization (runs on the emitted project):
+# small patterns of the blocks which the syntax tree cannot show (they come from the lowering) are rewritten:
+#   set VAR to (literal); change VAR by (literal) -> set VAR to (the sum)
+#   set VAR to (...); set VAR to (... without VAR) -> the second one only
+#   delete all of LIST; delete all of LIST -> the first one only
+#   if <...> then (nothing), if <...> then (nothing) else (nothing) -> nothing (the reporters do nothing else)
+#   if <...> then (...) else (nothing) -> if <...> then (...)
+# A removed block is unlinked (its "parent" and "next" are linked to each other), and its reporters are removed too
+
+from cast import to_number
+import math
+
+# The literals in the inputs: [1, [type, value]] (a number, or a text)
+LITERAL_TYPES = (4, 5, 6, 7, 8, 10)
+
+def literal(value: list) -> float | str | None:
+    if value[0] == 1 and isinstance(value[1], list) and value[1][0] in LITERAL_TYPES:
+        return value[1][1] if isinstance(value[1][1], str) else float(value[1][1])
+    return None
+
+class PeepholeOptimizer:
+    def __init__(self, project: dict):
+        self.blocks: dict[str, dict] = project['targets'][1]['blocks']
+        self.rewrites = 0
+
+    def optimize(self) -> int:
+        # Rewrite until nothing matches, and return the number of the rewrites
+        changed = True
+        while changed:
+            changed = False
+            for block_id in list(self.blocks):
+                if block_id in self.blocks and self.rewrite(block_id):
+                    self.rewrites += 1
+                    changed = True
+        return self.rewrites
+
+    def rewrite(self, block_id: str) -> bool:
+        block = self.blocks[block_id]
+        opcode = block['opcode']
+        inputs = block['inputs']
+        following = self.blocks[block['next']] if block['next'] is not None else None
+        if opcode == 'data_setvariableto' and following is not None \
+                and following['fields'].get('VARIABLE') == block['fields']['VARIABLE']:
+            variable_id = block['fields']['VARIABLE'][1]
+            if following['opcode'] == 'data_changevariableby':
+                value, change = literal(inputs['VALUE']), literal(following['inputs']['VALUE'])
+                if value is None or change is None:
+                    return False
+                result = to_number(value) + to_number(change)
+                if not math.isfinite(result):
+                    return False
+                # Like the numbers emitted by Interpreter
+                inputs['VALUE'] = [1, [4, int(result) if result.is_integer() else result]]
+                return self.remove(block['next'])
+            if following['opcode'] == 'data_setvariableto' and variable_id not in self.references(following['inputs']['VALUE']):
+                return self.remove(block_id)
+        if opcode == 'data_deletealloflist' and following is not None and following['opcode'] == opcode \
+                and following['fields']['LIST'] == block['fields']['LIST']:
+            return self.remove(block['next'])
+        if opcode in ('control_if', 'control_if_else') and self.is_empty(inputs, 'SUBSTACK2'):
+            if self.is_empty(inputs, 'SUBSTACK'):
+                return self.remove(block_id)
+            if opcode == 'control_if_else':
+                block['opcode'] = 'control_if'
+                inputs.pop('SUBSTACK2', None)
+                return True
+        return False
+
+    def is_empty(self, inputs: dict, name: str) -> bool:
+        return inputs.get(name, [2, None])[1] is None
+
+    def references(self, value: list) -> set[str]:
+        # The variables and the lists read by an input (and its reporters)
+        result: set[str] = set()
+        stack = [value]
+        while stack:
+            for item in stack.pop()[1:]:
+                if isinstance(item, list) and item[0] in (12, 13):
+                    result.add(item[2])
+                elif isinstance(item, str) and item in self.blocks:
+                    reporter = self.blocks[item]
+                    result.update(field[1] for name, field in reporter['fields'].items() if name in ('VARIABLE', 'LIST'))
+                    stack.extend(reporter['inputs'].values())
+        return result
+
+    def remove(self, block_id: str) -> bool:
+        # Unlink the block from its stack, then remove it with its reporters (and its substacks)
+        block = self.blocks[block_id]
+        parent_id, next_id = block['parent'], block['next']
+        if parent_id is None:
+            # The first block of a script without a hat, it is never emitted
+            return False
+        parent = self.blocks[parent_id]
+        if next_id is not None:
+            self.blocks[next_id]['parent'] = parent_id
+        if parent['next'] == block_id:
+            parent['next'] = next_id
+        else:
+            # The first block of a substack
+            for name, value in list(parent['inputs'].items()):
+                if value[1] == block_id:
+                    if next_id is None:
+                        del parent['inputs'][name]
+                    else:
+                        value[1] = next_id
+        stack = [block_id]
+        while stack:
+            removed = self.blocks.pop(stack.pop())
+            for value in removed['inputs'].values():
+                stack += [item for item in value[1:] if isinstance(item, str) and item in self.blocks]
+            if removed is not block and removed['next'] is not None:
+                stack.append(removed['next'])
+        return True
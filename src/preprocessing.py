@@ -5,54 +5,325 @@ https://github.com/IsBenben/Scratch-Language
 License under the Apache License, version 2.0
 """
 
+from __future__ import annotations
 from dataclasses import dataclass
-from tokens import Token, TokenType, tokenize
+from tokens import Token, TokenLike, TokenType, iter_tokens, iter_tokens_range
 from error import Error, raise_error
+from typing import Iterable, Iterator, TextIO
+import hashlib
+import io
 import os
+import pickle
+import re
 
 folder = os.path.dirname(__file__)
 HEADER_PATH = os.path.join(folder, '../includes')
+CACHE_PATH = os.path.join(folder, '../.cache/includes')
+CACHE_VERSION = 3  # Change it when the cached data changes
 
 @dataclass
 class Define:
-    tokens: list[Token]
+    tokens: list[TokenLike]
     params: list[str] | None = None
 
-def preprocess(tokens: str | list[Token], relative_path: str = os.getcwd()) -> list[Token]:
-    if isinstance(tokens, str):
-        tokens = tokenize(tokens)
-
-    def list_split(seq: list[Token]):
-        result: list[list[Token]] = []
-        if not seq:
-            return result
-        lineno: int | None = 0
-        for ele in seq:
-            if ele.lineno != lineno:
-                result.append([])
-                lineno = ele.lineno
-            assert len(result) > 0 and isinstance(result[-1], list)
-            result[-1].append(ele)
-        return result
-    
-    def list_find_from_back(seq: list[Token], token_type: TokenType) -> tuple[int, Token] | tuple[None, None]:
-        for i, ele in reversed(list(enumerate(seq))):
-            if ele.type == token_type:
-                return i, ele
-        return None, None
+def iter_lines(tokens: Iterable[TokenLike]) -> Iterator[list[TokenLike]]:
+    line: list[TokenLike] = []
+    lineno: int | None = 0
+    for token in tokens:
+        if token.lineno != lineno:
+            if line:
+                yield line
+            line = []
+            lineno = token.lineno
+        line.append(token)
+    if line:
+        yield line
+
+def list_find_from_back(seq: list[TokenLike], token_type: TokenType) -> tuple[int, TokenLike] | tuple[None, None]:
+    for i, ele in reversed(list(enumerate(seq))):
+        if ele.type == token_type:
+            return i, ele
+    return None, None
+
+def define_syntax(line: list[TokenLike]) -> tuple[int, list[str] | None] | None:
+    # "line" is "#define ..." without the statement end
+    # Return the index of the name and the params, return None if the syntax invalid
+    def test_3():
+        # Test of "#define value identifier(param1, param2, ...)"
+        # Return the index of left paren, return -1 if the syntax invalid
+        i, _ = list_find_from_back(line, TokenType.LEFT_PAREN)
+        if i is None:
+            return -1
+        # ? What is the compare
+        result = len(line) >= 7 \
+                     and line[-1].type == TokenType.RIGHT_PAREN \
+                     and 4 <= i <= len(line) - 2 \
+                     and all(map(lambda x: x.type == TokenType.COMMA, line[i+2:-1:2])) \
+                     and all(map(lambda x: x.type == TokenType.IDENTIFIER, line[i-1:-1:2]))
+        if result:
+            return i
+        return -1
+
+    if len(line) >= 4 and line[-1].type == TokenType.IDENTIFIER:
+        # #define value identifier
+        return -1, None
+    elif len(line) >= 6 \
+             and line[-1].type == TokenType.RIGHT_PAREN \
+             and line[-2].type == TokenType.LEFT_PAREN \
+             and line[-3].type == TokenType.IDENTIFIER:
+        # #define value identifier()
+        return -3, []
+    elif test_3() != -1:
+        # #define value identifier(param1, param2, ...)
+        ret = test_3()
+        return ret - 1, list(map(lambda x: x.value, line[ret+1:-1:2]))
+    return None
+
+def is_directive(line: list[TokenLike], *values: str) -> bool:
+    # Whether "line" is "#value1 value2 ...", with the statement end
+    return len(line) == len(values) + 2 \
+               and line[0].type == TokenType.PREPROCESSING \
+               and line[-1].type == TokenType.STATEMENT_END \
+               and all(token.type == TokenType.IDENTIFIER and token.value == value for token, value in zip(line[1:], values))
+
+# What the lexer sees as a whole (comments and strings), and the lines of conditional directives
+# Only the conditional directives are captured (with their comments), a line with a string after the directive is not split
+CONDITION_REGEX = re.compile(r'''(?s:/\*.*?\*/)|//[^\n\r]*|".*?"|(?P<condition>^[ \t]*\#[ \t]*(?:ifdef|ifndef|endif)\b'''
+                             r'''(?:[^\n/"]|/(?![/*])|(?s:/\*.*?\*/))*(?://[^\n]*)?(?:\n|\Z))''', re.MULTILINE)
+# A conditional directive which may be in a part not split (then the part is lexed, see TextLines.skip)
+DIRECTIVE_REGEX = re.compile(r'^[ \t]*\#[ \t]*(?:ifdef|ifndef|endif)\b', re.MULTILINE)
+PRAGMA_ONCE_REGEX = re.compile(r'^[ \t]*\#[ \t]*pragma[ \t]+once\b', re.MULTILINE)
+
+@dataclass
+class Part:
+    # code[start:end] of a source code: a line of "#ifdef", "#ifndef" or "#endif", or the lines between them
+    start: int
+    end: int
+    lineno: int
+    condition: bool  # It may have a conditional directive, so it's never skipped
+    lines: list[list[TokenLike]] | None = None  # Lexed when it is first read (only kept for the included files)
+
+def scan_parts(code: str) -> list[Part]:
+    # Split the code without lexing it, so a disabled region is never lexed
+    parts: list[Part] = []
+    start = 0
+    lineno = 1
+    for match in CONDITION_REGEX.finditer(code):
+        if match.group('condition') is None:
+            continue
+        if match.start() > start:
+            parts.append(Part(start, match.start(), lineno, uncaptured(code, start, match.start())))
+            lineno += code.count('\n', start, match.start())
+        parts.append(Part(match.start(), match.end(), lineno, True))
+        lineno += code.count('\n', match.start(), match.end())
+        start = match.end()
+    if start < len(code):
+        parts.append(Part(start, len(code), lineno, uncaptured(code, start, len(code))))
+    return parts
+
+def uncaptured(code: str, start: int, end: int) -> bool:
+    # Whether code[start:end] may have a conditional directive not captured (like "#endif" with a string after it)
+    return DIRECTIVE_REGEX.search(code, start, end) is not None
+
+class TextLines:
+    # Lines of a source code, a part is lexed when its first line is read
+    def __init__(self, code: str, parts: list[Part], include: Include | None = None, eof: bool = False):
+        self.code = code
+        self.parts = parts
+        self.include = include  # The lexed lines are kept in it
+        self.eof = eof  # Whether the EOF token is needed
+        self.index = 0
+        self.current: Iterator[list[TokenLike]] = iter(())
+
+    def __iter__(self) -> TextLines:
+        return self
+
+    def __next__(self) -> list[TokenLike]:
+        while True:
+            line = next(self.current, None)
+            if line is not None:
+                return line
+            if self.index > len(self.parts):
+                raise StopIteration
+            self.index += 1
+            if self.index > len(self.parts):
+                end: list[TokenLike] = [Token(TokenType.STATEMENT_END, 'end of file')]
+                if self.eof:
+                    end.append(Token(TokenType.EOF, 'end of file'))
+                return end
+            self.current = self.lex(self.parts[self.index - 1])
+
+    def lex(self, part: Part) -> Iterator[list[TokenLike]]:
+        if self.include is None:
+            return iter_lines(iter_tokens_range(self.code, part.start, part.end, part.lineno))
+        if part.lines is None:
+            part.lines = list(iter_lines(iter_tokens_range(self.code, part.start, part.end, part.lineno)))
+            self.include.saved = False
+        # The lines are copied, because the directives are changed when processed
+        return (list(line) for line in part.lines)
+
+    def skip(self) -> None:
+        # Skip to the next "#ifdef", "#ifndef" or "#endif", the lines are not lexed
+        self.current = iter(())
+        while self.index < len(self.parts) and not self.parts[self.index].condition:
+            self.index += 1
+
+@dataclass
+class Include:
+    # An included file, split into parts
+    digest: str
+    code: str
+    parts: list[Part]
+    once: bool  # "#pragma once" is found
+    # The defines of the file in order (name, params count, define, directive name token),
+    # or None if the file does not only define macros
+    defines: list[tuple[str, int, Define, TokenLike]] | None
+    saved: bool = True  # Whether the lexed parts are all saved to the disk
+
+def make_include(digest: str, code: str) -> Include:
+    parts = scan_parts(code)
+    once = PRAGMA_ONCE_REGEX.search(code) is not None
+    include = Include(digest, code, parts, once, None)
+    if any(part.condition for part in parts):
+        # The parts are lexed only if they are enabled
+        return include
+    lines = list(TextLines(code, parts, include))
+    defines: list[tuple[str, int, Define, TokenLike]] = []
+    seen: set[tuple[str, int]] = set()
+    for line in lines:
+        if is_directive(line, 'pragma', 'once') or all(token.type == TokenType.STATEMENT_END for token in line):
+            # Empty statements are not needed by the parser
+            continue
+        directive = line[:-1]
+        syntax = None
+        if len(line) >= 3 and line[-1].type == TokenType.STATEMENT_END \
+               and line[0].type == TokenType.PREPROCESSING and line[1].value == 'define':
+            syntax = define_syntax(directive)
+        if syntax is None:
+            return include
+        name, params = syntax
+        name_str = directive[name].value
+        params_count = -1 if params is None else len(params)
+        if (name_str, params_count) in seen:
+            # The error is reported when the lines are processed
+            return include
+        seen.add((name_str, params_count))
+        defines.append((name_str, params_count, Define(directive[2:name], params), line[1]))
+    include.defines = defines
+    return include
+
+class IncludeCache:
+    # Included files, keyed by the path, the modified time and the hash of the content
+    # The lexed parts are kept in memory, and also in "path" (unless it is None) for the later builds
+    def __init__(self, path: str | None = CACHE_PATH):
+        self.path = path
+        self.files: dict[str, tuple[int, int, Include]] = {}  # "str" means path, "int"s mean mtime and size
 
+    def get(self, path: str) -> Include:
+        stat = os.stat(path)
+        cached = self.files.get(path)
+        if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            return cached[2]
+        with open(path, 'rb') as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+        include: Include | None
+        if cached is not None and cached[2].digest == digest:
+            include = cached[2]
+        else:
+            include = self.load(digest)
+            if include is None:
+                # Same newlines as a file opened in text mode
+                code = content.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+                include = make_include(digest, code)
+                self.save(include)
+        self.files[path] = (stat.st_mtime_ns, stat.st_size, include)
+        return include
+
+    def load(self, digest: str) -> Include | None:
+        if self.path is None:
+            return None
+        try:
+            with open(os.path.join(self.path, digest + '.pickle'), 'rb') as f:
+                version, include = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError):
+            return None
+        if version != CACHE_VERSION or not isinstance(include, Include) or include.digest != digest:
+            return None
+        return include
+
+    def flush(self) -> None:
+        # Save the parts lexed by this build
+        for _, _, include in self.files.values():
+            if not include.saved:
+                self.save(include)
+
+    def save(self, include: Include) -> None:
+        include.saved = True
+        if self.path is None:
+            return None
+        file = os.path.join(self.path, include.digest + '.pickle')
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            # Written to another file first, so a reader never sees a half-written file
+            with open(f'{file}.{os.getpid()}', 'wb') as f:
+                pickle.dump((CACHE_VERSION, include), f)
+            os.replace(f'{file}.{os.getpid()}', file)
+        except OSError:
+            pass
+
+include_cache = IncludeCache()
+
+def preprocess(tokens: str | TextIO | Iterable[TokenLike], relative_path: str = os.getcwd(),
+               units: list[str] | None = None) -> Iterator[TokenLike]:
     # Unfold all preprocessing directives
-    
-    lines = list_split(tokens)
+    # Lines are read one by one, included files are read when the include directive is reached
+    # If "units" is a list, an included file with code is not unfolded, but its path is added to "units"
+    # (it is compiled on its own and linked, see linker.py), only the macros of a file are still unfolded
+    sources: list[Iterator[list[TokenLike]]]
+    if isinstance(tokens, str):
+        sources = [TextLines(tokens, scan_parts(tokens), eof=True)]
+    elif isinstance(tokens, io.IOBase):
+        # A file object is streamed, so its disabled regions are still lexed
+        sources = [iter_lines(iter_tokens(tokens))]  # type: ignore[arg-type]
+    else:
+        sources = [iter_lines(tokens)]  # type: ignore[arg-type]
+    lines: list[list[TokenLike]] = []  # The current line, and the lines looked ahead by a macro
+
+    def read_line() -> bool:
+        while sources:
+            if not if_result and isinstance(sources[-1], TextLines):
+                # A disabled region is not lexed
+                sources[-1].skip()
+            line = next(sources[-1], None)
+            if line is None:
+                sources.pop()
+                continue
+            lines.append(line)
+            return True
+        return False
+
     defines: dict[str, dict[int, Define]] = {}  # "str" means name, "int" means params count
+    included_once: set[str] = set()  # Files with "#pragma once" already included
+
+    def add_define(name_str: str, params_count: int, define: Define, directive_name: TokenLike) -> None:
+        overloads = defines.setdefault(name_str, {})
+        if params_count in overloads:
+            raise_error(Error('Preprocessing', f'"{name_str}" is already defined (in directive {directive_name.desc})'))
+        overloads[params_count] = define
+
     if_result = True
     if_cnt = 0
-    for i, line in enumerate(lines):
-        if not line:
-            continue
+    disabled_cnt = 0  # Conditions nested in a disabled region
+    while lines or read_line():
+        line = lines[0]
         if not if_result \
-               and (line[0].type != TokenType.PREPROCESSING or line[1].value != 'endif'):
-            line.clear()
+               and (line[0].type != TokenType.PREPROCESSING or line[1].value != 'endif' or disabled_cnt):
+            if line[0].type == TokenType.PREPROCESSING and line[1].value in ('ifdef', 'ifndef'):
+                disabled_cnt += 1
+            elif line[0].type == TokenType.PREPROCESSING and line[1].value == 'endif':
+                disabled_cnt -= 1
+            lines.pop(0)
             continue
         if line[0].type == TokenType.PREPROCESSING:
             if line[-1].type != TokenType.STATEMENT_END:
@@ -79,53 +350,34 @@ def preprocess(tokens: str | list[Token], relative_path: str = os.getcwd()) -> l
                 
                 if not os.path.exists(path):
                     raise_error(Error('Preprocessing', f'File "{path}" does not exist (in directive {line[1].desc})'))
-                with open(path, 'r', encoding='utf-8') as f:
-                    for line_inner in reversed(list_split(tokenize(f.read())[:-1])):
-                        lines.insert(i + 1, line_inner)
-            elif line[1].value == 'define':
-                def test_3():
-                    # Test of "#define value identifier(param1, param2, ...)"
-                    # Return the index of left paren, return -1 if the syntax invalid
-                    i, _ = list_find_from_back(line, TokenType.LEFT_PAREN)
-                    if i is None:
-                        return -1
-                    # ? What is the compare
-                    result = len(line) >= 7 \
-                                 and line[-1].type == TokenType.RIGHT_PAREN \
-                                 and 4 <= i <= len(line) - 2 \
-                                 and all(map(lambda x: x.type == TokenType.COMMA, line[i+2:-1:2])) \
-                                 and all(map(lambda x: x.type == TokenType.IDENTIFIER, line[i-1:-1:2]))
-                    if result:
-                        return i
-                    return -1
-
-                name = None
-                params = None
-                if len(line) >= 4 and line[-1].type == TokenType.IDENTIFIER:
-                    # #define value identifier
-                    name = -1
-                elif len(line) >= 6 \
-                         and line[-1].type == TokenType.RIGHT_PAREN \
-                         and line[-2].type == TokenType.LEFT_PAREN \
-                         and line[-3].type == TokenType.IDENTIFIER:
-                    # #define value identifier()
-                    name = -3
-                    params = []
-                elif test_3() != -1:
-                    # #define value identifier(param1, param2, ...)
-                    ret = test_3()
-                    name = ret - 1
-                    params = list(map(lambda x: x.value, line[ret+1:-1:2]))
+                path = os.path.realpath(path)
+                include = include_cache.get(path)
+                if include.once:
+                    if path in included_once:
+                        lines.pop(0)
+                        continue
+                    included_once.add(path)
+                if include.defines is not None:
+                    # The file only defines macros, so the lines are not processed again
+                    for name_str, params_count, define, directive_name in include.defines:
+                        add_define(name_str, params_count, define, directive_name)
+                elif units is not None:
+                    if path not in units:
+                        units.append(path)
                 else:
+                    # The included lines go before the lines already looked ahead
+                    if len(lines) > 1:
+                        sources.append(iter(lines[1:]))
+                        del lines[1:]
+                    sources.append(TextLines(include.code, include.parts, include))
+            elif line[1].value == 'define':
+                syntax = define_syntax(line)
+                if syntax is None:
                     raise_error(Error('Preprocessing', f'The syntax of directive "{line[1].desc}" is invalid'))
-                
-                assert name is not None
-                name_str = line[name].value
-                defines.setdefault(name_str, {})
+                assert syntax is not None
+                name, params = syntax
                 params_count = -1 if params is None else len(params)
-                if params_count in defines[name_str]:
-                    raise_error(Error('Preprocessing', f'"{name_str}" is already defined (in directive {line[1].desc})'))
-                defines[name_str][params_count] = Define(line[2:name], params) 
+                add_define(line[name].value, params_count, Define(line[2:name], params), line[1])
             elif line[1].value == 'undef':
                 # #undef identifier
                 if len(line) != 3 or line[2].type != TokenType.IDENTIFIER:
@@ -133,6 +385,11 @@ def preprocess(tokens: str | list[Token], relative_path: str = os.getcwd()) -> l
                 if line[2].value not in defines:
                     raise_error(Error('Preprocessing', f'"{line[2].desc}" is not defined (in directive {line[1].desc})'))
                 defines.pop(line[2].value)
+            elif line[1].value == 'pragma':
+                # #pragma once
+                # (handled when the file is included)
+                if len(line) != 3 or line[2].type != TokenType.IDENTIFIER or line[2].value != 'once':
+                    raise_error(Error('Preprocessing', f'The syntax of directive "{line[1].desc}" is invalid'))
             elif line[1].value == 'error':
                 # #error message
                 if len(line) != 3 or line[2].type != TokenType.STRING:
@@ -161,89 +418,77 @@ def preprocess(tokens: str | list[Token], relative_path: str = os.getcwd()) -> l
                 if_result = True
             else:
                 raise_error(Error('Preprocessing', f'Unknown directive "{line[1].desc}"'))
-            line.clear()
+            lines.pop(0)
             continue
 
-        for j, token in enumerate(line):
-            if token is None:
+        # Expand the macros in a single pass:
+        # "pending" is a stack of token iterators, the expansion of a macro is pushed onto it to be scanned again,
+        # and every token is written to "output" once
+        output: list[TokenLike] = []
+        pending: list[Iterator[TokenLike]] = [iter(line)]
+
+        def next_token(next_line: bool) -> TokenLike | None:
+            while True:
+                while pending:
+                    tk = next(pending[-1], None)
+                    if tk is not None:
+                        return tk
+                    pending.pop()
+                # A macro call may go on in the next lines
+                if not next_line or (len(lines) < 2 and not read_line()):
+                    return None
+                pending.append(iter(lines.pop(1)))
+
+        while (token := next_token(False)) is not None:
+            if token.type != TokenType.IDENTIFIER or token.value not in defines:
+                output.append(token)
                 continue
-            if token.type == TokenType.IDENTIFIER and token.value in defines:
-                line[j] = None  # type: ignore[assignment]
-                # Try to find the right paren
-                walk_i = i
-                walk_j = j
-                walk_tokens = [token]
-                walk_parens: list[Token] = []
-                walk_params: None | list[list[Token]] = None
+            args: list[list[TokenLike]] | None = None
+            tk = next_token(False)
+            if tk is None and (len(lines) >= 2 or read_line()) and lines[1][0].type == TokenType.LEFT_PAREN:
+                # The left paren is at the beginning of the next line
+                tk = next_token(True)
+            if tk is not None and tk.type == TokenType.LEFT_PAREN:
+                # Split the arguments by the outer commas
+                args = [[]]
+                depth = 1
                 while True:
-                    walk_j += 1
-                    while walk_j >= len(lines[walk_i]):
-                        walk_j = 0
-                        walk_i += 1
-                        if walk_i >= len(lines):
-                            if walk_parens:
-                                raise_error(Error('Preprocessing', f'Cannot find the right paren of "{line[j + 1].desc}"'))
-                            else:
-                                break
-                    tk = lines[walk_i][walk_j]
-                    walk_tokens.append(tk)
-                    add_to_params = True
-                    set_to_none = True
-                    if tk.type == TokenType.LEFT_PAREN:
-                        if walk_params is None:
-                            walk_params = [[]]
-                            add_to_params = False
-                        walk_parens.append(tk)
-                    elif tk.type == TokenType.RIGHT_PAREN:
-                        if walk_parens:
-                            walk_parens.pop()
-                        else:
-                            set_to_none = False
-                    elif tk.type == TokenType.COMMA:
-                        if walk_parens and len(walk_parens) == 1:
-                            # Outer paren
-                            assert walk_params is not None
-                            walk_params.append([])
-                            add_to_params = False
-                    elif not walk_parens:
-                        set_to_none = False
-                    
-                    if add_to_params:
-                        if walk_parens:
-                            assert walk_params is not None
-                            walk_params[-1].append(tk)
-                    if set_to_none:
-                        lines[walk_i][walk_j] = None  # type: ignore[assignment]
+                    arg_token = next_token(True)
+                    if arg_token is None:
+                        raise_error(Error('Preprocessing', f'Cannot find the right paren of "{tk.desc}"'))
+                    assert arg_token is not None
+                    if arg_token.type == TokenType.LEFT_PAREN:
+                        depth += 1
+                    elif arg_token.type == TokenType.RIGHT_PAREN:
+                        depth -= 1
+                        if depth == 0:
+                            break
+                    elif arg_token.type == TokenType.COMMA and depth == 1:
+                        args.append([])
+                        continue
+                    args[-1].append(arg_token)
+                if args == [[]]:
+                    # identifier()
+                    args.clear()
+            elif tk is not None:
+                pending.append(iter((tk,)))
+
+            params_count = -1 if args is None else len(args)
+            overloads = defines[token.value]
+            if params_count not in overloads:
+                raise_error(Error('Preprocessing', f'Cannot find {params_count} parameters overload of define "{token.desc}"'))
+            define = overloads[params_count]
+            if define.params and args:
+                param_indexes = {param: i for i, param in enumerate(define.params)}
+                expansion: list[TokenLike] = []
+                for token_inner in define.tokens:
+                    if token_inner.type == TokenType.IDENTIFIER and token_inner.value in param_indexes:
+                        expansion.extend(args[param_indexes[token_inner.value]])
                     else:
-                        walk_tokens.pop()
-                    
-                    if not walk_parens:
-                        if len(walk_tokens) >= 2:
-                            assert walk_params is not None
-                            if walk_params == [[]]:
-                                assert len(walk_tokens) == 3  # identifier()
-                                walk_params.clear()
-                        else:
-                            assert len(walk_tokens) == 1  # identifier
-                            walk_params = None
-                            walk_j -= 1  # This program run by this bug
-                        break
-                    
-                params_count = -1 if walk_params is None else len(walk_params)
-                overloads = defines[token.value]
-                if params_count not in overloads:
-                    raise_error(Error('Preprocessing', f'Cannot find {params_count} parameters overload of define "{token.desc}"'))
-                for token_inner in reversed(overloads[params_count].tokens):
-                    params = overloads[params_count].params  # type: ignore[assignment]
-                    if params:
-                        assert walk_params
-                        if token_inner.type == TokenType.IDENTIFIER and token_inner.value in params:
-                            param_index = params.index(token_inner.value)
-                            for token_inner_param in reversed(walk_params[param_index]):
-                                lines[walk_i].insert(walk_j + 1, token_inner_param)
-                            continue
-                    lines[walk_i].insert(walk_j + 1, token_inner)
-        while None in line:
-            line.remove(None)  # type: ignore
-    # Flat the list
-    return sum(lines, start=[])
+                        expansion.append(token_inner)
+                pending.append(iter(expansion))
+            else:
+                pending.append(iter(define.tokens))
+        yield from output
+        lines.pop(0)
+    include_cache.flush()
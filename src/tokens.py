@@ -5,10 +5,13 @@ https://github.com/IsBenben/Scratch-Language
 License under the Apache License, version 2.0
 """
 
+from __future__ import annotations
+from array import array
+from bisect import bisect_left, bisect_right
 from dataclasses import dataclass
 from enum import Enum, auto
 from error import Error, raise_error
-from typing import Optional
+from typing import Iterable, Iterator, Optional, Protocol, TextIO
 import re
 
 class TokenType(Enum):
@@ -63,6 +66,41 @@ TOKEN_REGEX = {
     for token_type, pattern in TOKEN_REGEX.items()
 }
 
+def _named_group(token_type: TokenType, pattern: re.Pattern | str) -> str:
+    # Flags of a pattern (for example DOTALL of comments) are scoped to its own group
+    if isinstance(pattern, str):
+        return f'(?P<{token_type.name}>{pattern})'
+    if pattern.flags & re.DOTALL:
+        return f'(?P<{token_type.name}>(?s:{pattern.pattern}))'
+    return f'(?P<{token_type.name}>{pattern.pattern})'
+
+# All patterns joined into one, so the lexer tries them in order with a single match call
+MASTER_REGEX = re.compile('|'.join(
+    _named_group(token_type, pattern)
+    for token_type, pattern in TOKEN_REGEX.items()
+))
+COMPARE_WORDS = frozenset(['in', 'contains'])
+KEYWORDS = frozenset(['const', 'var', 'if', 'else', 'while', 'until',
+                      'true', 'false', 'function', 'clone', 'array',
+                      'delete', 'for', 'attribute'])
+
+def describe(value: str, lineno: Optional[int]) -> str:
+    escaped = value.replace('\n', '\\n')
+    if lineno is None:
+        return escaped
+    return f'{escaped} (line {lineno})'
+
+class TokenLike(Protocol):
+    # Token, or a TokenView of a TokenBuffer
+    @property
+    def type(self) -> TokenType: ...
+    @property
+    def value(self) -> str: ...
+    @property
+    def lineno(self) -> Optional[int]: ...
+    @property
+    def desc(self) -> str: ...
+
 @dataclass
 class Token:
     type: TokenType
@@ -72,41 +110,258 @@ class Token:
 
     @property
     def desc(self):
-        escaped = self.value.replace('\n', '\\n')
-        if self.lineno is None:
-            return escaped
-        return f'{escaped} (line {self.lineno})'
+        return describe(self.value, self.lineno)
 
-def tokenize(code: str) -> list[Token]:
-    tokens = []
-    match: Optional[re.Match] = None
+def iter_tokens(source: str | TextIO) -> Iterator[Token]:
+    # A file object is read line by line,
+    # only a block comment may need more than one line to be matched
+    chunks: Iterator[str] = iter((source,)) if isinstance(source, str) else iter(source)
+    code = ''
+    # Scan by offset, the source code is never sliced
+    pos = 0
     lineno = 1
-    while code:
-        for token_type, pattern in TOKEN_REGEX.items():
-            match = re.match(pattern, code)
-            if not match:
-                continue
-            code = code[match.end():]
-            value = match.group()
-            old_lineno = lineno
-            lineno += value.count('\n')
-            if token_type == TokenType.COMMENT:
-                break
-            if token_type == TokenType.WHITE:
-                break
-            if token_type == TokenType.STRING:
-                value = value[1:-1]  # Remove the quotes
-            if token_type == TokenType.IDENTIFIER:
-                if value in ['in', 'contains']:
-                    token_type = TokenType.COMPARE
-                elif value in ['const', 'var', 'if', 'else', 'while', 'until',
-                               'true', 'false', 'function', 'clone', 'array',
-                               'delete', 'for', 'attribute']:
-                    token_type = TokenType.KEYWORD
-            tokens.append(Token(token_type, value, old_lineno))
+    more = True
+    match_at = MASTER_REGEX.match
+    while True:
+        if more and (pos >= len(code)
+                     or code.startswith('/*', pos) and code.find('*/', pos + 2) == -1):
+            chunk = next(chunks, None)
+            if chunk is None:
+                more = False
+            else:
+                code = code[pos:] + chunk
+                pos = 0
+            continue
+        if pos >= len(code):
             break
+        match = match_at(code, pos)
         if not match:
-            raise_error(Error('Tokenize', f'Invalid or unexpected token on "{code[:5]}"'))
-    tokens.append(Token(TokenType.STATEMENT_END, 'end of file'))
-    tokens.append(Token(TokenType.EOF, 'end of file'))
-    return tokens
+            raise_error(Error('Tokenize', f'Invalid or unexpected token on "{code[pos:pos + 5]}"'))
+        pos = match.end()
+        value = match.group()
+        old_lineno = lineno
+        lineno += value.count('\n')
+        # Every alternative is a named group, so "lastgroup" is never None
+        token_type = TokenType[match.lastgroup]  # type: ignore[misc]
+        if token_type == TokenType.COMMENT or token_type == TokenType.WHITE:
+            continue
+        if token_type == TokenType.STRING:
+            value = value[1:-1]  # Remove the quotes
+        elif token_type == TokenType.IDENTIFIER:
+            if value in COMPARE_WORDS:
+                token_type = TokenType.COMPARE
+            elif value in KEYWORDS:
+                token_type = TokenType.KEYWORD
+        yield Token(token_type, value, old_lineno)
+    yield Token(TokenType.STATEMENT_END, 'end of file')
+    yield Token(TokenType.EOF, 'end of file')
+
+def tokenize(code: str) -> list[Token]:
+    return list(iter_tokens(code))
+
+TOKEN_TYPES = tuple(TokenType)
+TOKEN_TYPE_INDEXES = {token_type.name: i for i, token_type in enumerate(TOKEN_TYPES)}
+STATEMENT_END_INDEX = TOKEN_TYPES.index(TokenType.STATEMENT_END)
+EOF_INDEX = TOKEN_TYPES.index(TokenType.EOF)
+IDENTIFIER_INDEX = TOKEN_TYPES.index(TokenType.IDENTIFIER)
+COMPARE_INDEX = TOKEN_TYPES.index(TokenType.COMPARE)
+KEYWORD_INDEX = TOKEN_TYPES.index(TokenType.KEYWORD)
+STRING_INDEX = TOKEN_TYPES.index(TokenType.STRING)
+SKIPPED_INDEXES = frozenset([TOKEN_TYPES.index(TokenType.COMMENT), TOKEN_TYPES.index(TokenType.WHITE)])
+
+def iter_spans(code: str, pos: int = 0, end: Optional[int] = None) -> Iterator[tuple[int, int, int]]:
+    # (type index, start, end) of every match in code[pos:end], the comments and white spaces included
+    if end is None:
+        end = len(code)
+    match_at = MASTER_REGEX.match
+    while pos < end:
+        match = match_at(code, pos, end)
+        if not match:
+            raise_error(Error('Tokenize', f'Invalid or unexpected token on "{code[pos:pos + 5]}"'))
+        start, pos = match.span()
+        type_index = TOKEN_TYPE_INDEXES[match.lastgroup]  # type: ignore[index]
+        if type_index == IDENTIFIER_INDEX:
+            value = code[start:pos]
+            if value in COMPARE_WORDS:
+                type_index = COMPARE_INDEX
+            elif value in KEYWORDS:
+                type_index = KEYWORD_INDEX
+        yield type_index, start, pos
+
+def iter_tokens_range(code: str, start: int, end: int, lineno: int = 1) -> Iterator[Token]:
+    # Tokens of code[start:end] (without the end of file tokens), "lineno" is the line number of "start"
+    for type_index, token_start, token_end in iter_spans(code, start, end):
+        old_lineno = lineno
+        lineno += code.count('\n', token_start, token_end)
+        if type_index in SKIPPED_INDEXES:
+            continue
+        if type_index == STRING_INDEX:
+            yield Token(TOKEN_TYPES[type_index], code[token_start + 1:token_end - 1], old_lineno)
+        else:
+            yield Token(TOKEN_TYPES[type_index], code[token_start:token_end], old_lineno)
+
+class TokenBuffer:
+    # Struct of arrays: the kinds, and the offsets into the source code
+    # The value and the line number of a token are only computed when they are used
+    def __init__(self, code: str):
+        self.code = code
+        self.types = array('B')
+        self.starts = array('I')
+        self.ends = array('I')
+        self._newlines: Optional[array] = None
+        for type_index, start, end in iter_spans(code):
+            if type_index in SKIPPED_INDEXES:
+                continue
+            self.types.append(type_index)
+            self.starts.append(start)
+            self.ends.append(end)
+        # The two tokens at the end are not in the source code
+        self.size = len(self.types)
+        self.types.extend([STATEMENT_END_INDEX, EOF_INDEX])
+
+    def edit(self, start: int, end: int, text: str) -> tuple[int, int, int]:
+        # Replace code[start:end] with text, and lex again only the damaged tokens
+        # Return (first, old_stop, new_stop): tokens[first:old_stop] are replaced by tokens[first:new_stop]
+        code = self.code[:start] + text + self.code[end:]
+        delta = len(text) - (end - start)
+        edited_end = start + len(text)
+        size = self.size
+        # The end of a token before the edit is a place where the lexer stopped
+        # A token may have looked at two characters after it (for example "0" looked at "x1" for "0x1")
+        first = bisect_left(self.ends, start - 2, 0, size)
+        # An unclosed "/*" was lexed as "/" and "*", but the edit may close it
+        # Every "/*" after the last "*/" is unclosed
+        opener = self.code.find('/*', max(self.code.rfind('*/') - 1, 0), start + 1)
+        if opener != -1:
+            first = bisect_left(self.starts, opener, 0, first)
+        pos = self.ends[first - 1] if first > 0 else 0
+        types, starts, ends = array('B'), array('I'), array('I')
+        old_stop = size
+        for type_index, token_start, token_end in iter_spans(code, pos):
+            if token_start >= edited_end:
+                # From the start of an old token after the edit, the lexer gets the old tokens again
+                i = bisect_left(self.starts, token_start - delta, first, size)
+                if i < size and self.starts[i] == token_start - delta:
+                    old_stop = i
+                    break
+            if type_index in SKIPPED_INDEXES:
+                continue
+            types.append(type_index)
+            starts.append(token_start)
+            ends.append(token_end)
+        shift = delta.__add__
+        self.starts = self.starts[:first] + starts + array('I', map(shift, self.starts[old_stop:size]))
+        self.ends = self.ends[:first] + ends + array('I', map(shift, self.ends[old_stop:size]))
+        self.types[first:old_stop] = types
+        self.size = len(self.starts)
+        self.code = code
+        self._newlines = None
+        return first, old_stop, first + len(types)
+
+    def __len__(self) -> int:
+        return len(self.types)
+
+    def __getitem__(self, index: int) -> TokenView:
+        if not 0 <= index < len(self.types):
+            raise IndexError('token buffer index out of range')
+        return TokenView(self, index)
+
+    def __iter__(self) -> Iterator[TokenView]:
+        return self.iter_from(0)
+
+    def iter_from(self, start: int) -> Iterator[TokenView]:
+        for i in range(start, len(self.types)):
+            yield TokenView(self, i)
+
+    def lineno_of(self, index: int) -> Optional[int]:
+        if index >= self.size:
+            return None
+        if self._newlines is None:
+            self._newlines = array('I', (match.start() for match in re.finditer('\n', self.code)))
+        return bisect_right(self._newlines, self.starts[index] - 1) + 1
+
+    def value_of(self, index: int) -> str:
+        if index >= self.size:
+            return 'end of file'
+        if TOKEN_TYPES[self.types[index]] == TokenType.STRING:
+            # Without the quotes
+            return self.code[self.starts[index] + 1:self.ends[index] - 1]
+        return self.code[self.starts[index]:self.ends[index]]
+
+class TokenView:
+    __slots__ = ('buffer', 'index')
+
+    def __init__(self, buffer: TokenBuffer, index: int):
+        self.buffer = buffer
+        self.index = index
+
+    @property
+    def type(self) -> TokenType:
+        return TOKEN_TYPES[self.buffer.types[self.index]]
+
+    @property
+    def value(self) -> str:
+        return self.buffer.value_of(self.index)
+
+    @property
+    def lineno(self) -> Optional[int]:
+        return self.buffer.lineno_of(self.index)
+
+    @property
+    def desc(self) -> str:
+        return describe(self.value, self.lineno)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, (Token, TokenView)):
+            return NotImplemented
+        return (self.type, self.value, self.lineno) == (other.type, other.value, other.lineno)
+
+    def __repr__(self) -> str:
+        return f'TokenView(type={self.type}, value={self.value!r}, lineno={self.lineno})'
+
+class TokenCursor:
+    # The parser reads tokens by index: peek(k) looks ahead, advance() takes the current token
+    # Tokens are taken from the iterator only when they are looked ahead, and the tokens
+    # before the current one (or before the oldest mark) are dropped, so only a few tokens are kept in memory
+    def __init__(self, tokens: Iterable[TokenLike]):
+        self.tokens = iter(tokens)
+        self.buffer: list[TokenLike] = []
+        self.offset = 0  # Index of buffer[0]
+        self.position = 0  # Index of the current token
+        self.marks: list[int] = []
+
+    def peek(self, k: int = 0) -> TokenLike:
+        index = self.position - self.offset + k
+        buffer = self.buffer
+        while len(buffer) <= index:
+            token = next(self.tokens, None)
+            if token is None:
+                # Looking ahead after the end always gets the EOF token
+                if not buffer or buffer[-1].type != TokenType.EOF:
+                    raise IndexError('token cursor index out of range')
+                return buffer[-1]
+            buffer.append(token)
+        return buffer[index]
+
+    def advance(self) -> TokenLike:
+        token = self.peek()
+        self.position += 1
+        index = self.position - self.offset
+        if not self.marks and index >= 1024:
+            # Drop the tokens already read, but keep the EOF token
+            index = min(index, len(self.buffer) - 1)
+            del self.buffer[:index]
+            self.offset += index
+        return token
+
+    def mark(self) -> int:
+        # The tokens after the mark are kept, until reset() or release() is called with it
+        self.marks.append(self.position)
+        return self.position
+
+    def reset(self, mark: int) -> None:
+        self.release(mark)
+        self.position = mark
+
+    def release(self, mark: int) -> None:
+        self.marks.remove(mark)
@@ -5,28 +5,95 @@ https://github.com/IsBenben/Scratch-Language
 License under the Apache License, version 2.0
 """
 
-from typing import Any
+from contextlib import contextmanager
+from typing import Any, Iterator
 import argparse
+import re
 
+VERSION = '1.2.3'
 valid_chars = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_$'
-target_ids: dict[int, Any] = {}
+ID_DIGITS = valid_chars[:-1]  # Without "$", so a temporary name ("$$...") is never an id ("$...")
+# Scratch compares the texts without their case (like the clone names, see nodes.Clone)
+NAME_DIGITS = ID_DIGITS[:36] + '_'
+ID_LENGTH = 12  # The length of a padded id (see unit_ids)
+
+class IdAllocator:
+    # The ids of a compilation: each new target gets the next id (the shortest ones first),
+    # and the same target always gets the same id, so the same code always makes the same project
+    def __init__(self, prefix: str, digits: str = ID_DIGITS) -> None:
+        self.prefix = prefix
+        self.digits = digits
+        self.padded = False  # The ids are padded to ID_LENGTH, so ID_REGEX finds them
+        self.ids: dict[Any, str] = {}
+
+    def generate(self, target: Any) -> str:
+        if target in self.ids:
+            return self.ids[target]
+        number = len(self.ids)
+        digits = ''
+        if self.padded:
+            for _ in range(ID_LENGTH - len(self.prefix)):
+                number, digit = divmod(number, len(self.digits))
+                digits = self.digits[digit] + digits
+        else:
+            # All the ids with one digit, then all the ids with two digits...
+            number += 1
+            while number > 0:
+                number, digit = divmod(number - 1, len(self.digits))
+                digits = self.digits[digit] + digits
+        self.ids[target] = self.prefix + digits
+        return self.ids[target]
+        # return str(target)  # For debugging
+
+    def reset(self) -> None:
+        self.ids.clear()
+
+block_ids = IdAllocator('$')  # The blocks, the variables and the functions of the project (see reset_ids)
+TEMPORARY_PREFIX = '$$'  # The temporary names start with it (a name in the code never does)
+temporary_names = IdAllocator(TEMPORARY_PREFIX, NAME_DIGITS)  # The temporaries made by the parser and the optimizations (reset by Parser.parse)
+linked_names = IdAllocator('$$$', NAME_DIGITS)  # The temporaries of the linked units (see linker.py)
+
+# The variable used by the clones (see nodes.Clone), neither an id nor a temporary name
+CLONE_VARIABLE = '$'
 
 def generate_id(target: Any) -> str:
-    id_num = hash(target) + 9223372036854775809
-    while id_num in target_ids and target_ids[id_num] != target:
-        id_num += 1
-    res = ''
-    while id_num > 0:
-        res = valid_chars[id_num % len(valid_chars)] + res
-        id_num //= len(valid_chars)
-    target_ids[id_num] = target
-    return '$' + res.zfill(11)
-    # return str(target)  # For debugging
+    return block_ids.generate(target)
+
+def generate_name(target: Any) -> str:
+    return temporary_names.generate(target)
+
+def reset_ids() -> None:
+    # A new project
+    block_ids.reset()
+    linked_names.reset()
+
+@contextmanager
+def unit_ids() -> Iterator[None]:
+    # The ids of a unit (see linker.py) are made apart from the ids of the project, and padded,
+    # so the linker finds them (and renames them) in the compiled unit
+    allocators = (block_ids, temporary_names, linked_names)
+    saved = [(allocator.ids, allocator.padded) for allocator in allocators]
+    for allocator in allocators:
+        allocator.ids, allocator.padded = {}, True
+    try:
+        yield
+    finally:
+        for allocator, (ids, padded) in zip(allocators, saved):
+            allocator.ids, allocator.padded = ids, padded
+
+# An id (or a temporary name) of a unit (see linker.rename_block)
+ID_REGEX = re.compile('\\$[' + re.escape(valid_chars) + ']{' + str(ID_LENGTH - 1) + '}')
 
 arg_parser = argparse.ArgumentParser(description='Scratch-Language Command Line')
-arg_parser.add_argument('--recursionlimit', '-rl', help='Python递归的上限', default=2000, type=int)
+arg_parser.add_argument('--recursionlimit', '-rl', help='Python递归的上限（只有表达式的解析不递归，优化、生成积木和输出语法树仍然递归，很深的表达式需要调大它）', default=2000, type=int)
 arg_parser.add_argument('--quite', '-q', help='静默模式，不会向控制台输出无用内容', action='store_true')
 arg_parser.add_argument('--nooptimize', '-no', help='取消优化，用于调试某些特殊情况', action='store_true')
+arg_parser.add_argument('--passes', '-ps', help='只启用这些优化（用逗号分隔，例如 fold,slots），默认启用全部', default=None)
+arg_parser.add_argument('--passreport', '-pr', help='向标准错误输出每个优化的耗时和改写的节点数', action='store_true')
+arg_parser.add_argument('--warpreport', '-wr', help='向标准错误输出每个函数是否自动设为运行时不刷新屏幕（norefresh），以及原因（不读写程序和单元的缓存）', action='store_true')
+arg_parser.add_argument('--nocache', '-nc', help='不读写磁盘上的缓存', action='store_true')
+arg_parser.add_argument('--separate', '-sp', help='分别编译被包含的文件（结果缓存在磁盘上），再链接到最终的项目中，只能与 --json 或 --sb3 一起使用', action='store_true')
+arg_parser.add_argument('--edits', '-e', help='与 --lint 一起使用，从标准输入逐行读取 JSON 格式的编辑 {"start", "end", "text"}，每次编辑后只重新分析受影响的部分', action='store_true')
 
 in_group = arg_parser.add_mutually_exclusive_group(required=True)
 in_group.add_argument('--infile', '-if', help='要解析的文件')
@@ -0,0 +1,161 @@
+# *-* encoding: utf-8 *-*
+"""
+Copyright (c) Copyright 2024 Scratch-Language Developers
+https://github.com/IsBenben/Scratch-Language
+License under the Apache License, version 2.0
+"""
+
+# Warp inference: a function which never waits (and the functions it calls never wait) gets attribute(norefresh),
+# so its loops run without waiting for the next frame
+# A function is not changed if it (or a function it calls):
+#   waits (like control_wait, looks_sayforsecs, event_broadcastandwait or sensing_askandwait), or loops forever,
+#   shows or senses something in a loop (an animation, it relies on the frames),
+#   waits in a loop for a variable set by another script,
+#   or calls a function with attribute(refresh) (it opts out, and a norefresh caller would run it without refresh too)
+# The functions are matched by their names (a name may be declared in many scopes, then all of them must never wait)
+
+from allocate import WAIT_OPCODES
+from interpret import BLOCK_TYPES
+from loops import LoopWrites
+from nodes import *
+from optimize import Names
+
+# The blocks in a loop which make it an animation (or a polling)
+FRAME_PREFIXES = ('motion_', 'looks_', 'pen_', 'sound_', 'sensing_')
+
+# The decision of each function in the last compilation: name -> the reason (see --warpreport)
+warp_decisions: dict[str, str] = {}
+
+class Reads(Names):
+    # The variables and the lists read
+    visit_ListIdentifier = Names.visit_Identifier
+
+class WaitFinder(NodeVisitor):
+    # Why a function body may wait (None if it never does), and the functions it calls
+    def __init__(self, functions: set[str]) -> None:
+        self.functions = functions
+        self.reason: str | None = None
+        self.calls: set[str] = set()
+        self.loop_calls: set[str] = set()  # The functions called in a loop
+        self.shows: str | None = None  # A block showing or sensing something (out of a loop too)
+        self.loops = 0  # The depth of the loops being visited
+
+    def visit_FunctionCall(self, node):
+        if not node.always_builtin and node.name in self.functions:
+            self.calls.add(node.name)
+            if self.loops:
+                self.loop_calls.add(node.name)
+        elif not node.always_builtin and node.name not in BLOCK_TYPES:
+            self.wait(f'calls {node.name}, which is not declared in this file')
+        elif node.name in WAIT_OPCODES:
+            self.wait(f'waits ({node.name})')
+        elif node.name == 'control_forever':
+            self.wait('loops forever')
+        elif self.loops and node.name.startswith(FRAME_PREFIXES):
+            self.wait(f'uses {node.name} in a loop')
+        elif node.name == 'control_repeat_until' and node.args:
+            # A loop whose condition is never changed by the loop waits for another script
+            writes = LoopWrites(self.functions)
+            writes.visit(node)
+            names = Reads()
+            names.visit(node.args[0])
+            if not writes.calls and not names.reads & writes.names:
+                self.wait('waits in a loop for another script')
+        if self.shows is None and node.name.startswith(FRAME_PREFIXES):
+            self.shows = node.name
+        loop = node.name in ('control_repeat', 'control_repeat_until')
+        self.loops += loop
+        self.generic_visit(node)
+        self.loops -= loop
+
+    def visit_FunctionDeclaration(self, node):
+        pass
+
+    def visit_Clone(self, node):
+        pass
+
+    def wait(self, reason: str) -> None:
+        if self.reason is None:
+            self.reason = reason
+
+class WarpInference(NodeTransformer):
+    def __init__(self) -> None:
+        super().__init__()
+        self.inferred: set[str] = set()  # The names of the functions which get attribute(norefresh)
+
+    def visit_Program(self, node):
+        declarations = Declarations()
+        declarations.visit(node)
+        functions = {declaration.name for declaration in declarations.functions}
+        reasons: dict[str, str] = {}
+        calls: dict[str, set[str]] = {}
+        loop_calls: dict[str, set[str]] = {}
+        shows: dict[str, str] = {}  # The functions showing something, and the block
+        for declaration in declarations.functions:
+            if 'refresh' in declaration.attributes:
+                reasons[declaration.name] = 'has attribute(refresh)'
+                continue
+            finder = WaitFinder(functions)
+            finder.visit(declaration.body)
+            calls.setdefault(declaration.name, set()).update(finder.calls)
+            loop_calls.setdefault(declaration.name, set()).update(finder.loop_calls)
+            if finder.shows is not None:
+                shows.setdefault(declaration.name, finder.shows)
+            if finder.reason is not None:
+                reasons.setdefault(declaration.name, finder.reason)
+        # The callers of the functions which may wait (or show something, in a loop) may wait too
+        changed = True
+        while changed:
+            changed = False
+            for name, callees in calls.items():
+                waiting = sorted(callee for callee in callees if callee in reasons)
+                showing = sorted(callee for callee in callees if callee in shows)
+                looping = sorted(callee for callee in loop_calls[name] if callee in shows)
+                if name not in reasons and waiting:
+                    reasons[name] = f'calls {waiting[0]}, which {reasons[waiting[0]]}'
+                    changed = True
+                elif name not in reasons and looping:
+                    reasons[name] = f'calls {looping[0]} in a loop, which uses {shows[looping[0]]}'
+                    changed = True
+                if name not in shows and showing:
+                    shows[name] = shows[showing[0]]
+                    changed = True
+        for declaration in declarations.functions:
+            if 'norefresh' in declaration.attributes or 'nooptimize' in declaration.attributes:
+                continue
+            if declaration.name in reasons:
+                warp_decisions[declaration.name] = 'refresh: ' + reasons[declaration.name]
+            else:
+                warp_decisions[declaration.name] = 'norefresh: inferred, it never waits'
+                self.inferred.add(declaration.name)
+        if not self.inferred:
+            return node
+        return self.generic_visit(node)
+
+    def visit_FunctionDeclaration(self, node):
+        body = self.visit(node.body)
+        changes = {} if body is None or body is node.body else {'body': body}
+        if node.name in self.inferred and 'norefresh' not in node.attributes:
+            self.rewrites += 1
+            changes['attributes'] = node.attributes + ['norefresh']
+        if not changes:
+            return node
+        rebuilt = node.replace(**changes)
+        self.rebuilt[id(rebuilt)] = rebuilt
+        return rebuilt
+
+class Declarations(NodeVisitor):
+    # All the function declarations in the program (in the functions and the clones too)
+    def __init__(self) -> None:
+        self.functions: list[FunctionDeclaration] = []
+
+    def visit_FunctionDeclaration(self, node):
+        self.functions.append(node)
+        self.generic_visit(node)
+
+    def visit_Clone(self, node):
+        self.generic_visit(node)
+
+def warp_report() -> str:
+    lines = [f'function {name}: {decision}' for name, decision in sorted(warp_decisions.items())]
+    return '\n'.join(lines) + '\n' if lines else 'no function\n'